@@ -0,0 +1,582 @@
+"""Command line entry point for the Indian River gauge tools.
+
+Usage:
+    python irg.py refresh [--cached] [--nws-forecast]
+    python irg.py sample
+    python irg.py animate [--data-file FILE | --start DT --end DT]
+    python irg.py replay [--data-file FILE | --start DT --end DT] [--speedup 60]
+    python irg.py backfill --start DATE --end DATE
+    python irg.py payloads [--dump HASH]
+    python irg.py rollups [--rebuild] [--start DT --end DT]
+    python irg.py export [--format parquet arrow] [--start DT --end DT]
+    python irg.py margins [--rebuild] [--top 20] [--series] [--start DT --end DT]
+    python irg.py loadtest --username USER [--url URL] [--levels 1 2 4 ...]
+    python irg.py quality [--data-file FILE]
+    python irg.py backtest --slides FILE [--rise 2.0 2.5 ...]
+    python irg.py benchmark [--data-file FILE] [--render]
+
+Plotting libraries and requests are only imported by the subcommands that
+use them, so fetch-only and analysis-only runs start quickly. Check with:
+    python -X importtime irg.py benchmark 2> importtime.txt
+"""
+
+import argparse, datetime, os, sys, time
+from pathlib import Path
+
+
+SAMPLE_DATA_FILE = 'sample_data/reading_dump_09212019.pkl'
+
+
+def refresh(args):
+    """Pull in new data, process it, and prepare the site to serve freshly
+    updated data.
+
+    If another refresh is already running, this waits for it and reports
+    its result, rather than fetching and rendering again.
+    """
+    import utils.analysis_utils as a_utils
+    from utils import pipeline_utils, single_flight
+
+    summary, joined = single_flight.run_single_flight('refresh',
+            lambda lease: run_refresh(args, lease))
+    if summary is None:
+        sys.exit("No readings available.")
+    if joined:
+        print(f"Joined a refresh that was already running:"
+                f" {summary['new_readings']} new readings,"
+                f" {summary['alerts']} alerts sent.")
+
+    if args.nws_forecast:
+        readings = pipeline_utils.load_recent_readings()
+        recent_readings = a_utils.get_recent_readings(readings,
+                pipeline_utils.RECENT_HOURS)
+        check_nws_forecast(recent_readings, fresh=not args.cached)
+
+
+def run_refresh(args, lease=None):
+    """Fetch, ingest, and publish. Returns a summary of the refresh, or
+    None if there are no readings.
+    """
+    import pytz
+    import utils.analysis_utils as a_utils
+    from utils import payload_archive, pipeline_utils
+
+    dt_ingest = datetime.datetime.now(pytz.utc)
+
+    # # Fetch current data, which is xml, and convert to readings.
+    # current_data = a_utils.fetch_current_data(fresh=not args.cached)
+    # readings = a_utils.process_xml_data(current_data)
+
+    # Fetch data directly from USGS, which is a tab-separated file.
+    usgs_data_file = a_utils.fetch_current_data_usgs(fresh=not args.cached)
+    with open(usgs_data_file) as f:
+        payload = f.read()
+
+    # Keep the raw response, and only parse readings newer than the archive.
+    url = None if args.cached else a_utils.get_current_usgs_url()
+    timestamps, heights, report = payload_archive.ingest_payload(payload,
+            url)
+    if report.num_removed or report.num_spikes:
+        print(report.get_formatted_report())
+    print(f"{len(timestamps)} new readings.")
+    readings = pipeline_utils.load_fetch_window(timestamps, heights)
+    if not readings:
+        return None
+
+    stage_times, alerts = pipeline_utils.run_pipeline(readings, dt_ingest,
+            new_arrays=(timestamps, heights), lease=lease)
+    return {
+        'dt_ingest': dt_ingest.isoformat(),
+        'new_readings': len(timestamps),
+        'alerts': len(alerts),
+        'stage_times': stage_times,
+    }
+
+
+def check_nws_forecast(readings, fresh=True):
+    """Compare the NWS river forecast with the minimum critical forecast."""
+    import io
+    import utils.analysis_utils as a_utils
+
+    current_data = a_utils.fetch_current_data(fresh=fresh)
+    _, forecast_readings, report = a_utils.process_nws_xml(
+            io.StringIO(current_data))
+    if report.has_issues():
+        print(report.get_formatted_report())
+    if not forecast_readings:
+        print("No NWS forecast available.")
+        return
+
+    min_cf_readings = a_utils.get_min_critical_forecast(readings)
+    critical_readings = a_utils.get_nws_critical_forecast(min_cf_readings,
+            forecast_readings)
+    if critical_readings:
+        print("NWS forecast reaches critical conditions:")
+        print(f"  {critical_readings[0].get_formatted_reading()}")
+    else:
+        print("NWS forecast stays below critical conditions.")
+
+
+def sample(args):
+    """Process the sample data, and prepare the site to serve it."""
+    from utils import single_flight
+
+    # Don't render into staging while a refresh is.
+    with single_flight.hold_lease('refresh') as lease:
+        build_sample_plots(lease)
+
+
+def build_sample_plots(lease=None):
+    """Render the sample data's plots, and publish them."""
+    import utils.analysis_utils as a_utils
+    from utils import artifact_store, plot_utils, plot_utils_mpl
+
+    recent_readings = load_data_file(SAMPLE_DATA_FILE)
+    critical_points = a_utils.get_critical_points(recent_readings)
+    staging_file = artifact_store.get_staging_file
+
+    plot_utils.plot_current_data_html(recent_readings,
+            filename=staging_file('simple_irg_plot_current.html'))
+
+    plot_utils.plot_interactive_critical_forecast_html(recent_readings[:86],
+            filename=staging_file('irg_critical_forecast_current.html'))
+
+    # Plot a shortened set of points.
+    num_points = 86
+    if num_points:
+        recent_readings = recent_readings[:num_points]
+        critical_points = a_utils.get_critical_points(recent_readings)
+
+    plot_utils_mpl.plot_critical_forecast_mpl(recent_readings,
+            critical_points,
+            filename=staging_file('irg_critical_forecast_plot_current.png'))
+
+    if lease:
+        lease.check()
+    artifact_store.publish_artifacts()
+
+
+def animate(args):
+    """Render an animation from a data file, or from the archive."""
+    from utils import animation_utils, reading_archive, slide_store
+
+    dt_start = parse_local_dt(args.start) if args.start else None
+    dt_end = parse_local_dt(args.end) if args.end else None
+    if args.data_file:
+        readings = load_data_file(args.data_file)
+    elif dt_start and dt_end:
+        dt_first = dt_start - datetime.timedelta(
+                hours=animation_utils.FRAME_HOURS)
+        readings = reading_archive.load_readings(dt_first, dt_end)
+    else:
+        sys.exit("Need a data file, or a start and end time.")
+    print(f"Found {len(readings)} readings.")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    animation_utils.render_animation(readings, args.output, dt_start, dt_end,
+            args.cadence, slide_store.load_slides())
+    print(f"  saved: {args.output}")
+
+
+def replay(args):
+    """Replay archived readings through the refresh pipeline, on a virtual
+    clock.
+    """
+    from utils import reading_archive, replay_utils, slide_store
+
+    dt_start = parse_local_dt(args.start) if args.start else None
+    dt_end = parse_local_dt(args.end) if args.end else None
+    if args.data_file:
+        readings = load_data_file(args.data_file)
+    elif dt_start and dt_end:
+        dt_first = dt_start - datetime.timedelta(days=replay_utils.FETCH_DAYS)
+        readings = reading_archive.load_readings(dt_first, dt_end)
+    else:
+        sys.exit("Need a data file, or a start and end time.")
+    if not readings:
+        sys.exit("No readings to replay.")
+
+    try:
+        replay_utils.prepare_replay_dir(args.output_dir)
+    except ValueError as e:
+        sys.exit(str(e))
+    report = replay_utils.replay(readings, dt_start, dt_end, args.speedup,
+            args.cycle_minutes, render=not args.no_render,
+            replay_dir=args.output_dir, slides=slide_store.load_slides())
+    if not report.cycle_times:
+        sys.exit("No cycles had any readings.")
+    print(report.get_formatted_report())
+
+
+def backfill(args):
+    """Fill the archive with historical readings from USGS, and rebuild the
+    event catalog.
+    """
+    import utils.analysis_utils as a_utils
+    from utils import backfill_utils, event_catalog, reading_archive
+    from utils import single_flight
+
+    base_url = args.base_url if args.base_url else a_utils.USGS_URL
+    date_start = datetime.date.fromisoformat(args.start)
+    date_end = datetime.date.fromisoformat(args.end)
+    if args.restart and os.path.exists(backfill_utils.CHECKPOINT_FILE):
+        os.remove(backfill_utils.CHECKPOINT_FILE)
+
+    # Merging into the archive or the catalog while a refresh does could
+    #   lose readings or events. A backfill can run for hours, so its lease
+    #   isn't capped like a refresh's.
+    with single_flight.hold_lease('refresh', capped=False) as lease:
+        num_readings = backfill_utils.backfill(date_start, date_end,
+                args.chunk_days, args.concurrency, base_url, lease=lease)
+        print(f"Saved {num_readings} readings.")
+        lease.check()
+
+        # Backfilled readings can land anywhere in the archive, so the
+        #   catalog is rebuilt rather than updated.
+        catalog = event_catalog.EventCatalog()
+        catalog.update(reading_archive.load_readings())
+        catalog.save()
+    print(f"Found {len(catalog)} critical events.")
+
+
+def payloads(args):
+    """Summarize the archive of raw USGS responses, or print one of them."""
+    from utils import payload_archive
+
+    if args.dump:
+        sys.stdout.write(payload_archive.load_payload(args.dump))
+        return
+
+    fetches = payload_archive.get_fetches()
+    fetched_size = sum(fetch['size'] for fetch in fetches)
+    stored_size = payload_archive.get_stored_size()
+    print(f"{len(fetches)} fetches, {len(set(f['payload'] for f in fetches))} distinct responses.")
+    print(f"  fetched: {fetched_size / 1024:.1f} KB, stored: {stored_size / 1024:.1f} KB")
+    for fetch in fetches[-args.show:]:
+        print(f"  {fetch['dt_fetched']} - {fetch['payload'][:16]},"
+                f" {fetch['new_blocks']} of {fetch['num_blocks']} blocks new")
+
+
+def rollups(args):
+    """Rebuild the hourly and daily rollups, or print them for a date range."""
+    from utils import rollup_utils, single_flight
+
+    if args.rebuild:
+        # A refresh updates the same files.
+        with single_flight.hold_lease('refresh', capped=False):
+            rollup_utils.rebuild_rollups()
+
+    dt_start = parse_local_dt(args.start) if args.start else None
+    dt_end = parse_local_dt(args.end) if args.end else None
+    if not (dt_start or dt_end):
+        return
+    for row in rollup_utils.load_rollups(args.resolution, dt_start, dt_end):
+        print(rollup_utils.get_formatted_rollup(row, args.resolution))
+
+
+def export(args):
+    """Export the readings and event catalog as Parquet and Arrow files."""
+    from utils import export_utils
+
+    dt_start = parse_local_dt(args.start) if args.start else None
+    dt_end = parse_local_dt(args.end) if args.end else None
+    filenames = export_utils.export_history(args.dir, args.format, dt_start,
+            dt_end)
+    for filename in filenames:
+        print(f"  wrote {filename} ({os.path.getsize(filename) / 1024:.1f} KB)")
+
+
+def margins(args):
+    """Rebuild the margins to critical, list the closest calls, or print the
+    margins over a time range.
+    """
+    from utils import margin_utils, single_flight
+
+    if args.rebuild:
+        # A refresh updates the same files.
+        with single_flight.hold_lease('refresh', capped=False):
+            margin_utils.rebuild_margins()
+
+    dt_start = parse_local_dt(args.start) if args.start else None
+    dt_end = parse_local_dt(args.end) if args.end else None
+    if args.series:
+        for row in margin_utils.load_margins(dt_start, dt_end):
+            print(f"  {margin_utils.get_formatted_margin(row)}")
+        return
+
+    calls = margin_utils.get_closest_calls(args.top, dt_start, dt_end)
+    print(f"{len(calls)} closest calls:")
+    for call in calls:
+        print(f"  {margin_utils.get_formatted_call(call)}")
+
+
+def loadtest(args):
+    """Measure throughput and latency of the site under increasing load."""
+    from utils import loadtest_utils
+
+    password = args.password if args.password else os.environ.get(
+            'IRG_LOADTEST_PASSWORD')
+    if not password:
+        sys.exit("Need a password, with --password or IRG_LOADTEST_PASSWORD.")
+
+    report = loadtest_utils.run_load_test(args.username, password, args.url,
+            args.levels, args.seconds, args.workers, args.seed)
+    print(report.get_formatted_report())
+
+
+def quality(args):
+    """Report on the quality of the archive, or of a data file."""
+    from utils import quality_utils, reading_archive, resample_utils
+
+    if args.data_file:
+        timestamps, heights = resample_utils.readings_to_arrays(
+                load_data_file(args.data_file))
+    else:
+        timestamps, heights = reading_archive.load_arrays()
+
+    _, _, report = quality_utils.clean_arrays(timestamps, heights)
+    print(report.get_formatted_report())
+
+
+def backtest(args):
+    """Backtest critical thresholds against known slides."""
+    from utils import backtest_utils, reading_archive, slide_store
+
+    slides = slide_store.load_slides(args.slides)
+    if args.data_file:
+        readings = load_data_file(args.data_file)
+    else:
+        readings = reading_archive.load_readings()
+    print(f"Backtesting {len(readings)} readings against {len(slides)} slides.")
+
+    grid = {'rise_critical': args.rise, 'm_critical': args.m,
+            'lookback_hours': args.lookback,
+            'suppression_hours': args.suppression}
+    grid = {name: values for name, values in grid.items() if values}
+    warning_hours = args.warning_hours
+    if warning_hours is None:
+        warning_hours = backtest_utils.WARNING_HOURS
+    results = backtest_utils.run_backtest(readings,
+            [s.dt_slide for s in slides.slides], grid,
+            warning_hours=warning_hours, workers=args.workers)
+    backtest_utils.print_backtest_results(results)
+
+
+def benchmark(args):
+    """Time each stage of the analysis, and optionally rendering."""
+    import utils.analysis_utils as a_utils
+    from utils import event_catalog, resample_utils
+
+    stages = [
+        ('load', lambda: load_data_file(args.data_file)),
+    ]
+    readings = stages[0][1]()
+    stages += [
+        ('resample', lambda: resample_utils.resample_readings(readings)),
+        ('critical points', lambda: a_utils.get_critical_points(readings)),
+        ('first critical points',
+            lambda: a_utils.get_first_critical_points(readings)),
+        ('event catalog',
+            lambda: event_catalog.EventCatalog().update(readings)),
+    ]
+    if args.render:
+        from utils import plot_utils, plot_utils_mpl
+        critical_points = a_utils.get_critical_points(readings)
+        stages += [
+            ('plotly html', lambda: plot_utils.plot_current_data_html(readings)),
+            ('mpl png', lambda: plot_utils_mpl.plot_critical_forecast_mpl(
+                    readings, critical_points)),
+        ]
+
+    print(f"{len(readings)} readings, best of {args.repeat} runs:")
+    for name, stage in stages:
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            stage()
+            times.append(time.perf_counter() - start)
+        print(f"  {name:<24} {min(times) * 1000:>10.2f} ms")
+
+
+def load_data_file(data_file):
+    """Load readings from a raw USGS file, or a pickled list of readings."""
+    import pickle
+    import utils.analysis_utils as a_utils
+
+    file_extension = Path(data_file).suffix
+    if file_extension == '.txt':
+        readings, report = a_utils.process_usgs_data(data_file)
+        if report.has_issues():
+            print(report.get_formatted_report())
+        return readings
+    elif file_extension == '.pkl':
+        with open(data_file, 'rb') as f:
+            return pickle.load(f)
+    else:
+        sys.exit(f"Data file extension not recognized: {file_extension}")
+
+
+def parse_local_dt(dt_str):
+    """Parse an iso format time, in Alaska time unless it has an offset."""
+    import pytz
+
+    dt = datetime.datetime.fromisoformat(dt_str)
+    if dt.tzinfo is None:
+        dt = pytz.timezone('US/Alaska').localize(dt)
+    return dt
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='irg',
+            description="Indian River gauge tools.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('refresh',
+            help="Fetch current data, and rebuild the site's plots.")
+    p.add_argument('--cached', action='store_true',
+            help="Use cached data instead of fetching fresh data.")
+    p.add_argument('--nws-forecast', action='store_true',
+            help="Also check the NWS river forecast against the critical "
+                "forecast.")
+    p.set_defaults(func=refresh)
+
+    p = subparsers.add_parser('sample',
+            help="Build the site's plots from the sample data.")
+    p.set_defaults(func=sample)
+
+    p = subparsers.add_parser('animate',
+            help="Render an animation of the critical forecast plot.")
+    p.add_argument('--data-file', help="A .txt USGS file or .pkl readings.")
+    p.add_argument('--start', help="First frame, local time, iso format.")
+    p.add_argument('--end', help="Last frame, local time, iso format.")
+    p.add_argument('--cadence', type=int, default=15,
+            help="Minutes between frames.")
+    p.add_argument('--output',
+            default='animation_output/animation_file_out.mp4',
+            help="Output file, .mp4 or .gif.")
+    p.set_defaults(func=animate)
+
+    p = subparsers.add_parser('replay',
+            help="Replay history through the refresh pipeline.")
+    p.add_argument('--data-file', help="A .txt USGS file or .pkl readings.")
+    p.add_argument('--start', help="First cycle, local time, iso format.")
+    p.add_argument('--end', help="Last cycle, local time, iso format.")
+    p.add_argument('--speedup', type=float, default=60,
+            help="Virtual minutes per real minute; 0 runs flat out.")
+    p.add_argument('--cycle-minutes', type=int, default=15,
+            help="Virtual minutes between refreshes.")
+    p.add_argument('--no-render', action='store_true',
+            help="Skip rendering plots.")
+    p.add_argument('--output-dir', default='replay_output',
+            help="Where the replayed pipeline writes its files.")
+    p.set_defaults(func=replay)
+
+    p = subparsers.add_parser('backfill',
+            help="Fill the archive with historical readings from USGS.")
+    p.add_argument('--start', required=True, help="First date, YYYY-MM-DD.")
+    p.add_argument('--end', required=True, help="Last date, YYYY-MM-DD.")
+    p.add_argument('--chunk-days', type=int, default=30,
+            help="Days of readings per request.")
+    p.add_argument('--concurrency', type=int, default=4,
+            help="Requests to run at once; capped at 8.")
+    p.add_argument('--base-url',
+            help="USGS service url; point this at a mock server for testing.")
+    p.add_argument('--restart', action='store_true',
+            help="Ignore the checkpoint, and fetch every chunk.")
+    p.set_defaults(func=backfill)
+
+    p = subparsers.add_parser('payloads',
+            help="Summarize the archive of raw USGS responses.")
+    p.add_argument('--show', type=int, default=10,
+            help="Number of recent fetches to list.")
+    p.add_argument('--dump', help="Print the response with this hash.")
+    p.set_defaults(func=payloads)
+
+    p = subparsers.add_parser('rollups',
+            help="Hourly and daily summaries of the archive.")
+    p.add_argument('--rebuild', action='store_true',
+            help="Recompute every rollup from the archive.")
+    p.add_argument('--resolution', choices=('hourly', 'daily'),
+            default='daily')
+    p.add_argument('--start', help="First period, local time, iso format.")
+    p.add_argument('--end', help="Last period, local time, iso format.")
+    p.set_defaults(func=rollups)
+
+    p = subparsers.add_parser('export',
+            help="Export the history as Parquet and Arrow files.")
+    p.add_argument('--format', nargs='+', choices=('parquet', 'arrow'),
+            default=['parquet', 'arrow'])
+    p.add_argument('--start', help="First reading, local time, iso format.")
+    p.add_argument('--end', help="Last reading, local time, iso format.")
+    p.add_argument('--dir', default='historical_data/exports',
+            help="Directory to write the files to.")
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser('margins',
+            help="How close readings came to critical, and the closest calls.")
+    p.add_argument('--rebuild', action='store_true',
+            help="Recompute every margin from the archive.")
+    p.add_argument('--top', type=int, default=20,
+            help="Number of closest calls to list.")
+    p.add_argument('--series', action='store_true',
+            help="Print the margin of every reading, instead of the calls.")
+    p.add_argument('--start', help="Start of the range, local time, iso format.")
+    p.add_argument('--end', help="End of the range, local time, iso format.")
+    p.set_defaults(func=margins)
+
+    p = subparsers.add_parser('loadtest',
+            help="Load test the site at increasing concurrency.")
+    p.add_argument('--username', required=True,
+            help="An existing user to log in as.")
+    p.add_argument('--password', help="Defaults to IRG_LOADTEST_PASSWORD.")
+    p.add_argument('--url',
+            help="Test a running site, instead of starting one locally.")
+    p.add_argument('--levels', type=int, nargs='+',
+            default=[1, 2, 4, 8, 16, 32],
+            help="Numbers of concurrent viewers to test.")
+    p.add_argument('--seconds', type=int, default=20,
+            help="How long to run each level.")
+    p.add_argument('--workers', type=int, default=3,
+            help="Gunicorn workers for the local server.")
+    p.add_argument('--seed', type=int)
+    p.set_defaults(func=loadtest)
+
+    p = subparsers.add_parser('quality',
+            help="Report on duplicates, spikes and gaps in the readings.")
+    p.add_argument('--data-file',
+            help="Check this data file instead of the archive.")
+    p.set_defaults(func=quality)
+
+    p = subparsers.add_parser('backtest',
+            help="Backtest critical thresholds against known slides.")
+    p.add_argument('--slides', required=True,
+            help="csv file of known slides.")
+    p.add_argument('--data-file',
+            help="Use this data file instead of the archive.")
+    p.add_argument('--rise', type=float, nargs='+')
+    p.add_argument('--m', type=float, nargs='+')
+    p.add_argument('--lookback', type=float, nargs='+')
+    p.add_argument('--suppression', type=int, nargs='+')
+    p.add_argument('--warning-hours', type=float,
+            help="Hours after an onset that a slide counts as a hit.")
+    p.add_argument('--workers', type=int)
+    p.set_defaults(func=backtest)
+
+    p = subparsers.add_parser('benchmark',
+            help="Time each stage of the pipeline.")
+    p.add_argument('--data-file', default=SAMPLE_DATA_FILE)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--render', action='store_true',
+            help="Include rendering the plots.")
+    p.set_defaults(func=benchmark)
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,1807 @@
-from django.test import TestCase
+import contextlib, datetime, http.server, io, json, os, pickle, socket
+import subprocess, sys, tempfile, threading, time, urllib.parse
+from unittest import mock
+from xml.etree import ElementTree as ET
 
-# Create your tests here.
+import dateutil.tz
+import numpy as np
+import pyarrow.parquet as pq
+import pytz
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+import utils.analysis_utils as a_utils
+from irg_viz import views
+from utils import alert_utils, animation_utils, artifact_store, backfill_utils
+from utils import backtest_utils, critical_rules, downsample_utils
+from utils import event_catalog, export_utils, loadtest_utils, margin_utils
+from utils import nowcast_utils, payload_archive, pipeline_utils, quality_utils
+from utils import reading_archive, replay_utils, resample_utils, rollup_utils
+from utils import series_cache, single_flight, slide_store, time_utils
+from utils.ir_reading import IRReading
+
+
+SAMPLE_DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'sample_data/reading_dump_09212019.pkl')
+
+
+def load_sample_readings():
+    with open(SAMPLE_DATA_FILE, 'rb') as f:
+        return pickle.load(f)
+
+
+def make_readings(heights, dt_start=None, interval_minutes=15):
+    """Return readings with the given heights, interval_minutes apart."""
+    dt_start = dt_start if dt_start else datetime.datetime(2019, 9, 1,
+            tzinfo=pytz.utc)
+    interval = datetime.timedelta(minutes=interval_minutes)
+    return [IRReading(dt_start + i * interval, float(height))
+                for i, height in enumerate(heights)]
+
+
+def make_event_heights(rise=3.0, rise_hours=4, flat_hours=12, base=21.0):
+    """Return 15-minute heights that rise steadily to a crest, and then
+    stay flat.
+    """
+    rising = base + np.linspace(0, rise, rise_hours * 4 + 1)
+    return np.concatenate((rising, np.full(flat_hours * 4, base + rise)))
+
+
+def make_archive_arrays(days=30, seed=0):
+    """Return 15-minute timestamps and heights with a few critical events,
+    some of them close together, over a noisy base.
+    """
+    rng = np.random.default_rng(seed)
+    num_readings = days * 96
+    heights = 21.0 + np.cumsum(rng.normal(0, 0.02, num_readings))
+    for start in (200, 230, 600, 900, 1500, 2700):
+        if start >= num_readings:
+            break
+        event = make_event_heights(flat_hours=6, base=0.0)
+        end = min(start + len(event), num_readings)
+        heights[start:end] += event[:end - start]
+        heights[end:] += event[end - start - 1]
+    dt_start = datetime.datetime(2019, 8, 20, tzinfo=pytz.utc)
+    timestamps = int(dt_start.timestamp()) + 900 * np.arange(num_readings)
+    return timestamps.astype(np.int64), heights
+
+
+def get_critical_brute_force(readings, rules):
+    """Check every rule against every pair of readings, the slow way.
+    Returns a boolean array per rule, over the readings.
+    """
+    timestamps, heights = resample_utils.readings_to_arrays(readings)
+    critical = np.zeros((len(rules), len(readings)), dtype=bool)
+    for index, rule in enumerate(rules):
+        for j in range(len(readings)):
+            if rule.is_stage_rule:
+                critical[index, j] = heights[j] >= rule.stage
+                continue
+            for i in range(j):
+                hours = (timestamps[j] - timestamps[i]) / 3600
+                rise = heights[j] - heights[i]
+                if (hours <= rule.lookback_hours and rise >= rule.rise
+                        and (not rule.rate or rise / hours > rule.rate)):
+                    critical[index, j] = True
+                    break
+    return critical
+
+
+def assert_records_equal(actual, expected):
+    """Compare structured arrays field by field, so nans match."""
+    assert actual.dtype == expected.dtype, (actual.dtype, expected.dtype)
+    for field in expected.dtype.names:
+        np.testing.assert_array_equal(actual[field], expected[field],
+                err_msg=field)
+
+
+def make_usgs_rdb(timestamps, heights, dt_retrieved=None):
+    """Return a USGS rdb response with the given readings, in local time
+    as USGS sends them.
+    """
+    dt_retrieved = dt_retrieved if dt_retrieved else datetime.datetime(2019,
+            9, 21, 18, 33, 47)
+    lines = [
+        "# ---------------------------------- WARNING ----------------------------------------\n",
+        "# Some of the data that you have obtained from this U.S. Geological Survey database\n",
+        "# may not have received Director's approval.\n",
+        "#\n",
+        f"# retrieved: {dt_retrieved:%Y-%m-%d %H:%M:%S} -04:00\t(natwebsdas01)\n",
+        "#\n",
+        "# Data for the following 1 site(s) are contained in this file\n",
+        "#    USGS 15087700 INDIAN R NR SITKA AK\n",
+        "agency_cd\tsite_no\tdatetime\ttz_cd\t69928_00065\t69928_00065_cd\n",
+        "5s\t15s\t20d\t6s\t14n\t10s\n",
+    ]
+    for ts, height in zip(timestamps.tolist(), heights.tolist()):
+        dt = datetime.datetime.fromtimestamp(ts, tz=pytz.utc).astimezone(
+                time_utils.aktz)
+        lines.append(f"USGS\t15087700\t{dt:%Y-%m-%d %H:%M}\t{dt:%Z}"
+                f"\t{height:.2f}\tP\n")
+    return ''.join(lines)
+
+
+def make_nws_xml(observed, forecast):
+    """Return an NWS hydrograph document, with sections of (valid, height)
+    pairs. The observed section is the 6th element, as NWS sends it.
+    """
+    def get_section(tag, pairs):
+        data = ''.join(f"""
+    <datum>
+      <valid timezone="UTC">{valid}</valid>
+      <primary name="Stage" units="ft">{height}</primary>
+      <secondary name="Flow" units="kcfs">-999</secondary>
+      <pedts>HGIRG</pedts>
+    </datum>""" for valid, height in pairs)
+        return f"<{tag} timezone=\"UTC\">{data}\n  </{tag}>"
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<site id="ikra2" name="Indian River at Sitka" generationtime="2019-09-21T22:30:00-00:00">
+  <disclaimers><AHPSXMLversion>2.2</AHPSXMLversion></disclaimers>
+  <sigstages><low units="ft"></low><flood units="ft">25</flood></sigstages>
+  <sigflows><low units="kcfs"></low></sigflows>
+  <zerodatum units="ft">0</zerodatum>
+  <rating></rating>
+  {get_section('observed', observed)}
+  {get_section('forecast', forecast)}
+</site>
+"""
+
+
+def process_xml_data_tree(data):
+    """The tree-based parser that process_xml_data() used to be."""
+    root = ET.fromstring(data)
+    readings = []
+    for reading in root[5]:
+        dt_reading = datetime.datetime.strptime(reading[0].text,
+                "%Y-%m-%dT%H:%M:%S-00:00")
+        readings.append(IRReading(dt_reading.replace(tzinfo=pytz.utc),
+                float(reading[1].text)))
+    return a_utils.clean_readings(readings)[0]
+
+
+class TempDirTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def get_path(self, *paths):
+        return os.path.join(self.tmp_dir.name, *paths)
+
+
+class SiteTestCase(TestCase):
+    """Views, with a temp dir, and a user to log in as."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.user = User.objects.create_user('viewer', password='not-used')
+
+    def get_path(self, *paths):
+        return os.path.join(self.tmp_dir.name, *paths)
+
+    def assert_login_required(self, url):
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/users/login/', response['Location'])
+        self.client.force_login(self.user)
+
+
+class CriticalRulesTests(SimpleTestCase):
+
+    RULES = [
+        critical_rules.CriticalRule('sustained_rise',
+            rise=critical_rules.RISE_CRITICAL, rate=critical_rules.M_CRITICAL),
+        critical_rules.CriticalRule('fast_rise', rise=1.5, rate=0.6,
+            lookback_hours=2),
+        critical_rules.CriticalRule('big_rise', rise=3.0, lookback_hours=8),
+        critical_rules.CriticalRule('flood_stage', stage=24.5),
+    ]
+
+    def check_matches_brute_force(self, readings):
+        results = a_utils.evaluate_readings(readings, self.RULES)
+        expected = get_critical_brute_force(readings, self.RULES)
+        self.assertTrue(expected.any(axis=1).all())
+
+        critical_by_rule = a_utils.get_critical_points_by_rule(readings,
+                results=results)
+        for index, rule in enumerate(self.RULES):
+            self.assertEqual(critical_by_rule[rule.name],
+                    [r for r, c in zip(readings, expected[index]) if c],
+                    rule.name)
+        self.assertEqual(a_utils.get_critical_points(readings, self.RULES),
+                [r for r, c in zip(readings, expected.any(axis=0)) if c])
+
+    def test_15_minute_readings(self):
+        timestamps, heights = make_archive_arrays(days=8, seed=1)
+        self.check_matches_brute_force(
+                resample_utils.arrays_to_readings(timestamps, heights))
+
+    def test_hourly_readings(self):
+        timestamps, heights = make_archive_arrays(days=8, seed=2)
+        self.check_matches_brute_force(resample_utils.arrays_to_readings(
+                timestamps[::4], heights[::4]))
+
+    def test_sample_data(self):
+        readings = load_sample_readings()
+        expected = get_critical_brute_force(readings, critical_rules.RULES)
+        self.assertTrue(expected.any())
+        self.assertEqual(a_utils.get_critical_points(readings),
+                [r for r, c in zip(readings, expected.any(axis=0)) if c])
+
+    def test_alert_state_from_shared_results(self):
+        readings = load_sample_readings()
+        for end in range(20, len(readings), 7):
+            results = a_utils.evaluate_readings(readings[:end])
+            self.assertEqual(
+                    alert_utils.get_rules_met(readings[:end], results),
+                    alert_utils.get_rules_met(readings[:end]))
+
+
+def make_close_call_arrays(days=40, seed=3):
+    """Return archive arrays with critical events, and rises that come close
+    to critical without getting there.
+    """
+    timestamps, heights = make_archive_arrays(days, seed)
+    for start, rise in ((400, 2.0), (1100, 2.3), (1130, 1.8), (3300, 2.2)):
+        bump = make_event_heights(rise=rise, flat_hours=6, base=0.0)
+        heights[start:start + len(bump)] += bump
+        heights[start + len(bump):] += bump[-1]
+    return timestamps, heights
+
+
+def ingest_in_refreshes(timestamps, heights, archive_dir, update, step=28):
+    """Merge readings into an archive the way refreshes do: a few days at a
+    time, each fetch overlapping the last, calling update after each merge.
+    """
+    for end in range(step, len(timestamps) + step, step):
+        start = max(end - 3 * 96, 0)
+        reading_archive.save_arrays(timestamps[start:end],
+                heights[start:end], archive_dir)
+        update(timestamps[start:end], heights[start:end])
+
+
+class MarginTests(TempDirTestCase):
+
+    def test_incremental_matches_rebuild(self):
+        archive_dir = self.get_path('readings')
+        timestamps, heights = make_close_call_arrays()
+        ingest_in_refreshes(timestamps, heights, archive_dir,
+                lambda ts, h: margin_utils.update_margins(ts, h, archive_dir))
+
+        rebuilt_dir = self.get_path('rebuilt')
+        margin_utils.rebuild_margins(archive_dir, rebuilt_dir)
+
+        assert_records_equal(
+                margin_utils.load_margins(margin_dir=rebuilt_dir),
+                margin_utils.load_margins(
+                    margin_dir=margin_utils.get_margin_dir(archive_dir)))
+        rebuilt_calls = margin_utils.get_closest_calls(100,
+                margin_dir=rebuilt_dir)
+        self.assertGreater(len(rebuilt_calls), 2)
+        assert_records_equal(rebuilt_calls,
+                margin_utils.get_closest_calls(100,
+                    margin_dir=margin_utils.get_margin_dir(archive_dir)))
+
+    def test_calls_match_full_scan(self):
+        timestamps, heights = make_close_call_arrays()
+        margins = margin_utils.compute_margins(timestamps, heights)
+        margin_dir = self.get_path('margins')
+        margin_utils.save_margins(margins, margin_dir)
+        assert_records_equal(
+                margin_utils.get_closest_calls(100, margin_dir=margin_dir),
+                margin_utils.find_closest_calls(margins))
+
+
+class RollupTests(TempDirTestCase):
+
+    def test_incremental_matches_rebuild(self):
+        archive_dir = self.get_path('readings')
+        # Cross a DST change, so local days of 23 and 25 hours are rolled up.
+        timestamps, heights = make_close_call_arrays()
+        timestamps += int(datetime.datetime(2019, 10, 20,
+                tzinfo=pytz.utc).timestamp()) - timestamps[0]
+        ingest_in_refreshes(timestamps, heights, archive_dir,
+                lambda ts, h: rollup_utils.update_rollups(ts, h, archive_dir))
+
+        rebuilt_dir = self.get_path('rebuilt')
+        rollup_utils.rebuild_rollups(archive_dir, rebuilt_dir)
+        for resolution in rollup_utils.RESOLUTIONS:
+            rebuilt = rollup_utils.load_rollups(resolution,
+                    rollup_dir=rebuilt_dir)
+            self.assertGreater(len(rebuilt), 0)
+            assert_records_equal(rollup_utils.load_rollups(resolution,
+                        rollup_dir=rollup_utils.get_rollup_dir(archive_dir)),
+                    rebuilt)
+
+    def test_update_only_rewrites_touched_months(self):
+        archive_dir = self.get_path('readings')
+        rollup_dir = rollup_utils.get_rollup_dir(archive_dir)
+        timestamps, heights = make_close_call_arrays(days=70)
+        reading_archive.save_arrays(timestamps[:-96], heights[:-96],
+                archive_dir)
+        rollup_utils.rebuild_rollups(archive_dir)
+
+        month_files = {}
+        for resolution in rollup_utils.RESOLUTIONS:
+            month_dir = os.path.join(rollup_dir, resolution)
+            months = reading_archive.get_months(month_dir)
+            self.assertGreater(len(months), 2)
+            for month in months:
+                filename = os.path.join(month_dir, f"{month}.npy")
+                month_files[filename] = os.stat(filename).st_mtime_ns
+
+        time.sleep(0.01)
+        ingest_in_refreshes(timestamps[-96:], heights[-96:], archive_dir,
+                lambda ts, h: rollup_utils.update_rollups(ts, h, archive_dir))
+        rewritten = [f for f, mtime in month_files.items()
+                        if os.stat(f).st_mtime_ns != mtime]
+        self.assertEqual(sorted(os.path.basename(f) for f in rewritten),
+                ['2019-10.npy', '2019-10.npy'])
+
+
+class BacktestTests(SimpleTestCase):
+    """Three events over a flat river: one followed by a slide, one
+    followed by a slide too late to count, and one with no slide.
+    """
+
+    EVENT_STARTS = (96, 300, 500)
+
+    def setUp(self):
+        heights = np.full(7 * 96, 21.0)
+        for start in self.EVENT_STARTS:
+            event = make_event_heights(flat_hours=0, base=0.0)
+            heights[start:start + len(event)] += event
+            heights[start + len(event):] += event[-1]
+        dt_start = datetime.datetime(2019, 8, 20, tzinfo=pytz.utc)
+        self.timestamps = (int(dt_start.timestamp())
+                + 900 * np.arange(len(heights)))
+        self.readings = resample_utils.arrays_to_readings(self.timestamps,
+                heights)
+
+        # A 3 ft rise over 4 hours first reaches 2.5 ft 14 readings in.
+        self.onsets = [self.timestamps[start + 14]
+                for start in self.EVENT_STARTS]
+        self.slide_times = [
+            datetime.datetime.fromtimestamp(self.onsets[0] + 5 * 3600,
+                    pytz.utc),
+            datetime.datetime.fromtimestamp(self.onsets[1] + 20 * 3600,
+                    pytz.utc),
+        ]
+
+    def test_scores_known_events(self):
+        results = backtest_utils.run_backtest(self.readings,
+                self.slide_times, workers=1)
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result['events'], 3)
+        self.assertEqual(result['hits'], 1)
+        self.assertEqual(result['misses'], 1)
+        self.assertEqual(result['false_alarms'], 2)
+        self.assertEqual(result['lead_times'], [5.0])
+        self.assertEqual(result['mean_lead_time'], 5.0)
+
+        # Nothing reaches a higher threshold, so both slides are missed.
+        result = backtest_utils.run_backtest(self.readings, self.slide_times,
+                {'rise_critical': [3.5]}, workers=1)[0]
+        self.assertEqual((result['events'], result['hits'],
+                result['misses'], result['false_alarms']), (0, 0, 2, 0))
+        self.assertIsNone(result['mean_lead_time'])
+
+    def test_pool_matches_serial(self):
+        grid = {
+            'rise_critical': [2.0, 2.5, 3.5],
+            'm_critical': [0.25, 0.5, 1.0],
+            'suppression_hours': [6, 12],
+        }
+        serial = backtest_utils.run_backtest(self.readings, self.slide_times,
+                grid, workers=1)
+        pooled = backtest_utils.run_backtest(self.readings, self.slide_times,
+                grid, workers=2)
+        self.assertEqual(len(serial), 18)
+        self.assertEqual(pooled, serial)
+
+
+class SlideStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.dt_first = datetime.datetime(2019, 8, 20, tzinfo=pytz.utc)
+        hours = lambda h: self.dt_first + datetime.timedelta(hours=h)
+        self.slides = [
+            slide_store.SlideEvent(hours(0), hours(3 * 24), 'long'),
+            slide_store.SlideEvent(hours(10), hours(12), 'short'),
+            slide_store.SlideEvent(hours(40), name='exact'),
+            slide_store.SlideEvent(hours(50), hours(51), 'later'),
+        ]
+        self.store = slide_store.SlideStore(reversed(self.slides))
+        self.hours = hours
+
+    def test_long_slide_before_window(self):
+        # The long slide starts well before the window, and more than one
+        #   slide starts between it and the window.
+        slides = self.store.get_slides(self.hours(45), self.hours(49))
+        self.assertEqual([s.name for s in slides], ['long'])
+
+        slides = self.store.get_slides(self.hours(11), self.hours(40))
+        self.assertEqual([s.name for s in slides], ['long', 'short', 'exact'])
+
+        slides = self.store.get_slides(self.hours(73), self.hours(100))
+        self.assertEqual(slides, [])
+
+    def test_matches_scan(self):
+        for start in range(0, 80, 3):
+            for length in (0, 1, 5, 30):
+                dt_start = self.hours(start)
+                dt_end = self.hours(start + length)
+                expected = [s for s in self.slides
+                        if s.dt_start <= dt_end and s.dt_end >= dt_start]
+                self.assertEqual(self.store.get_slides(dt_start, dt_end),
+                        expected, (start, length))
+
+
+class EventCatalogTests(TempDirTestCase):
+
+    def test_incremental_matches_rebuild(self):
+        archive_dir = self.get_path('readings')
+        timestamps, heights = make_archive_arrays()
+
+        # Ingest a refresh at a time; each fetch overlaps the last.
+        catalog = event_catalog.EventCatalog()
+        step = 4 * 7
+        for end in range(step, len(timestamps) + step, step):
+            start = max(end - 3 * 96, 0)
+            reading_archive.save_arrays(timestamps[start:end],
+                    heights[start:end], archive_dir)
+            catalog.update_from_archive(archive_dir)
+            catalog.save(self.get_path('catalog.json'))
+            catalog = event_catalog.load_catalog(self.get_path('catalog.json'))
+
+        rebuilt = event_catalog.EventCatalog()
+        rebuilt.update(resample_utils.arrays_to_readings(timestamps, heights))
+
+        self.assertGreater(len(rebuilt), 2)
+        self.assertEqual([e.to_dict() for e in catalog.events],
+                [e.to_dict() for e in rebuilt.events])
+        self.assertEqual((catalog.last_ts, catalog.num_readings),
+                (rebuilt.last_ts, rebuilt.num_readings))
+
+
+class NowcastLibraryTests(TempDirTestCase):
+
+    def test_incremental_matches_rebuild(self):
+        archive_dir = self.get_path('readings')
+        library_file = self.get_path('library.npz')
+        timestamps, heights = make_archive_arrays()
+        # Drop a few stretches, so the library sees gaps and filled slots.
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[[100, 101, 950, 951, 952, 953, 954, 1700]] = False
+        timestamps, heights = timestamps[keep], heights[keep]
+
+        library = nowcast_utils.AnalogLibrary()
+        for end in range(50, len(timestamps) + 50, 50):
+            reading_archive.save_arrays(timestamps[end - 50:end],
+                    heights[end - 50:end], archive_dir)
+            library.update(archive_dir)
+            library.save(library_file)
+            library = nowcast_utils.AnalogLibrary.load(library_file)
+
+        rates, paths = nowcast_utils.build_library(timestamps, heights)
+        self.assertGreater(len(rates), 0)
+        np.testing.assert_array_equal(library.rates, rates)
+        np.testing.assert_array_equal(library.paths, paths)
+
+    def test_rebuilds_when_past_changes(self):
+        archive_dir = self.get_path('readings')
+        timestamps, heights = make_archive_arrays()
+        reading_archive.save_arrays(timestamps[1000:], heights[1000:],
+                archive_dir)
+        library = nowcast_utils.AnalogLibrary()
+        library.update(archive_dir)
+
+        # A backfill adds older readings, with a storm in them.
+        reading_archive.save_arrays(timestamps[:1000], heights[:1000],
+                archive_dir)
+        reading_archive.save_arrays(timestamps[-1:] + 900, heights[-1:],
+                archive_dir)
+        library.update(archive_dir)
+
+        rates, paths = nowcast_utils.build_library(
+                *reading_archive.load_arrays(archive_dir=archive_dir))
+        np.testing.assert_array_equal(library.rates, rates)
+        np.testing.assert_array_equal(library.paths, paths)
+
+
+class FetchWindowTests(TempDirTestCase):
+
+    def test_recent_readings_and_fetch_window(self):
+        archive_dir = self.get_path('readings')
+        self.assertEqual(pipeline_utils.load_recent_readings(
+                archive_dir=archive_dir), [])
+
+        timestamps, heights = make_archive_arrays(days=10)
+        reading_archive.save_arrays(timestamps[:-96], heights[:-96],
+                archive_dir)
+        readings = pipeline_utils.load_recent_readings(3, archive_dir)
+        recent = timestamps[:-96][-3 * 96 - 1:]
+        self.assertEqual([r.dt_reading.timestamp() for r in readings],
+                list(recent))
+
+        # New readings go after the archived ones, and the window ends
+        #   with them.
+        readings = pipeline_utils.load_fetch_window(timestamps[-96:],
+                heights[-96:], 3, archive_dir)
+        self.assertEqual([r.dt_reading.timestamp() for r in readings],
+                list(timestamps[-3 * 96 - 1:]))
+        self.assertEqual(readings[-1].height, heights[-1])
+
+
+class ReplayDirTests(TempDirTestCase):
+
+    def test_clears_earlier_replay(self):
+        replay_dir = self.get_path('replay')
+        replay_utils.prepare_replay_dir(replay_dir)
+        os.makedirs(os.path.join(replay_dir, 'historical_data'))
+        open(os.path.join(replay_dir, 'historical_data', 'alerts.log'),
+                'w').close()
+
+        replay_utils.prepare_replay_dir(replay_dir)
+        self.assertEqual(os.listdir(replay_dir), [replay_utils.MARKER_FILE])
+
+    def test_refuses_other_dir(self):
+        open(self.get_path('notes.txt'), 'w').close()
+        with self.assertRaises(ValueError):
+            replay_utils.prepare_replay_dir(self.tmp_dir.name)
+        self.assertTrue(os.path.exists(self.get_path('notes.txt')))
+
+    def test_range_without_readings(self):
+        readings = make_readings(make_event_heights())
+        dt_start = readings[-1].dt_reading + datetime.timedelta(days=10)
+        report = replay_utils.replay(readings, dt_start,
+                dt_start + datetime.timedelta(hours=1), speedup=0,
+                render=False, replay_dir=self.get_path('replay'))
+        self.assertEqual(report.get_formatted_report(),
+                "No cycles replayed; no readings in the replay's range.")
+
+
+class ResampleTests(SimpleTestCase):
+
+    def test_infer_interval(self):
+        t0 = 1568000000 - 1568000000 % 3600
+        quarter_hours = t0 + 900 * np.arange(40)
+        # One odd interval doesn't count.
+        odd = np.append(quarter_hours, quarter_hours[-1] + 420)
+        self.assertEqual(resample_utils.infer_interval(odd), 900)
+        # Hourly readings that switch to 15 minutes resolve to 15 minutes.
+        hourly = t0 - 3600 * np.arange(1, 60)[::-1]
+        self.assertEqual(resample_utils.infer_interval(
+                np.concatenate((hourly, quarter_hours))), 900)
+        self.assertEqual(resample_utils.infer_interval(hourly), 3600)
+        # Duplicates and order don't matter.
+        self.assertEqual(resample_utils.infer_interval(
+                np.concatenate((quarter_hours, quarter_hours))[::-1]), 900)
+        self.assertEqual(resample_utils.infer_interval(quarter_hours[:1]),
+                3600)
+
+    def test_short_gaps_filled_and_long_gaps_left(self):
+        # Slots 10-12 are missing, which is a 60 minute gap, and slots
+        #   21-28 are missing, which is a 135 minute gap.
+        slots = np.r_[0:10, 13:21, 29:36]
+        t0 = 1568000000 - 1568000000 % 900
+        timestamps = t0 + 900 * slots
+        # A few readings come in off the grid.
+        for slot, jitter in ((3, 120), (15, -180), (31, 90)):
+            timestamps[slots == slot] += jitter
+        heights = 21.0 + 0.1 * slots
+        # A late duplicate of slot 5, which replaces the first one.
+        timestamps = np.append(timestamps, t0 + 900 * 5 + 60)
+        heights = np.append(heights, 30.0)
+        order = np.random.default_rng(0).permutation(len(timestamps))
+        order = np.append(order[order != len(timestamps) - 1],
+                len(timestamps) - 1)
+        timestamps, heights = timestamps[order], heights[order]
+
+        series = resample_utils.resample_arrays(timestamps, heights)
+        self.assertEqual((series.start, series.interval, len(series)),
+                (t0, 900, 36))
+
+        # Each reading lands in its nearest slot.
+        read = series.source_index >= 0
+        np.testing.assert_array_equal(np.flatnonzero(read), slots)
+        np.testing.assert_array_equal(series.heights[read],
+                heights[series.source_index[read]])
+        self.assertEqual(series.heights[5], 30.0)
+        self.assertEqual(series.source_index[5], len(timestamps) - 1)
+
+        np.testing.assert_array_equal(np.flatnonzero(series.interpolated),
+                [10, 11, 12])
+        np.testing.assert_allclose(series.heights[10:13],
+                np.linspace(series.heights[9], series.heights[13], 5)[1:-1])
+        np.testing.assert_array_equal(np.flatnonzero(series.gaps),
+                np.arange(21, 29))
+        np.testing.assert_array_equal(np.flatnonzero(series.source_index
+                == -1), np.r_[10:13, 21:29])
+        self.assertEqual(series.get_gap_periods(),
+                [(series.get_datetime(21), series.get_datetime(28))])
+
+        # A shorter allowed gap leaves the first gap too.
+        series = resample_utils.resample_arrays(timestamps, heights,
+                max_gap_minutes=45)
+        self.assertEqual(series.gaps.sum(), 11)
+        self.assertFalse(series.interpolated.any())
+
+
+class QualityTests(SimpleTestCase):
+
+    def setUp(self):
+        self.timestamps = 1568000000 + 900 * np.arange(12, dtype=np.int64)
+        self.heights = np.full(12, 21.0)
+
+    def test_spikes_are_flagged_and_kept(self):
+        self.heights[5] += 1.5
+        kept, flags, report = quality_utils.clean_arrays(self.timestamps,
+                self.heights)
+        np.testing.assert_array_equal(kept, np.arange(12))
+        self.assertEqual(flags[5], quality_utils.FLAG_SPIKE)
+        self.assertEqual(np.count_nonzero(flags), 1)
+        self.assertEqual((report.num_spikes, report.num_removed), (1, 0))
+
+    def test_drop_spikes(self):
+        self.heights[5] += 1.5
+        kept, flags, report = quality_utils.clean_arrays(self.timestamps,
+                self.heights, drop_spikes=True)
+        self.assertNotIn(5, kept)
+        self.assertFalse(flags.any())
+        self.assertEqual((report.num_spikes, report.num_removed), (1, 1))
+
+    def test_gaps_are_flagged(self):
+        keep = np.arange(12) != 6
+        timestamps, heights = self.timestamps[keep], self.heights[keep]
+        timestamps[6:] += 3600
+        kept, flags, report = quality_utils.clean_arrays(timestamps, heights)
+        self.assertEqual(len(kept), 11)
+        np.testing.assert_array_equal(
+                np.flatnonzero(flags & quality_utils.FLAG_AFTER_GAP), [6])
+        self.assertEqual(len(report.gaps), 1)
+
+    def test_context_checks_the_first_new_reading(self):
+        self.heights[6] += 1.5
+        new = slice(6, None)
+        _, flags, _ = quality_utils.clean_arrays(self.timestamps[new],
+                self.heights[new])
+        self.assertFalse(flags.any())
+
+        kept, flags, report = quality_utils.clean_arrays(
+                self.timestamps[new], self.heights[new],
+                context=(self.timestamps[:6], self.heights[:6]))
+        np.testing.assert_array_equal(kept, np.arange(6))
+        self.assertEqual(flags[0], quality_utils.FLAG_SPIKE)
+        self.assertEqual((report.num_readings, report.num_spikes), (6, 1))
+
+    def test_report_is_returned_not_printed(self):
+        self.heights[5] += 1.5
+        readings = resample_utils.arrays_to_readings(self.timestamps,
+                self.heights)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            readings, report = a_utils.clean_readings(readings[::-1])
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(len(readings), 12)
+        self.assertEqual(report.num_spikes, 1)
+        self.assertTrue(report.has_issues())
+
+
+class NwsXmlTests(SimpleTestCase):
+
+    def setUp(self):
+        # NWS lists the newest readings first. Include a duplicate, a spike,
+        #   and a gap.
+        dt_last = datetime.datetime(2019, 9, 21, 22, 15)
+        observed = [(dt_last - datetime.timedelta(minutes=15 * i),
+                    f"{21.0 + 0.01 * (i % 7):.2f}") for i in range(200)]
+        observed[40] = (observed[40][0], '23.50')
+        del observed[90:96]
+        observed.insert(10, observed[10])
+        self.observed = [(dt.strftime('%Y-%m-%dT%H:%M:%S-00:00'), height)
+                for dt, height in observed]
+        self.forecast = [((dt_last + datetime.timedelta(hours=6 * i)
+                    ).strftime('%Y-%m-%dT%H:%M:%S-00:00'), f"{21.5 - 0.1 * i:.2f}")
+                for i in range(1, 13)]
+        self.data = make_nws_xml(self.observed, self.forecast)
+
+    def assert_readings_equal(self, actual, expected):
+        self.assertEqual([(r.dt_reading, r.height) for r in actual],
+                [(r.dt_reading, r.height) for r in expected])
+
+    def test_matches_tree_parser(self):
+        self.assert_readings_equal(a_utils.process_xml_data(self.data),
+                process_xml_data_tree(self.data))
+
+    def test_forecast(self):
+        _, forecast_readings, _ = a_utils.process_nws_xml(
+                io.StringIO(self.data))
+        expected = [IRReading(datetime.datetime.strptime(valid,
+                        "%Y-%m-%dT%H:%M:%S-00:00").replace(tzinfo=pytz.utc),
+                    float(height)) for valid, height in self.forecast]
+        self.assert_readings_equal(forecast_readings, expected)
+
+    def test_document_order(self):
+        series = a_utils.parse_nws_xml(io.StringIO(self.data))
+        observed_ts, observed_heights = series['observed']
+        self.assertEqual(len(observed_ts), len(self.observed))
+        self.assertEqual(observed_heights.tolist(),
+                [float(height) for _, height in self.observed])
+        self.assertEqual(
+                a_utils.parse_nws_timestamps(['2019-09-21T14:15:00-08:00'])[0],
+                a_utils.parse_nws_timestamps(['2019-09-21T22:15:00-00:00'])[0])
+
+
+class ExportTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = self.get_path('readings')
+        self.catalog_file = self.get_path('catalog.json')
+        self.timestamps, self.heights = make_archive_arrays(days=45)
+        reading_archive.save_arrays(self.timestamps, self.heights,
+                self.archive_dir)
+        catalog = event_catalog.EventCatalog()
+        catalog.update_from_archive(self.archive_dir)
+        catalog.save(self.catalog_file)
+
+    def test_month_range_round_trip(self):
+        filenames = export_utils.export_history(self.get_path('exports'),
+                archive_dir=self.archive_dir, catalog_file=self.catalog_file)
+        self.assertEqual(len(filenames), 4)
+
+        # One row group per archive month: August, September, October.
+        parquet_file = self.get_path('exports', 'readings.parquet')
+        self.assertEqual(pq.ParquetFile(parquet_file).num_row_groups, 3)
+
+        dt_start = datetime.datetime(2019, 9, 1, tzinfo=pytz.utc)
+        dt_end = datetime.datetime(2019, 9, 30, 23, 45, tzinfo=pytz.utc)
+        in_range = ((self.timestamps >= dt_start.timestamp())
+                & (self.timestamps <= dt_end.timestamp()))
+        for export_format in export_utils.FORMATS:
+            filename = self.get_path('exports', f"readings.{export_format}")
+            table = export_utils.read_readings(filename, dt_start, dt_end)
+            timestamps = np.array([dt.timestamp() for dt in
+                    table.column('ts').to_pylist()], dtype=np.int64)
+            heights = np.array(table.column('height').to_pylist())
+            np.testing.assert_array_equal(timestamps,
+                    self.timestamps[in_range])
+            np.testing.assert_array_equal(heights, self.heights[in_range])
+
+        table = export_utils.read_readings(self.get_path('exports',
+                'readings.arrow'))
+        self.assertEqual(table.num_rows, len(self.timestamps))
+        self.assertEqual(sum(table.column('critical').to_pylist()),
+                export_utils.get_critical_flags(self.timestamps,
+                self.heights).sum())
+
+
+class DownsampleTests(SimpleTestCase):
+
+    def setUp(self):
+        self.timestamps, self.heights = make_archive_arrays(days=60)
+        # A one-reading spike each way, far narrower than a bucket.
+        self.spikes = (1234, 4321)
+        self.heights[self.spikes[0]] += 5.0
+        self.heights[self.spikes[1]] -= 5.0
+
+    def test_endpoints_kept_and_length_bounded(self):
+        for method in downsample_utils.DOWNSAMPLE_METHODS:
+            for max_points in (3, 4, 100, 999, 2000):
+                timestamps, heights = downsample_utils.downsample(
+                        self.timestamps, self.heights, max_points, method)
+                self.assertLessEqual(len(timestamps), max_points)
+                self.assertEqual(timestamps[0], self.timestamps[0])
+                self.assertEqual(timestamps[-1], self.timestamps[-1])
+                self.assertEqual(heights[-1], self.heights[-1])
+                self.assertTrue((np.diff(timestamps) > 0).all())
+
+        # Short series are sent as they are.
+        timestamps, _ = downsample_utils.downsample(self.timestamps[:50],
+                self.heights[:50], 100)
+        np.testing.assert_array_equal(timestamps, self.timestamps[:50])
+
+    def test_min_max_keeps_spikes(self):
+        kept = downsample_utils.min_max(self.timestamps, self.heights, 200)
+        for spike in self.spikes:
+            self.assertIn(spike, kept)
+        self.assertEqual(self.heights[kept].max(), self.heights.max())
+        self.assertEqual(self.heights[kept].min(), self.heights.min())
+
+    def test_lttb_keeps_largest_triangles(self):
+        # A straight run with one peak keeps the peak.
+        heights = np.r_[np.linspace(21.0, 22.0, 500), 30.0,
+                np.linspace(22.0, 21.0, 500)]
+        timestamps = 900 * np.arange(len(heights))
+        kept = downsample_utils.lttb(timestamps, heights, 20)
+        self.assertEqual(len(kept), 20)
+        self.assertIn(500, kept)
+        self.assertTrue((np.diff(kept) > 0).all())
+
+
+class LoadTestReportTests(SimpleTestCase):
+
+    def test_percentiles(self):
+        # 1 to 100 ms, in no particular order.
+        times = np.random.default_rng(0).permutation(np.arange(1, 101)) / 1000
+        np.testing.assert_allclose(loadtest_utils.get_percentiles(times),
+                [50.5, 95.05, 99.01])
+        np.testing.assert_allclose(loadtest_utils.get_percentiles([0.25]),
+                [250, 250, 250])
+
+    def test_formatted_report(self):
+        report = loadtest_utils.LoadTestReport()
+        report.add_level(4, {
+            'index': list(np.arange(1, 101) / 1000),
+            'plot image': [],
+            'latest json': [],
+        }, {'plot image': 3}, duration=10.0)
+        lines = report.get_formatted_report().split('\n')
+
+        self.assertEqual(lines[0], "4 concurrent viewers: 10.0 req/s, 3 errors")
+        self.assertEqual(lines[2].split(),
+                ['index', '10.0', '50ms', '95ms', '99ms', '0'])
+        self.assertEqual(lines[3].split(),
+                ['plot', 'image', '0.0', '-', '-', '-', '3'])
+        # Endpoints with no requests at all are left out.
+        self.assertEqual(len(lines), 4)
+
+
+class SingleFlightTests(TempDirTestCase):
+
+    def write_lease(self, **lease):
+        lease = dict({'run_id': 'stale', 'pid': os.getpid(),
+                'host': 'elsewhere', 'started': time.time(),
+                'expires': time.time() + 60}, **lease)
+        os.makedirs(self.tmp_dir.name, exist_ok=True)
+        with open(single_flight.get_lease_file('refresh', self.tmp_dir.name),
+                'w') as f:
+            json.dump(lease, f)
+
+    def get_dead_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def test_live_lease_is_respected(self):
+        self.write_lease()
+        lease = single_flight.Lease('refresh', self.tmp_dir.name)
+        self.assertFalse(lease.acquire())
+        self.assertEqual(lease.holder['run_id'], 'stale')
+
+    def test_expired_lease_is_taken_over(self):
+        self.write_lease(expires=time.time() - 1)
+        lease = single_flight.Lease('refresh', self.tmp_dir.name)
+        self.assertTrue(lease.acquire())
+        lease.release()
+        self.assertIsNone(single_flight.read_lease('refresh',
+                self.tmp_dir.name))
+
+    def test_dead_holder_is_taken_over(self):
+        self.write_lease(pid=self.get_dead_pid(), host=socket.gethostname())
+        lease = single_flight.Lease('refresh', self.tmp_dir.name)
+        self.assertTrue(lease.acquire())
+        lease.release()
+
+    def test_old_holder_keeps_its_hands_off(self):
+        old = single_flight.Lease('refresh', self.tmp_dir.name)
+        self.assertTrue(old.acquire())
+        # The old run stops heartbeating, and its lease expires.
+        lease_file = single_flight.get_lease_file('refresh', self.tmp_dir.name)
+        with open(lease_file) as f:
+            stale = json.load(f)
+        self.write_lease(**dict(stale, expires=time.time() - 1))
+
+        new = single_flight.Lease('refresh', self.tmp_dir.name)
+        self.assertTrue(new.acquire())
+        old.release()
+        self.assertEqual(single_flight.read_lease('refresh',
+                self.tmp_dir.name)['run_id'], new.run_id)
+        new.release()
+
+    def test_waiter_joins_the_running_run(self):
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_refresh(lease):
+            started.set()
+            finish.wait(10)
+            return {'version': 7}
+
+        results = []
+        runner = threading.Thread(target=lambda: results.append(
+                single_flight.run_single_flight('refresh', slow_refresh,
+                    self.tmp_dir.name)))
+        runner.start()
+        started.wait(10)
+        threading.Timer(0.2, finish.set).start()
+
+        result, joined = single_flight.run_single_flight('refresh',
+                lambda lease: self.fail("Ran a second refresh."),
+                self.tmp_dir.name)
+        runner.join()
+        self.assertEqual((result, joined), ({'version': 7}, True))
+        self.assertEqual(results, [({'version': 7}, False)])
+
+    def test_over_time_run_is_stopped(self):
+        writes = []
+
+        def hung_refresh(lease):
+            while True:
+                lease.check()
+                writes.append(time.time())
+                time.sleep(0.01)
+
+        with mock.patch.object(single_flight, 'HEARTBEAT_SECONDS', 0.02), \
+                mock.patch.object(single_flight, 'MAX_RUN_MINUTES', 0.002):
+            with self.assertRaises(single_flight.LeaseLostError):
+                single_flight.run_single_flight('refresh', hung_refresh,
+                        self.tmp_dir.name)
+        self.assertTrue(writes)
+        # A joiner doesn't take the stopped run's result for its own.
+        self.assertIsNone(single_flight.load_result('refresh',
+                self.tmp_dir.name))
+
+    def test_uncapped_lease_outlives_max_run(self):
+        with mock.patch.object(single_flight, 'HEARTBEAT_SECONDS', 0.02), \
+                mock.patch.object(single_flight, 'LEASE_SECONDS', 0.1), \
+                mock.patch.object(single_flight, 'MAX_RUN_MINUTES', 0.002):
+            with single_flight.hold_lease('refresh', self.tmp_dir.name,
+                    capped=False) as lease:
+                time.sleep(0.3)
+                lease.check()
+                held = single_flight.read_lease('refresh', self.tmp_dir.name)
+                self.assertFalse(single_flight.is_stale(held))
+
+    def test_pipeline_stops_without_its_lease(self):
+        lease = single_flight.Lease('refresh', self.tmp_dir.name)
+        self.assertTrue(lease.acquire())
+        self.addCleanup(lease.release)
+        lease.lost = True
+
+        paths = pipeline_utils.PipelinePaths(self.get_path('site'))
+        readings = make_readings(make_event_heights())
+        with self.assertRaises(single_flight.LeaseLostError):
+            pipeline_utils.run_pipeline(readings,
+                    readings[-1].dt_reading, render=False, verbose=False,
+                    paths=paths, lease=lease)
+        self.assertFalse(os.path.exists(paths.root))
+
+    def test_exit_is_recorded(self):
+        with self.assertRaises(SystemExit):
+            single_flight.run_single_flight('refresh',
+                    lambda lease: sys.exit("No readings available."),
+                    self.tmp_dir.name)
+        record = single_flight.load_result('refresh', self.tmp_dir.name)
+        self.assertFalse(record['ok'])
+        self.assertIn("No readings available.", record['error'])
+
+
+class LocalTimeTests(SimpleTestCase):
+
+    def get_timestamps(self):
+        """Every 15 minutes around each of 2019's DST changes, and around
+        Alaska's change of time zones in 1983.
+        """
+        days = [datetime.datetime(2019, 3, 9), datetime.datetime(2019, 11, 2),
+                datetime.datetime(1983, 10, 29)]
+        return np.concatenate([int(pytz.utc.localize(day).timestamp())
+                    + 900 * np.arange(4 * 96, dtype=np.int64)
+                for day in days])
+
+    def test_matches_astimezone(self):
+        timestamps = self.get_timestamps()
+        dts = [datetime.datetime.fromtimestamp(ts, tz=pytz.utc).astimezone(
+                    time_utils.aktz) for ts in timestamps.tolist()]
+
+        self.assertEqual(time_utils.to_local_strings(timestamps).tolist(),
+                [dt.strftime('%Y-%m-%d %H:%M:%S') for dt in dts])
+        self.assertEqual(
+                time_utils.to_local_strings(timestamps, True).tolist(),
+                [str(dt) for dt in dts])
+        # Both sides of each change are covered.
+        self.assertGreater(len(set(dt.utcoffset() for dt in dts)), 1)
+
+    def test_zone_without_pytz_transitions(self):
+        timestamps = self.get_timestamps()
+        expected = time_utils.to_local_strings(timestamps, True).tolist()
+
+        zone = dateutil.tz.gettz('America/Anchorage')
+        self.assertFalse(hasattr(zone, '_utc_transition_times'))
+        with mock.patch.object(time_utils, 'aktz', zone):
+            self.assertEqual(
+                    time_utils.to_local_strings(timestamps, True).tolist(),
+                    expected)
+
+    def test_slices_share_conversion(self):
+        local_times = time_utils.LocalTimes(self.get_timestamps())
+        strings = local_times.strings
+        self.assertEqual(local_times[10:20].strings.tolist(),
+                strings[10:20].tolist())
+        self.assertEqual(
+                local_times.take(local_times.timestamps[[3, 50]]).strings.tolist(),
+                strings[[3, 50]].tolist())
+
+
+class AlertTransitionTests(TempDirTestCase):
+    """Feed readings to the alert engine one at a time, like refreshes."""
+
+    def run_engine(self, readings, clock=None):
+        engine = alert_utils.AlertEngine(channels=[],
+                state_file=self.get_path('state.json'),
+                clock=clock, verbose=False)
+        alerts = []
+        for i in range(2, len(readings) + 1):
+            # Without a clock, time runs with the readings.
+            if clock is None:
+                engine.clock = lambda: readings[i - 1].dt_reading
+            alerts += engine.check(readings[:i])
+        return engine, alerts
+
+    def test_crest_doesnt_clear(self):
+        readings = load_sample_readings()
+        engine, alerts = self.run_engine(readings)
+        kinds = [alert.kind for alert in alerts if alert.kind != 'approaching']
+        self.assertEqual(kinds, ['critical', 'cleared'])
+
+        critical, cleared = [a for a in alerts if a.kind != 'approaching']
+        crest = max(r.height for r in readings
+                    if r.dt_reading >= critical.reading.dt_reading)
+        self.assertLess(cleared.reading.height, crest)
+        self.assertGreaterEqual(
+                cleared.reading.dt_reading - critical.reading.dt_reading,
+                datetime.timedelta(hours=alert_utils.COOLDOWN_HOURS))
+
+    def test_critical_after_cleared_is_sent(self):
+        # Two events, far enough apart for the first to clear. The clock
+        #   doesn't move, so any cool-down on critical alerts would apply.
+        heights = np.concatenate((make_event_heights(flat_hours=12),
+                make_event_heights(base=24.0, flat_hours=2)))
+        readings = make_readings(heights)
+        dt_now = readings[-1].dt_reading
+        engine, alerts = self.run_engine(readings, clock=lambda: dt_now)
+
+        kinds = [alert.kind for alert in alerts if alert.kind != 'approaching']
+        self.assertEqual(kinds, ['critical', 'cleared', 'critical'])
+        self.assertEqual(engine.state, 'critical')
+
+    def test_brief_dip_holds_critical(self):
+        heights = make_event_heights(flat_hours=2)
+        # Drop out of critical for an hour, then rise again.
+        heights = np.concatenate((heights, np.full(4, heights[-1] - 2.8),
+                heights[-1] + np.linspace(0, 3.0, 17)))
+        engine, alerts = self.run_engine(make_readings(heights))
+
+        kinds = [alert.kind for alert in alerts if alert.kind != 'approaching']
+        self.assertEqual(kinds, ['critical'])
+        self.assertEqual(engine.state, 'critical')
+
+    def test_verbose_prints_alerts(self):
+        readings = make_readings(make_event_heights(flat_hours=0))
+        for verbose in (True, False):
+            engine = alert_utils.AlertEngine(channels=[],
+                    state_file=self.get_path(f"{verbose}.json"),
+                    clock=lambda: readings[-1].dt_reading, verbose=verbose)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                alerts = engine.check(readings)
+            self.assertEqual([a.kind for a in alerts], ['critical'])
+            if verbose:
+                self.assertIn(alerts[0].get_formatted_alert(),
+                        output.getvalue())
+                self.assertIn('reading to alert', output.getvalue())
+            else:
+                self.assertEqual(output.getvalue(), '')
+
+    def test_state_survives_restart(self):
+        heights = make_event_heights(flat_hours=2)
+        readings = make_readings(heights)
+        engine, alerts = self.run_engine(readings)
+        self.assertEqual(engine.state, 'critical')
+
+        # A new engine picks up the held state from the state file.
+        engine = alert_utils.AlertEngine(channels=[],
+                state_file=self.get_path('state.json'), verbose=False)
+        self.assertEqual(engine.state, 'critical')
+        self.assertIsNotNone(engine.left_critical_ts)
+
+
+def fake_render(readings, filename, *args):
+    """Stand in for render_animation(), without matplotlib or ffmpeg."""
+    with open(filename, 'wb') as f:
+        f.write(f"{len(readings)} readings".encode())
+
+
+class AnimationQueueTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = self.get_path('readings')
+        timestamps, heights = make_archive_arrays(days=4)
+        reading_archive.save_arrays(timestamps, heights, self.archive_dir)
+        self.dt_last = datetime.datetime.fromtimestamp(timestamps[-1],
+                tz=pytz.utc)
+        self.dt_start = self.dt_last - datetime.timedelta(days=1)
+
+        self.animation_dir = self.get_path('animations')
+        self.queue = animation_utils.AnimationQueue(
+                animation_dir=self.animation_dir, archive_dir=self.archive_dir)
+        # Jobs are run by hand, in this process.
+        self.queue._executor = mock.Mock()
+
+    def run_queued_job(self, render=fake_render):
+        args = self.queue._executor.submit.call_args.args
+        with mock.patch.object(animation_utils, 'render_animation', render):
+            return args[0](*args[1:])
+
+    def get_status(self, job_id):
+        return self.queue.get_status(job_id)['status']
+
+    def test_identical_requests_share_a_job(self):
+        job_id = self.queue.submit(self.dt_start, self.dt_last)
+        self.assertEqual(self.get_status(job_id), 'running')
+        self.assertEqual(self.queue.submit(self.dt_start, self.dt_last),
+                job_id)
+        self.assertEqual(self.queue._executor.submit.call_count, 1)
+
+        filename = self.run_queued_job()
+        self.assertEqual(self.queue.get_status(job_id),
+                {'status': 'done', 'filename': filename})
+        # A cached animation isn't queued again.
+        self.assertEqual(self.queue.submit(self.dt_start, self.dt_last),
+                job_id)
+        self.assertEqual(self.queue._executor.submit.call_count, 1)
+
+    def test_end_is_clamped_to_the_archive(self):
+        job_id = self.queue.submit(self.dt_start,
+                self.dt_last + datetime.timedelta(hours=6))
+        self.assertEqual(job_id, animation_utils.get_job_id(self.dt_start,
+                self.dt_last, 15, 'mp4'))
+        with self.assertRaises(ValueError):
+            self.queue.submit(self.dt_last, self.dt_last
+                    + datetime.timedelta(hours=6))
+
+    def test_status_while_rendering(self):
+        job_id = self.queue.submit(self.dt_start, self.dt_last)
+        statuses = []
+
+        def check_status(*args):
+            statuses.append(animation_utils.load_job_record(job_id,
+                    self.animation_dir)['status'])
+            statuses.append(self.get_status(job_id))
+            fake_render(*args)
+
+        self.run_queued_job(check_status)
+        self.assertEqual(statuses, ['running', 'running'])
+        self.assertEqual(animation_utils.load_job_record(job_id,
+                self.animation_dir)['status'], 'done')
+
+    def test_failed_job(self):
+        job_id = self.queue.submit(self.dt_start, self.dt_last)
+        with self.assertRaises(ValueError):
+            self.run_queued_job(mock.Mock(
+                    side_effect=ValueError("ffmpeg failed")))
+        self.assertEqual(self.queue.get_status(job_id),
+                {'status': 'failed', 'error': "ffmpeg failed"})
+
+    def test_lost_job(self):
+        job_id = self.queue.submit(self.dt_start, self.dt_last)
+        record_file = animation_utils.get_job_record_file(job_id,
+                self.animation_dir)
+        queued = time.time() - animation_utils.MAX_QUEUED_MINUTES * 60 - 1
+        with open(record_file) as f:
+            record = json.load(f)
+        with open(record_file, 'w') as f:
+            json.dump(dict(record, updated=queued), f)
+        self.assertEqual(self.get_status(job_id), 'unknown')
+
+        # It's still running, if a worker holds its lease.
+        lease = single_flight.Lease(job_id,
+                animation_utils.get_job_dir(self.animation_dir))
+        self.assertTrue(lease.acquire())
+        self.addCleanup(lease.release)
+        self.assertEqual(self.get_status(job_id), 'running')
+
+    def test_least_recently_used_are_evicted(self):
+        os.makedirs(self.animation_dir)
+        now = time.time()
+        names = [f"{i:016x}.mp4" for i in range(4)]
+        for age, name in enumerate(names):
+            filename = os.path.join(self.animation_dir, name)
+            open(filename, 'w').close()
+            os.utime(filename, (now - age, now - age))
+        open(os.path.join(self.animation_dir, 'ab.tmp.mp4'), 'w').close()
+
+        # Use the oldest, so it's kept instead of the next oldest.
+        os.utime(os.path.join(self.animation_dir, names[3]))
+        animation_utils.evict_animations(2, self.animation_dir)
+        self.assertEqual(sorted(os.listdir(self.animation_dir)),
+                sorted([names[0], names[3], 'ab.tmp.mp4']))
+
+
+class AnimationViewTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.animation_dir = self.get_path('animations')
+        os.makedirs(self.animation_dir)
+        queue = animation_utils.AnimationQueue(
+                animation_dir=self.animation_dir)
+        patcher = mock.patch.object(views, 'animation_queue', queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_animation_is_private(self):
+        name = '3f2a9c01b7d4e5f6.mp4'
+        with open(os.path.join(self.animation_dir, name), 'wb') as f:
+            f.write(b'mp4 data')
+        url = f"/animations/{name}"
+        self.assert_login_required(url)
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), b'mp4 data')
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertTrue(response['Cache-Control'].startswith('private'))
+
+        status = self.client.get('/animations/3f2a9c01b7d4e5f6').json()
+        self.assertEqual(status['status'], 'done')
+        self.assertTrue(status['url'].endswith(url))
+
+    def test_other_files_arent_served(self):
+        self.client.force_login(self.user)
+        open(os.path.join(self.animation_dir, 'notes.txt'), 'w').close()
+        self.assertEqual(self.client.get('/animations/notes.txt').status_code,
+                404)
+
+
+class MockUsgsServer:
+    """A local stand-in for the USGS rdb service, serving the readings
+    between each request's begin_date and end_date. Fails the first
+    failures[begin_date] requests for a chunk.
+    """
+
+    def __init__(self, timestamps, heights, failures=None):
+        self.timestamps = timestamps
+        self.heights = np.round(heights, 2)
+        self.failures = dict(failures) if failures else {}
+        self.requests = []
+        self.local_dates = time_utils.to_local_strings(timestamps).astype('U10')
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                query = urllib.parse.parse_qs(
+                        urllib.parse.urlparse(self.path).query)
+                begin, end = query['begin_date'][0], query['end_date'][0]
+                server.requests.append(begin)
+                if server.failures.get(begin):
+                    server.failures[begin] -= 1
+                    self.send_error(503)
+                    return
+                in_chunk = ((server.local_dates >= begin)
+                        & (server.local_dates <= end))
+                body = make_usgs_rdb(server.timestamps[in_chunk],
+                        server.heights[in_chunk]).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}/nwis/uv"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class BackfillTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.timestamps, self.heights = make_archive_arrays(days=20)
+        self.archive_dir = self.get_path('readings')
+        self.checkpoint_file = self.get_path('checkpoint.json')
+        patcher = mock.patch.object(backfill_utils, 'BACKOFF_SECONDS', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_backfill(self, server, lease=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return backfill_utils.backfill(datetime.date(2019, 8, 20),
+                    datetime.date(2019, 9, 8), chunk_days=5, concurrency=3,
+                    base_url=server.base_url, archive_dir=self.archive_dir,
+                    checkpoint_file=self.checkpoint_file, lease=lease)
+
+    def test_retries_and_resumes(self):
+        # One chunk fails once, and is retried. Another fails every
+        #   attempt, so it's left for the next run.
+        server = MockUsgsServer(self.timestamps, self.heights,
+                failures={'2019-08-25': 1,
+                    '2019-08-30': backfill_utils.MAX_ATTEMPTS})
+        self.addCleanup(server.close)
+        self.run_backfill(server)
+        self.assertEqual(server.requests.count('2019-08-25'), 2)
+        self.assertEqual(server.requests.count('2019-08-30'),
+                backfill_utils.MAX_ATTEMPTS)
+        self.assertEqual(len(backfill_utils.load_checkpoint(
+                self.checkpoint_file)), 3)
+
+        # Resuming only fetches the chunk that failed.
+        server.requests.clear()
+        self.run_backfill(server)
+        self.assertEqual(server.requests, ['2019-08-30'])
+        self.assertEqual(len(backfill_utils.load_checkpoint(
+                self.checkpoint_file)), 4)
+
+        # The first few hours of the data are on the day before the
+        #   backfill starts, local time.
+        expected = server.local_dates >= '2019-08-20'
+        timestamps, heights = reading_archive.load_arrays(
+                archive_dir=self.archive_dir)
+        np.testing.assert_array_equal(timestamps, self.timestamps[expected])
+        np.testing.assert_array_equal(heights, server.heights[expected])
+
+    def test_stops_when_lease_is_lost(self):
+        server = MockUsgsServer(self.timestamps, self.heights)
+        self.addCleanup(server.close)
+        lease = single_flight.Lease('refresh', self.get_path('locks'))
+        self.assertTrue(lease.acquire())
+        self.addCleanup(lease.release)
+        lease.lost = True
+
+        with self.assertRaises(single_flight.LeaseLostError):
+            self.run_backfill(server, lease)
+        self.assertFalse(os.path.exists(self.archive_dir))
+        self.assertEqual(backfill_utils.load_checkpoint(self.checkpoint_file),
+                set())
+
+
+class StaticPlotTests(TempDirTestCase):
+
+    def render(self, filename):
+        from utils import plot_utils_mpl
+
+        readings = load_sample_readings()[:86]
+        plot_utils_mpl.plot_critical_forecast_mpl(readings,
+                a_utils.get_critical_points(readings), filename=filename)
+
+    def test_every_size_is_saved(self):
+        from PIL import Image
+        from utils import plot_utils_mpl
+
+        self.render(self.get_path('plot.png'))
+        for suffix, width in plot_utils_mpl.IMAGE_SIZES:
+            for image_format in ('png', 'webp'):
+                with Image.open(self.get_path(f"plot{suffix}.{image_format}")
+                        ) as image:
+                    self.assertEqual((image.format.lower(), image.width),
+                            (image_format, width))
+
+    def test_default_filename(self):
+        os.makedirs(self.get_path('media/plot_images'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.get_path())
+
+        self.render(None)
+        self.assertEqual(sorted(os.listdir(self.get_path())), ['media'])
+        self.assertIn('irg_critical_forecast_plot_current_320.webp',
+                os.listdir(self.get_path('media/plot_images')))
+
+    def test_threads_render_the_same_plot(self):
+        self.render(self.get_path('serial.png'))
+        threads = [threading.Thread(target=self.render,
+                    args=(self.get_path(f"thread_{i}.png"),))
+                for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with open(self.get_path('serial.png'), 'rb') as f:
+            serial = f.read()
+        for i in range(4):
+            with open(self.get_path(f"thread_{i}.png"), 'rb') as f:
+                self.assertEqual(f.read(), serial)
+
+
+class SeriesCacheTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = self.get_path('latest')
+
+    def publish_version(self, value):
+        """Publish a version where every height is value, so a reader can
+        tell if it mixed arrays from different versions.
+        """
+        timestamps = 1568000000 + 900 * np.arange(20 + int(value),
+                dtype=np.int64)
+        arrays = {name: series_cache._to_series(timestamps,
+                        np.full(len(timestamps), float(value)))
+                    for name in ('readings', 'critical_points',
+                        'min_critical_forecast')}
+        return series_cache.publish(arrays, {'value': value},
+                cache_dir=self.cache_dir)
+
+    def assert_consistent(self, latest):
+        value = latest.meta['value']
+        for name in latest.arrays:
+            self.assertEqual(len(latest[name]), 20 + value)
+            self.assertTrue((latest[name]['height'] == value).all(), name)
+
+    def test_readers_see_whole_versions(self):
+        self.assertIsNone(series_cache.get_latest(self.cache_dir))
+        self.assertEqual(self.publish_version(1), 1)
+        first = series_cache.get_latest(self.cache_dir)
+        self.assertIs(series_cache.get_latest(self.cache_dir), first)
+        self.assertIsInstance(first['readings'], np.memmap)
+
+        self.assertEqual(self.publish_version(2), 2)
+        second = series_cache.get_latest(self.cache_dir)
+        self.assertEqual((first.version, second.version), (1, 2))
+        self.assert_consistent(first)
+        self.assert_consistent(second)
+
+    def test_readers_during_publishing(self):
+        self.publish_version(0)
+        done = threading.Event()
+        seen = set()
+        errors = []
+
+        def read():
+            while not done.is_set():
+                try:
+                    latest = series_cache.get_latest(self.cache_dir)
+                    self.assert_consistent(latest)
+                    seen.add(latest.version)
+                except Exception as e:
+                    errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        for value in range(1, 30):
+            self.publish_version(value)
+        done.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertGreater(len(seen), 1)
+
+    def test_old_versions_are_pruned(self):
+        for value in range(6):
+            version = self.publish_version(value)
+        self.assertEqual(series_cache.get_current_version(self.cache_dir),
+                version)
+        version_dirs = sorted(name for name in os.listdir(self.cache_dir)
+                if name.startswith('v'))
+        self.assertEqual(version_dirs,
+                [series_cache._get_version_dir(v, '') for v in
+                    range(version - series_cache.KEEP_VERSIONS + 1,
+                        version + 1)])
+        self.assertEqual(series_cache.get_latest(self.cache_dir).meta['value'],
+                5)
+
+    def test_leftover_version_is_replaced(self):
+        self.publish_version(1)
+        # A publish died after renaming its version into place, but before
+        #   swapping the pointer.
+        leftover = os.path.join(self.cache_dir,
+                series_cache._get_version_dir(2, ''))
+        os.makedirs(leftover)
+        with open(os.path.join(leftover, series_cache.META_FILE), 'w') as f:
+            json.dump({'value': 'partial'}, f)
+
+        self.assertEqual(self.publish_version(2), 2)
+        self.assertEqual(series_cache.get_latest(self.cache_dir).meta['value'],
+                2)
+
+    def test_precompressed_json(self):
+        import brotli, gzip
+
+        self.publish_version(300)
+        latest = series_cache.get_latest(self.cache_dir)
+        with open(latest.json_file, 'rb') as f:
+            data = f.read()
+        with open(f"{latest.json_file}.gz", 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), data)
+        with open(f"{latest.json_file}.br", 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()), data)
+        self.assertEqual(json.loads(data), latest.get_json_data())
+
+        since_ts = int(latest['readings']['ts'][-3])
+        self.assertEqual(len(latest.get_json_data(since_ts)['readings']['y']),
+                2)
+
+
+class ArtifactStoreTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project_dir = self.get_path('project')
+        patcher = mock.patch.object(artifact_store, 'PROJECT_DIR',
+                self.project_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stage(self, name, data):
+        with open(artifact_store.get_staging_file(name), 'wb') as f:
+            f.write(data)
+
+    def get_published_file(self, name, manifest):
+        return os.path.join(artifact_store.get_publish_dir(name),
+                manifest['artifacts'][name])
+
+    def test_publish_from_any_working_dir(self):
+        os.makedirs(self.get_path('elsewhere'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.get_path('elsewhere'))
+
+        self.stage('plot.png', b'png data')
+        self.stage('plot.html', b'<html>' + b'plot ' * 200 + b'</html>')
+        manifest = artifact_store.publish_artifacts()
+        self.assertEqual(os.listdir(self.get_path('elsewhere')), [])
+        self.assertEqual(artifact_store.load_manifest(), manifest)
+
+        png_name = manifest['artifacts']['plot.png']
+        self.assertTrue(artifact_store.is_versioned_name(png_name))
+        self.assertEqual(artifact_store.get_versioned_name('plot.png'),
+                png_name)
+        with open(os.path.join(self.project_dir, artifact_store.IMAGE_DIR,
+                png_name), 'rb') as f:
+            self.assertEqual(f.read(), b'png data')
+        html_file = os.path.join(self.project_dir,
+                artifact_store.FRAGMENT_DIR, manifest['artifacts']['plot.html'])
+        for ext in ('', '.gz', '.br'):
+            self.assertTrue(os.path.exists(f"{html_file}{ext}"), ext)
+
+    def test_changed_files_get_new_names(self):
+        self.stage('plot.png', b'first')
+        self.stage('other.png', b'unchanged')
+        first = artifact_store.publish_artifacts()
+        self.stage('plot.png', b'second')
+        second = artifact_store.publish_artifacts()
+
+        self.assertEqual(second['artifacts']['other.png'],
+                first['artifacts']['other.png'])
+        self.assertNotEqual(second['artifacts']['plot.png'],
+                first['artifacts']['plot.png'])
+        # The old version stays for pages that were just rendered.
+        old_file = self.get_published_file('plot.png', first)
+        self.assertIn(first['artifacts']['plot.png'], second['superseded'])
+        self.assertTrue(os.path.exists(old_file))
+
+        with mock.patch.object(artifact_store, 'KEEP_HOURS', -1):
+            third = artifact_store.publish_artifacts()
+        self.assertFalse(os.path.exists(old_file))
+        self.assertEqual(third['superseded'], {})
+        self.assertTrue(os.path.exists(
+                self.get_published_file('plot.png', third)))
+
+
+class PlotViewTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(artifact_store, 'PROJECT_DIR',
+                self.get_path('project'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        html = b'<html>' + b'plot ' * 200 + b'</html>'
+        for name, data in (('plot.png', b'png data'), ('plot.html', html)):
+            with open(artifact_store.get_staging_file(name), 'wb') as f:
+                f.write(data)
+        self.manifest = artifact_store.publish_artifacts()
+        self.html = html
+
+    def get_url(self, view_name, name):
+        return reverse(f"irg_viz:{view_name}",
+                args=[self.manifest['artifacts'][name]])
+
+    def test_images_are_private(self):
+        url = self.get_url('plot_image', 'plot.png')
+        self.assert_login_required(url)
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), b'png data')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Cache-Control'],
+                artifact_store.PRIVATE_CACHE_CONTROL)
+
+        self.assertEqual(self.client.get(reverse('irg_viz:plot_image',
+                args=['plot.png'])).status_code, 404)
+
+    def test_fragments_are_private(self):
+        url = self.get_url('plot_fragment', 'plot.html')
+        self.assert_login_required(url)
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), self.html)
+        self.assertEqual(response['Cache-Control'],
+                artifact_store.PRIVATE_CACHE_CONTROL)
+
+
+class AcceptEncodingTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = self.get_path('plot.html')
+        for ext in ('', '.gz', '.br'):
+            open(f"{self.path}{ext}", 'w').close()
+
+    def get_encoding(self, accept_encoding):
+        encoded_path, encoding = artifact_store.get_encoded_file(self.path,
+                accept_encoding)
+        ext = dict(artifact_store.ENCODINGS).get(encoding, '')
+        self.assertEqual(encoded_path, f"{self.path}{ext}")
+        return encoding
+
+    def test_qualities(self):
+        cases = [
+            ('', None),
+            ('gzip, deflate, br', 'br'),
+            ('br;q=0', None),
+            ('gzip, br;q=0', 'gzip'),
+            ('gzip;q=0.5, br;q=0.4', 'gzip'),
+            ('gzip; q=0.4, br; q=0.5', 'br'),
+            ('*', 'br'),
+            ('*, br;q=0', 'gzip'),
+            ('*;q=0', None),
+            ('identity', None),
+            ('identity, gzip;q=0.5', None),
+            ('identity;q=0.5, gzip', 'gzip'),
+            ('GZIP;Q=1', 'gzip'),
+            ('gzip;q=oops, br;q=0', None),
+        ]
+        for accept_encoding, encoding in cases:
+            self.assertEqual(self.get_encoding(accept_encoding), encoding,
+                    accept_encoding)
+
+    def test_missing_variant(self):
+        os.remove(f"{self.path}.br")
+        self.assertEqual(self.get_encoding('br, gzip;q=0.1'), 'gzip')
+        self.assertEqual(self.get_encoding('br'), None)
+
+
+class EncodedResponseTests(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(artifact_store, 'PROJECT_DIR',
+                self.get_path('project'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def get(self, url, accept_encoding):
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING=accept_encoding)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        return response, b''.join(response.streaming_content)
+
+    def test_fragment(self):
+        import brotli, gzip
+
+        html = b'<html>' + b'plot ' * 200 + b'</html>'
+        with open(artifact_store.get_staging_file('plot.html'), 'wb') as f:
+            f.write(html)
+        manifest = artifact_store.publish_artifacts()
+        url = reverse('irg_viz:plot_fragment',
+                args=[manifest['artifacts']['plot.html']])
+
+        response, data = self.get(url, 'gzip;q=0.5, br;q=0.4')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(data), html)
+        self.assertEqual(int(response['Content-Length']), len(data))
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+
+        response, data = self.get(url, 'gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(data), html)
+
+        response, data = self.get(url, 'identity')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(data, html)
+
+    def test_latest_json(self):
+        import brotli
+
+        cache_dir = self.get_path('latest')
+        readings = make_readings(make_event_heights())
+        series_cache.publish_series(readings, cache_dir=cache_dir)
+        latest = series_cache.get_latest(cache_dir)
+        with mock.patch.object(series_cache, 'get_latest', lambda: latest):
+            response, data = self.get(reverse('irg_viz:latest_data'), 'br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(brotli.decompress(data)),
+                latest.get_json_data())
+
+
+class PayloadArchiveTests(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = self.get_path('readings')
+        self.payload_dir = self.get_path('payloads')
+        self.timestamps, self.heights = make_archive_arrays(days=6)
+        self.heights = np.round(self.heights, 2)
+
+    def fetch(self, first_day, hours):
+        """Return a response covering 3 days, fetched hours into the
+        window's last day.
+        """
+        start = first_day * 96
+        end = start + 2 * 96 + hours * 4
+        dt_retrieved = datetime.datetime(2019, 8, 20 + first_day, hours, 3, 17)
+        return make_usgs_rdb(self.timestamps[start:end],
+                self.heights[start:end], dt_retrieved)
+
+    def ingest(self, payload):
+        timestamps, heights, report = payload_archive.ingest_payload(payload,
+                archive_dir=self.archive_dir, payload_dir=self.payload_dir)
+        self.assertEqual(report.num_removed, 0)
+        reading_archive.save_arrays(timestamps, heights, self.archive_dir)
+        return timestamps, heights
+
+    def count_block_files(self):
+        return sum(len(files) for _, _, files in os.walk(
+                os.path.join(self.payload_dir, 'blocks')))
+
+    def test_overlapping_fetches_share_blocks(self):
+        payloads = [self.fetch(1, 6), self.fetch(1, 12), self.fetch(2, 1)]
+        for payload in payloads:
+            self.ingest(payload)
+
+        stored_texts = set(text for payload in payloads
+                for key, text in payload_archive.split_blocks(payload)
+                if key != 'volatile')
+        self.assertEqual(self.count_block_files(), len(stored_texts))
+
+        # Each fetch only stores the days that changed. The header, with
+        #   its new retrieval time, is already stored.
+        fetches = payload_archive.get_fetches(self.payload_dir)
+        self.assertEqual(len(set(f['payload'] for f in fetches)), 3)
+        seen = set()
+        for fetch, payload in zip(fetches, payloads):
+            blocks = payload_archive.split_blocks(payload)
+            texts = set(text for key, text in blocks if key != 'volatile')
+            self.assertEqual(fetch['new_blocks'], len(texts - seen))
+            if seen:
+                self.assertLess(fetch['new_blocks'], fetch['num_blocks'] - 2)
+                self.assertTrue(all(text in seen for key, text in blocks
+                        if key == 'header'))
+            seen |= texts
+
+            self.assertEqual(payload_archive.load_payload(fetch['payload'],
+                    self.payload_dir), payload)
+
+    def test_only_new_readings_are_parsed(self):
+        timestamps, _ = self.ingest(self.fetch(1, 6))
+        self.assertEqual(len(timestamps), 2 * 96 + 6 * 4)
+        last_ts = timestamps[-1]
+
+        timestamps, heights = self.ingest(self.fetch(1, 12))
+        expected = (self.timestamps > last_ts) & (self.timestamps
+                < self.timestamps[96 + 2 * 96 + 12 * 4])
+        np.testing.assert_array_equal(timestamps, self.timestamps[expected])
+        np.testing.assert_array_equal(heights, self.heights[expected])
+
+        with mock.patch.object(a_utils, 'parse_usgs_rows',
+                wraps=a_utils.parse_usgs_rows) as parse_rows:
+            self.ingest(self.fetch(2, 1))
+        # Earlier days in the response aren't parsed.
+        self.assertLess(len(parse_rows.call_args.args[0]), 2 * 96)
@@ -28,6 +28,37 @@ urlpatterns = [
             views.irg_critical_forecast_plot_extended,
             name='irg_critical_forecast_plot_extended'),
 
+    # Interactive plot of all archived readings.
+    path('long_range_plot', views.long_range_plot, name='long_range_plot'),
+
+    # Downsampled readings for the long-range plot, for each zoomed range.
+    path('long_range_plot/readings', views.long_range_readings,
+            name='long_range_readings'),
+
+    # Latest analyzed series, as json.
+    path('latest.json', views.latest_data, name='latest_data'),
+
+    # Published plot images, cached forever.
+    path('plot_images/<str:name>', views.plot_image, name='plot_image'),
+
+    # Published interactive plots, shown in a frame on each plot page.
+    path('plot_fragments/<str:name>', views.plot_fragment,
+            name='plot_fragment'),
+
+    # Readings or events as a Parquet or Arrow file.
+    path('history/<slug:table_name>.<slug:export_format>',
+            views.history_export, name='history_export'),
+
+    # Queue an animation of a time range.
+    path('animations/new', views.request_animation, name='request_animation'),
+
+    # Status of an animation job.
+    path('animations/<slug:job_id>', views.animation_status,
+            name='animation_status'),
+
+    # A finished animation; names have a '.', so they aren't job ids.
+    path('animations/<str:name>', views.animation_file,
+            name='animation_file'),
 
 ]
 
@@ -1,7 +1,27 @@
+import datetime, mimetypes, os
+
+import pytz
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import render
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.clickjacking import xframe_options_sameorigin
+from django.views.decorators.http import require_POST
+
+from utils import animation_utils, artifact_store, downsample_utils
+from utils import series_cache
+
+aktz = pytz.timezone('US/Alaska')
 
-from utils import plot_utils
+# Suffixes of each size of a static plot. These match IMAGE_SIZES in
+#   utils/plot_utils_mpl.py, which is too slow to import here.
+IMAGE_SUFFIXES = ['', '_640', '_320']
+
+# Animation jobs run in a pool of worker processes, shared by every request
+#   this process serves.
+animation_queue = animation_utils.AnimationQueue()
+MAX_ANIMATION_DAYS = 14
 
 def index(request):
     """Home page for the whole project."""
@@ -10,19 +30,260 @@ def index(request):
 @login_required
 def simple_irg_plot(request):
     """Simple plot of the river gauge."""
-    return render(request, 'irg_viz/simple_irg_plot.html')
+    context = {'plot_fragment': get_plot_fragment_url(
+            'simple_irg_plot_current.html')}
+    return render(request, 'irg_viz/simple_irg_plot.html', context)
 
 @login_required
 def irg_critical_forecast_plot_interactive(request):
     """Interactive critical forecast plot."""
-    return render(request, 'irg_viz/irg_critical_forecast_plot_interactive.html')
+    context = {'plot_fragment': get_plot_fragment_url(
+            'irg_critical_forecast_current.html')}
+    return render(request, 'irg_viz/irg_critical_forecast_plot_interactive.html',
+            context)
 
 @login_required
 def irg_critical_forecast_plot(request):
     """Static critical forecast plot."""
-    return render(request, 'irg_viz/irg_critical_forecast_plot.html')
+    context = {'plot_image': get_plot_image_urls(
+            'irg_critical_forecast_plot_current')}
+    return render(request, 'irg_viz/irg_critical_forecast_plot.html', context)
 
 @login_required
 def irg_critical_forecast_plot_extended(request):
     """Static critical forecast plot, extended back x hours."""
-    return render(request, 'irg_viz/irg_critical_forecast_plot_extended.html')
\ No newline at end of file
+    context = {'plot_image': get_plot_image_urls(
+            'irg_critical_forecast_plot_current_extended')}
+    return render(request, 'irg_viz/irg_critical_forecast_plot_extended.html',
+            context)
+
+@login_required
+def long_range_plot(request):
+    """Interactive plot of all archived readings."""
+    context = {'plot_fragment': get_plot_fragment_url(
+            'long_range_plot_current.html')}
+    return render(request, 'irg_viz/long_range_plot.html', context)
+
+@login_required
+def plot_image(request, name):
+    """A published plot image. Published names include a hash of the
+    image, so they can be cached forever, but only by the viewer's browser.
+    """
+    if not artifact_store.is_versioned_name(name):
+        raise Http404
+    return serve_artifact(request,
+            os.path.join(artifact_store.get_path(artifact_store.IMAGE_DIR),
+                name),
+            artifact_store.PRIVATE_CACHE_CONTROL)
+
+@login_required
+@xframe_options_sameorigin
+def plot_fragment(request, name):
+    """A published interactive plot, as a standalone html page. Pages show
+    it in a frame, so it's cached apart from the page around it.
+    """
+    if artifact_store.is_versioned_name(name):
+        cache_control = artifact_store.PRIVATE_CACHE_CONTROL
+    else:
+        # Nothing published yet; serve the plain file, and don't cache it.
+        cache_control = 'no-cache'
+    if not name.endswith('.html') or os.path.basename(name) != name:
+        raise Http404
+    return serve_artifact(request,
+            os.path.join(artifact_store.get_path(artifact_store.FRAGMENT_DIR),
+                name), cache_control)
+
+def serve_artifact(request, path, cache_control):
+    """Serve a file, precompressed if the client accepts any of the
+    file's compressed variants.
+    """
+    if not os.path.exists(path):
+        raise Http404
+    encoded_path, encoding = artifact_store.get_encoded_file(path,
+            request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    content_type, _ = mimetypes.guess_type(path)
+    response = FileResponse(open(encoded_path, 'rb'))
+    # FileResponse guesses headers from the name of the compressed file,
+    #   so set them from the original file.
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    response['Content-Length'] = os.path.getsize(encoded_path)
+    del response['Content-Disposition']
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = cache_control
+    return response
+
+def get_plot_fragment_url(name):
+    """Url for the current version of an interactive plot."""
+    return reverse('irg_viz:plot_fragment',
+            args=[artifact_store.get_versioned_name(name)])
+
+def get_plot_image_urls(image_name):
+    """Urls for every size and format of a static plot, by format and size,
+    ie png, webp, png_640, webp_640...
+    """
+    urls = {}
+    for suffix in IMAGE_SUFFIXES:
+        for image_format in ('png', 'webp'):
+            name = artifact_store.get_versioned_name(
+                    f"{image_name}{suffix}.{image_format}")
+            if artifact_store.is_versioned_name(name):
+                url = reverse('irg_viz:plot_image', args=[name])
+            else:
+                # Nothing published yet; fall back to the plain media file.
+                url = f"/{settings.MEDIA_URL.strip('/')}/plot_images/{name}"
+            urls[f"{image_format}{suffix}"] = url
+    return urls
+
+@login_required
+def long_range_readings(request):
+    """Downsampled archive readings for a time range, as json.
+    Takes start and end (local time, iso format, either can be left out),
+    points (at most downsample_utils.MAX_POINTS), and method (lttb or
+    minmax) as query parameters.
+    """
+    try:
+        dt_start, dt_end = [aktz.localize(
+                    datetime.datetime.fromisoformat(request.GET[name]))
+                if request.GET.get(name) else None
+                for name in ('start', 'end')]
+        max_points = int(request.GET.get('points',
+                downsample_utils.MAX_POINTS))
+    except ValueError:
+        return JsonResponse({'error': "Need a valid start, end, and points."},
+                status=400)
+
+    method = request.GET.get('method', 'lttb')
+    if method not in downsample_utils.DOWNSAMPLE_METHODS:
+        return JsonResponse({'error': "Method must be lttb or minmax."},
+                status=400)
+    max_points = max(3, min(max_points, downsample_utils.MAX_POINTS))
+
+    return JsonResponse(downsample_utils.get_long_range_data(dt_start,
+            dt_end, max_points, method))
+
+@login_required
+def latest_data(request):
+    """The latest analyzed series, as json: readings, critical points, and
+    the minimum critical forecast, as local time strings and heights.
+    Takes since (epoch seconds) as an optional query parameter, to only
+    get points after a time.
+    """
+    latest = series_cache.get_latest()
+    if latest is None:
+        return JsonResponse({'error': "No data has been published yet."},
+                status=503)
+
+    etag = f'"{latest.version}"'
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    elif request.GET.get('since'):
+        try:
+            since_ts = int(request.GET['since'])
+        except ValueError:
+            return JsonResponse({'error': "Since must be epoch seconds."},
+                    status=400)
+        response = JsonResponse(latest.get_json_data(since_ts))
+    else:
+        # The full json is written once per version, already compressed.
+        response = serve_artifact(request, latest.json_file, 'no-cache')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+@login_required
+def history_export(request, table_name, export_format):
+    """Download the readings or event catalog as a Parquet or Arrow file.
+    Takes start and end (local time, iso format, either can be left out)
+    as query parameters. Only the archive months in the range are read.
+    """
+    # pyarrow is slow to import, so only this view pays for it.
+    from utils import export_utils
+
+    if (table_name not in export_utils.TABLES
+            or export_format not in export_utils.FORMATS):
+        raise Http404
+    try:
+        dt_start, dt_end = [aktz.localize(
+                    datetime.datetime.fromisoformat(request.GET[name]))
+                if request.GET.get(name) else None
+                for name in ('start', 'end')]
+    except ValueError:
+        return JsonResponse({'error': "Need a valid start and end."},
+                status=400)
+
+    data = export_utils.export_to_bytes(table_name, export_format, dt_start,
+            dt_end)
+    response = HttpResponse(data, content_type='application/octet-stream')
+    response['Content-Disposition'] = (
+            f'attachment; filename="irg_{table_name}.{export_format}"')
+    return response
+
+@login_required
+@require_POST
+def request_animation(request):
+    """Queue an animation of a time range, and return the job's status.
+    Takes start and end (local time, iso format), cadence (minutes between
+    frames), and format (mp4 or gif) as form fields. An end past the last
+    reading is moved back to it.
+    """
+    try:
+        dt_start = aktz.localize(
+                datetime.datetime.fromisoformat(request.POST['start']))
+        dt_end = aktz.localize(
+                datetime.datetime.fromisoformat(request.POST['end']))
+        cadence_minutes = int(request.POST.get('cadence', 15))
+    except (KeyError, ValueError):
+        return JsonResponse({'error': "Need a valid start, end, and cadence."},
+                status=400)
+
+    animation_format = request.POST.get('format', 'mp4')
+    if animation_format not in animation_utils.ANIMATION_FORMATS:
+        return JsonResponse({'error': "Format must be mp4 or gif."},
+                status=400)
+    if cadence_minutes < 15:
+        return JsonResponse({'error': "Cadence must be at least 15 minutes."},
+                status=400)
+    if not dt_start < dt_end <= dt_start + datetime.timedelta(days=MAX_ANIMATION_DAYS):
+        return JsonResponse({'error': f"End must be after start, and within {MAX_ANIMATION_DAYS} days."},
+                status=400)
+
+    try:
+        job_id = animation_queue.submit(dt_start, dt_end, cadence_minutes,
+                animation_format)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(get_animation_status(request, job_id, animation_format))
+
+@login_required
+def animation_status(request, job_id):
+    """Status of an animation job, with its url once it's done."""
+    animation_format = request.GET.get('format', 'mp4')
+    if animation_format not in animation_utils.ANIMATION_FORMATS:
+        return JsonResponse({'error': "Format must be mp4 or gif."},
+                status=400)
+    return JsonResponse(get_animation_status(request, job_id, animation_format))
+
+@login_required
+def animation_file(request, name):
+    """A finished animation. An animation's name is a hash of its
+    parameters, and it's never rendered again, so it's cached like the
+    plot images.
+    """
+    if not animation_utils.is_animation_name(name):
+        raise Http404
+    return serve_artifact(request,
+            os.path.join(animation_queue.animation_dir, name),
+            artifact_store.PRIVATE_CACHE_CONTROL)
+
+def get_animation_status(request, job_id, animation_format):
+    """Build the json status for an animation job."""
+    job_status = animation_queue.get_status(job_id, animation_format)
+    status = {'job_id': job_id, 'status': job_status['status']}
+    if job_status['status'] == 'done':
+        status['url'] = request.build_absolute_uri(reverse(
+                'irg_viz:animation_file', args=[f"{job_id}.{animation_format}"]))
+    elif job_status['status'] == 'failed':
+        status['error'] = job_status['error']
+    return status
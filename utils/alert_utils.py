@@ -0,0 +1,406 @@
+"""Alerts on changes in critical conditions.
+
+This is the last stage of the ingest path. After new readings are
+processed, the alert engine works out the current state of the river:
+critical, approaching critical, or normal. On a change of state it sends
+an alert through every configured channel.
+
+State is kept in a small json file, so rerunning a refresh on the same
+readings never sends the same alert twice.
+
+A river that flickers in and out of critical doesn't send a stream of
+alerts. Once critical, the river stays critical until its readings have
+been out of critical for the cool-down; a crest, or a brief dip, doesn't
+clear it. So critical and cleared alerts always go out, and the
+subscribers' last message always matches the state. Approaching alerts
+aren't sent again within the cool-down.
+"""
+
+import datetime, json, os, smtplib
+from email.message import EmailMessage
+
+import numpy as np
+import pytz
+
+import utils.analysis_utils as a_utils
+
+
+aktz = pytz.timezone('US/Alaska')
+
+STATE_FILE = 'historical_data/alert_state.json'
+CONFIG_FILE = 'alert_config.json'
+ALERT_LOG_FILE = 'historical_data/alerts.log'
+
+# Readings have to be out of critical this many hours to clear it, and an
+#   approaching alert isn't sent again within this many hours.
+COOLDOWN_HOURS = 6
+# Alert when the current rate of rise would reach critical within this
+#   many hours. The minimum critical forecast only covers 4.5 hours.
+FORECAST_HOURS = 3
+
+STATES = ('normal', 'approaching', 'critical')
+
+
+class Alert:
+    """A change in critical conditions, and how long it took to report."""
+
+    def __init__(self, state, prev_state, reading, dt_ingest=None,
+            dt_critical=None, rules=None):
+        self.state = state
+        self.prev_state = prev_state
+        # The reading that caused the change of state.
+        self.reading = reading
+        # When processing of the readings began.
+        self.dt_ingest = dt_ingest
+        # For an approaching alert, when critical would be reached.
+        self.dt_critical = dt_critical
+        # For a critical alert, the critical rules the reading met.
+        self.rules = rules if rules else []
+        self.dt_sent = None
+
+    @property
+    def kind(self):
+        return get_alert_kind(self.state, self.prev_state)
+
+    @property
+    def reading_latency(self):
+        """Time from the reading to sending the alert."""
+        return self.dt_sent - self.reading.dt_reading
+
+    @property
+    def processing_latency(self):
+        """Time from starting to process the readings to sending the alert."""
+        if not self.dt_ingest:
+            return None
+        return self.dt_sent - self.dt_ingest
+
+    def get_subject(self):
+        subjects = {
+            'critical': "Indian River is critical",
+            'approaching': "Indian River is approaching critical",
+            'cleared': "Indian River is no longer critical",
+        }
+        return subjects[self.kind]
+
+    def get_formatted_alert(self):
+        """Print a neat message for the alert."""
+        dt = self.reading.dt_reading.astimezone(aktz).strftime('%m/%d/%Y %H:%M')
+        message = f"{self.get_subject()}: {self.reading.height:.2f} ft at {dt}."
+        if self.dt_critical:
+            dt_critical = self.dt_critical.astimezone(aktz).strftime('%H:%M')
+            message += f" At the current rate of rise, critical by {dt_critical}."
+        if self.rules:
+            descriptions = [rule.get_description() for rule in self.rules]
+            message += f" Met: {'; '.join(descriptions)}."
+        return message
+
+    def to_dict(self):
+        alert_dict = {
+            'kind': self.kind,
+            'state': self.state,
+            'prev_state': self.prev_state,
+            'dt_reading': self.reading.dt_reading.isoformat(),
+            'height': self.reading.height,
+            'rules': [rule.name for rule in self.rules],
+            'dt_sent': self.dt_sent.isoformat() if self.dt_sent else None,
+            'message': self.get_formatted_alert(),
+        }
+        if self.dt_sent:
+            alert_dict['reading_latency'] = self.reading_latency.total_seconds()
+            if self.dt_ingest:
+                alert_dict['processing_latency'] = (
+                        self.processing_latency.total_seconds())
+        return alert_dict
+
+
+class AlertChannel:
+    """Somewhere to send alerts. Subclasses implement send()."""
+
+    name = 'channel'
+
+    def send(self, alert):
+        raise NotImplementedError
+
+
+class FileChannel(AlertChannel):
+    """Append each alert to a file, as a line of json."""
+
+    name = 'file'
+
+    def __init__(self, filename=ALERT_LOG_FILE):
+        self.filename = filename
+
+    def send(self, alert):
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(alert.to_dict()) + '\n')
+
+
+class SmtpChannel(AlertChannel):
+    """Email each alert. The defaults point at a local test server, such as
+    `python -m aiosmtpd -n -l localhost:1025`.
+    """
+
+    name = 'smtp'
+
+    def __init__(self, recipients, sender='irg-alerts@localhost',
+            host='localhost', port=1025, timeout=10):
+        self.recipients = recipients
+        self.sender = sender
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def send(self, alert):
+        msg = EmailMessage()
+        msg['Subject'] = alert.get_subject()
+        msg['From'] = self.sender
+        msg['To'] = ', '.join(self.recipients)
+        msg.set_content(alert.get_formatted_alert())
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(msg)
+
+
+class WebhookChannel(AlertChannel):
+    """Post each alert to a url, as json."""
+
+    name = 'webhook'
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alert):
+        import requests
+
+        r = requests.post(self.url, json=alert.to_dict(), timeout=self.timeout)
+        r.raise_for_status()
+
+
+CHANNEL_TYPES = {
+    'file': FileChannel,
+    'smtp': SmtpChannel,
+    'webhook': WebhookChannel,
+}
+
+
+def load_channels(config_file=CONFIG_FILE):
+    """Build the alert channels listed in a json config file.
+
+    The file holds a list of channels, each with a type and the arguments
+      for that channel, such as:
+        [{"type": "webhook", "url": "http://localhost:8080/alerts"}]
+    Without a config file, alerts are only written to ALERT_LOG_FILE.
+    """
+    if not os.path.exists(config_file):
+        return [FileChannel()]
+    with open(config_file) as f:
+        channel_configs = json.load(f)
+
+    channels = []
+    for channel_config in channel_configs:
+        channel_config = dict(channel_config)
+        channel_type = CHANNEL_TYPES[channel_config.pop('type')]
+        channels.append(channel_type(**channel_config))
+    return channels
+
+
+class AlertEngine:
+    """Watches for changes in critical conditions, and sends alerts."""
+
+    def __init__(self, channels=None, state_file=STATE_FILE,
+            cooldown_hours=COOLDOWN_HOURS, forecast_hours=FORECAST_HOURS,
+            clock=None, verbose=True):
+        """clock returns the current utc datetime; a replay passes in its
+        virtual clock. verbose prints each alert, and each skipped alert.
+        """
+        self.channels = channels if channels is not None else load_channels()
+        self.clock = clock if clock else lambda: datetime.datetime.now(pytz.utc)
+        self.state_file = state_file
+        self.cooldown = datetime.timedelta(hours=cooldown_hours)
+        self.forecast_hours = forecast_hours
+        self.verbose = verbose
+
+        self._load_state()
+
+    def check(self, readings, dt_ingest=None, results=None):
+        """Check the latest readings, and send an alert if the state of the
+        river has changed. results is from
+        analysis_utils.evaluate_readings(readings), if it's already been run.
+        Returns a list of the alerts that were sent.
+        """
+        if not readings:
+            return []
+        latest_reading = readings[-1]
+        if self.last_ts and latest_reading.dt_reading.timestamp() <= self.last_ts:
+            # Nothing new since the last check.
+            return []
+
+        results = results if results else a_utils.evaluate_readings(readings)
+        rules = get_rules_met(readings, results)
+        state, dt_critical = get_state(readings, self.forecast_hours, rules)
+        ts = latest_reading.dt_reading.timestamp()
+        if self.state == 'critical' and state != 'critical':
+            # Hold critical until the readings have stayed out of it for
+            #   the cool-down.
+            if self.left_critical_ts is None:
+                self.left_critical_ts = ts
+            if ts - self.left_critical_ts < self.cooldown.total_seconds():
+                state, dt_critical = 'critical', None
+        else:
+            self.left_critical_ts = None
+        prev_state = self.state
+        self.state = state
+        self.last_ts = ts
+
+        sent_alerts = []
+        if get_alert_kind(state, prev_state):
+            alert = Alert(state, prev_state, latest_reading, dt_ingest,
+                    dt_critical, rules if state == 'critical' else [])
+            if self._in_cooldown(alert):
+                if self.verbose:
+                    print(f"Skipping alert, in cool-down: {alert.get_formatted_alert()}")
+            else:
+                self.send(alert)
+                sent_alerts.append(alert)
+
+        self._save_state()
+        return sent_alerts
+
+    def send(self, alert):
+        """Send an alert through every channel. A failing channel doesn't
+        stop the others.
+        """
+        alert.dt_sent = self.clock()
+        for channel in self.channels:
+            try:
+                channel.send(alert)
+            except Exception as e:
+                print(f"  alert not sent through {channel.name}: {e}")
+        self.last_sent[alert.kind] = alert.dt_sent.timestamp()
+
+        if not self.verbose:
+            return
+        print(alert.get_formatted_alert())
+        print(f"  reading to alert: {alert.reading_latency.total_seconds():.1f} s")
+        if alert.dt_ingest:
+            print(f"  processing to alert: {alert.processing_latency.total_seconds():.3f} s")
+
+    def _in_cooldown(self, alert):
+        # Clearing already waits out the cool-down, so critical and cleared
+        #   alerts can't flicker, and skipping one would leave subscribers
+        #   with the wrong state.
+        if alert.kind != 'approaching':
+            return False
+        last_sent = self.last_sent.get(alert.kind)
+        if last_sent is None:
+            return False
+        dt_last_sent = datetime.datetime.fromtimestamp(last_sent, tz=pytz.utc)
+        return self.clock() - dt_last_sent < self.cooldown
+
+    def _load_state(self):
+        self.state, self.last_ts, self.last_sent = 'normal', None, {}
+        # When the readings last left critical, while still holding it.
+        self.left_critical_ts = None
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                state_dict = json.load(f)
+            self.state = state_dict['state']
+            self.last_ts = state_dict['last_ts']
+            self.last_sent = state_dict['last_sent']
+            self.left_critical_ts = state_dict.get('left_critical_ts')
+
+    def _save_state(self):
+        """Write the state, replacing the old file atomically."""
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        state_dict = {
+            'state': self.state,
+            'last_ts': self.last_ts,
+            'last_sent': self.last_sent,
+            'left_critical_ts': self.left_critical_ts,
+        }
+        tmp_filename = f"{self.state_file}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(state_dict, f, indent=2)
+        os.replace(tmp_filename, self.state_file)
+
+
+def get_alert_kind(state, prev_state):
+    """Return the kind of alert for a change of state, or None if the
+    change doesn't need an alert.
+
+    Leaving critical always clears the alert. Dropping back from
+      approaching to normal doesn't need one.
+    """
+    if state == prev_state:
+        return None
+    if state == 'critical':
+        return 'critical'
+    if prev_state == 'critical':
+        return 'cleared'
+    if state == 'approaching':
+        return 'approaching'
+    return None
+
+
+def get_state(readings, forecast_hours=FORECAST_HOURS, rules_met=None):
+    """Return the state of the river at the latest reading, and for the
+    approaching state, when it would become critical.
+
+    The river is critical if the latest reading is a critical point. It's
+      approaching critical if rising at the rate of the last hour would
+      reach the minimum critical forecast within forecast_hours.
+    rules_met is from get_rules_met(readings), if it's already been run.
+    """
+    rules_met = rules_met if rules_met is not None else get_rules_met(readings)
+    if rules_met:
+        return 'critical', None
+
+    dt_critical = get_dt_critical(readings, forecast_hours)
+    if dt_critical:
+        return 'approaching', dt_critical
+    return 'normal', None
+
+
+def get_rules_met(readings, results=None):
+    """Return the critical rules that the latest reading meets. results is
+    from analysis_utils.evaluate_readings(readings).
+    """
+    results = results if results else a_utils.evaluate_readings(readings)
+    series = results.series
+    latest_slot = np.flatnonzero(series.source_index == len(readings) - 1)
+    if not len(latest_slot):
+        return []
+    return [rule for rule, critical in
+                zip(results.rules, results.critical[:, latest_slot[0]])
+                if critical]
+
+
+def get_dt_critical(readings, forecast_hours=FORECAST_HOURS):
+    """Return when the river would reach the minimum critical forecast,
+    rising at the rate of the last hour, or None if it wouldn't within
+    forecast_hours.
+    """
+    latest_reading = readings[-1]
+    dt_hour_ago = latest_reading.dt_reading - datetime.timedelta(hours=1)
+    earlier_readings = [r for r in readings if r.dt_reading <= dt_hour_ago]
+    if not earlier_readings:
+        return None
+    earlier_reading = earlier_readings[-1]
+
+    hours = (latest_reading.dt_reading
+            - earlier_reading.dt_reading).total_seconds() / 3600
+    rate = (latest_reading.height - earlier_reading.height) / hours
+    if rate <= 0:
+        return None
+
+    dt_last_forecast = (latest_reading.dt_reading
+            + datetime.timedelta(hours=forecast_hours))
+    for cf_reading in a_utils.get_min_critical_forecast(readings):
+        if cf_reading.dt_reading > dt_last_forecast:
+            break
+        hours_ahead = (cf_reading.dt_reading
+                - latest_reading.dt_reading).total_seconds() / 3600
+        if latest_reading.height + rate * hours_ahead >= cf_reading.height:
+            return cf_reading.dt_reading
+    return None
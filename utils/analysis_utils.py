@@ -1,20 +1,25 @@
 """Utility functions for analyzing stream gauge data, and slide data.
 """
 
-import math, datetime, csv
+import datetime, csv, io
 
 from xml.etree import ElementTree as ET
 
-import requests, pytz
+import pytz
+import numpy as np
 
 # Assume this file will be imported in a directory outside of utils.
 from utils.ir_reading import IRReading
+from utils import critical_rules, resample_utils, quality_utils
+from utils.critical_rules import RISE_CRITICAL, M_CRITICAL
 
+# USGS instantaneous values for the Indian River gauge, as tab-separated rdb.
+USGS_URL = "https://waterdata.usgs.gov/ak/nwis/uv"
+USGS_SITE_NO = '15087700'
 
-# Critical values.
-# Critical rise in feet. Critical slope, in ft/hr.
-RISE_CRITICAL = 2.5
-M_CRITICAL = 0.5
+# Critical points within this many hours of the first critical point in an
+#   event are part of the same event.
+EVENT_SUPPRESSION_HOURS = 12
 
 
 def fetch_current_data(fresh=True, filename='current_data/current_data.txt'):
@@ -27,6 +32,9 @@ def fetch_current_data(fresh=True, filename='current_data/current_data.txt'):
     Returns the current data as text.
     """
     if fresh:
+        # Only fetches need requests; don't make analysis pay for it.
+        import requests
+
         gauge_url = "https://water.weather.gov/ahps2/hydrograph_to_xml.php?gage=irva2&output=tabular"
         gauge_url_xml = "https://water.weather.gov/ahps2/hydrograph_to_xml.php?gage=irva2&output=xml"
         r = requests.get(gauge_url_xml)
@@ -59,27 +67,12 @@ def fetch_current_data_usgs(fresh=True,
     Returns the current data file.
     """
 
-    # Data url format:
-    # https://waterdata.usgs.gov/ak/nwis/uv?cb_00065=on&format=rdb \ 
-    #   &site_no=15087700&period=&begin_date=2020-02-18&end_date=2020-02-21
-    # Grab last 3 days of data; will be 48 hrs + today's hours.
-    # Make sure I make an appropriate ak timestamp, because this needs to run
-    #  on my system which is localized to ak, and a server which is on utc.
-    #  Start with utc time, then localize to ak.
-    aktz = pytz.timezone('US/Alaska')
-    dt_end_naive = datetime.datetime.utcnow()
-    dt_end_utc = pytz.utc.localize(dt_end_naive)
-    dt_end_ak = dt_end_utc.astimezone(aktz)
-    dt_end_ak_str = dt_end_ak.strftime("%Y-%m-%d")
-    dt_start_ak = dt_end_ak - datetime.timedelta(days=3)
-    dt_start_ak_str = dt_start_ak.strftime("%Y-%m-%d")
-
-    usgs_url = f"https://waterdata.usgs.gov/ak/nwis/uv?cb_00065=on&format=rdb"
-    usgs_url += f"&site_no=15087700&period=&begin_date={dt_start_ak_str}"
-    usgs_url += f"&end_date={dt_end_ak_str}"
+    usgs_url = get_current_usgs_url()
 
     if fresh:
         # All of above should be moved to a helper function if fresh.
+        import requests
+
         r = requests.get(usgs_url)
 
         with open(filename, 'w') as f:
@@ -99,109 +92,266 @@ def fetch_current_data_usgs(fresh=True,
             return filename
 
 
+def get_current_usgs_url():
+    """Return the url for the last 3 days of USGS readings."""
+    # Data url format:
+    # https://waterdata.usgs.gov/ak/nwis/uv?cb_00065=on&format=rdb \ 
+    #   &site_no=15087700&period=&begin_date=2020-02-18&end_date=2020-02-21
+    # Grab last 3 days of data; will be 48 hrs + today's hours.
+    # Make sure I make an appropriate ak timestamp, because this needs to run
+    #  on my system which is localized to ak, and a server which is on utc.
+    #  Start with utc time, then localize to ak.
+    aktz = pytz.timezone('US/Alaska')
+    dt_end_naive = datetime.datetime.utcnow()
+    dt_end_utc = pytz.utc.localize(dt_end_naive)
+    dt_end_ak = dt_end_utc.astimezone(aktz)
+    dt_end_ak_str = dt_end_ak.strftime("%Y-%m-%d")
+    dt_start_ak = dt_end_ak - datetime.timedelta(days=3)
+    dt_start_ak_str = dt_start_ak.strftime("%Y-%m-%d")
+
+    return get_usgs_url(dt_start_ak_str, dt_end_ak_str)
+
+
+def get_usgs_url(begin_date_str, end_date_str, base_url=USGS_URL):
+    """Return the url for USGS readings between two dates, inclusive.
+    Dates are 'YYYY-MM-DD', in local time.
+    """
+    usgs_url = f"{base_url}?cb_00065=on&format=rdb"
+    usgs_url += f"&site_no={USGS_SITE_NO}&period=&begin_date={begin_date_str}"
+    usgs_url += f"&end_date={end_date_str}"
+    return usgs_url
+
+
 def process_xml_data(data):
     """Processes xml data from text file.
-    Returns a list of readings.
+    Returns a list of observed readings.
     """
+    observed_readings, _, _ = process_nws_xml(io.StringIO(data))
+    return observed_readings
 
-    # Parse xml tree from file.
-    root = ET.fromstring(data)
-    tree = ET.ElementTree(root)
 
-    # 6th element is the set of observed readings.
-    # 1st and 2nd elements of each reading are datetime, height.
-    readings = []
-    for reading in root[5]:
-        dt_reading_str = reading[0].text
-        dt_reading = datetime.datetime.strptime(dt_reading_str,
-                 "%Y-%m-%dT%H:%M:%S-00:00")
-        dt_reading_utc = dt_reading.replace(tzinfo=pytz.utc)
-        height = float(reading[1].text)
+def process_nws_xml(source):
+    """Processes an NWS hydrograph xml document, from a filename or a file
+    object.
+    Returns lists of observed readings and forecast readings, each cleaned
+    and in chronological order, and the QualityReport for the observed
+    readings.
+    """
+    series = parse_nws_xml(source)
 
-        reading = IRReading(dt_reading_utc, height)
-        readings.append(reading)
+    observed_ts, observed_heights = series['observed']
+    kept, _, report = quality_utils.clean_arrays(observed_ts,
+            observed_heights)
+    observed_readings = resample_utils.arrays_to_readings(observed_ts[kept],
+            observed_heights[kept])
 
-    # Readings need to be in chronological order.
-    # DEV: This should be an absolute ordering, not just relying on 
-    #      input file format.
-    readings.reverse()
+    forecast_ts, forecast_heights = series['forecast']
+    kept, _, _ = quality_utils.clean_arrays(forecast_ts, forecast_heights)
+    forecast_readings = resample_utils.arrays_to_readings(forecast_ts[kept],
+            forecast_heights[kept])
+
+    return observed_readings, forecast_readings, report
+
+
+def parse_nws_xml(source):
+    """Stream an NWS hydrograph xml document, from a filename or a file
+    object.
+
+    Finds the observed and forecast sections by tag, and frees each datum
+      once it's read, so the whole tree is never held in memory.
+    Returns a dict with 'observed' and 'forecast' entries, each a pair of
+      epoch-second and height arrays, in document order.
+    """
+    sections = {'observed': ([], []), 'forecast': ([], [])}
+    section = None
+    dt_str = height_str = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in sections:
+                section = elem.tag
+            continue
+
+        # Each datum has a valid time, and a primary value which is the
+        #   height in ft.
+        if elem.tag == 'valid':
+            dt_str = elem.text
+        elif elem.tag == 'primary':
+            height_str = elem.text
+        elif elem.tag == 'datum':
+            if section and dt_str and height_str:
+                sections[section][0].append(dt_str.strip())
+                sections[section][1].append(height_str)
+            dt_str = height_str = None
+            elem.clear()
+        elif elem.tag in sections:
+            section = None
+            elem.clear()
+
+    return {name: (parse_nws_timestamps(dt_strs),
+                    np.array(height_strs, dtype=np.float64))
+                for name, (dt_strs, height_strs) in sections.items()}
+
+
+def parse_nws_timestamps(dt_strs):
+    """Convert NWS timestamps such as '2020-02-21T18:30:00-00:00' to epoch
+    seconds, all at once.
+    """
+    if not dt_strs:
+        return np.empty(0, dtype=np.int64)
+
+    # Casting to 19 characters drops the utc offset.
+    timestamps = np.array(dt_strs, dtype='U19').astype('datetime64[s]')
+    timestamps = timestamps.astype(np.int64)
+
+    # Apply any offsets other than utc, once per distinct offset.
+    suffixes, suffix_indices = np.unique([s[19:] for s in dt_strs],
+            return_inverse=True)
+    offsets = np.array([_get_utc_offset(suffix) for suffix in suffixes])
+    return timestamps - offsets[suffix_indices]
+
+
+def _get_utc_offset(suffix):
+    """Return the offset in seconds for a suffix such as '-08:00' or 'Z'."""
+    if suffix in ('', 'Z', '-00:00', '+00:00'):
+        return 0
+    sign = -1 if suffix[0] == '-' else 1
+    hours, minutes = suffix[1:].split(':')
+    return sign * (int(hours) * 3600 + int(minutes) * 60)
 
-    return readings
 
 def process_usgs_data(usgs_data_file):
     """Processes data that came directly from the USGS.
-    Returns a list of readings.
+    Returns a list of readings, and a QualityReport.
     """
-    aktz = pytz.timezone('US/Alaska')
     with open(usgs_data_file) as f:
-        reader = csv.reader(f, delimiter='\t')
-        # Skip past all the header rows.
-        for _ in range(28):
-            next(reader)
-        readings = []
-        for row in reader:
-            # Skip any data that causes errors.
-            try:
-                ts_naive = datetime.datetime.strptime(row[2], '%Y-%m-%d %H:%M')
-                tz_str = row[3]
-                height = float(row[4])
-            except Exception as e:
-                # DEV: Bare except is bad, but fix.
-                # Log this?
-                pass
-                print('exception', e)
-            else:
-                ts_ak = aktz.localize(ts_naive)
-                ts_utc = ts_ak.astimezone(pytz.utc)
-                new_reading = IRReading(ts_utc, height)
-                readings.append(new_reading)
-
-    # Make sure readings are in chronological order.
-    if readings[-1].dt_reading < readings[0].dt_reading:
-        readings.reverse()
+        readings = parse_usgs_data(f)
+
+    # Make sure readings are in chronological order, without duplicates
+    #   or spikes.
+    return clean_readings(readings)
+
+
+def parse_usgs_data(lines):
+    """Parses lines of USGS rdb data, from a file or a response.
+    Returns a list of readings, in the order they appear.
+    """
+    # Skip past all the header rows: comments, column names, and
+    #   column formats.
+    lines = (line for line in lines if not line.startswith('#'))
+    reader = csv.reader(lines, delimiter='\t')
+    for _ in range(2):
+        next(reader, None)
+
+    return parse_usgs_rows(reader)
+
+
+def parse_usgs_rows(rows):
+    """Parses rows of USGS rdb readings, already split into fields.
+    Returns a list of readings, in the order they appear.
+    """
+    aktz = pytz.timezone('US/Alaska')
+
+    readings = []
+    for row in rows:
+        # Skip any data that causes errors.
+        try:
+            ts_naive = datetime.datetime.strptime(row[2], '%Y-%m-%d %H:%M')
+            tz_str = row[3]
+            height = float(row[4])
+        except Exception as e:
+            # DEV: Bare except is bad, but fix.
+            # Log this?
+            pass
+            print('exception', e)
+        else:
+            ts_ak = aktz.localize(ts_naive)
+            ts_utc = ts_ak.astimezone(pytz.utc)
+            new_reading = IRReading(ts_utc, height)
+            readings.append(new_reading)
 
     return readings
 
 
-def get_critical_points(readings):
+def clean_readings(readings):
+    """Run readings through the data quality stage.
+    Returns the clean readings, and a QualityReport of what was found.
+    """
+    readings, _, report = quality_utils.clean_readings(readings)
+    return readings, report
+
+
+def evaluate_readings(readings, rules=None):
+    """Evaluate the critical rules over a set of readings, in one pass.
+    Returns a RuleResults, which can be passed to get_critical_points(),
+    get_critical_points_by_rule(), and the alert engine, so the rules are
+    only evaluated once per refresh.
+    """
+    series = resample_utils.resample_readings(readings)
+    return critical_rules.evaluate_series(series, rules)
+
+
+def get_critical_points(readings, rules=None, results=None):
     """Return critical points.
-    A critical point is the first point where the slope has been critical
-    over a minimum rise. Once a point is considered critical, there are no
-    more critical points for the next 6 hours.
+    A critical point is any reading that meets one of the critical rules;
+    see critical_rules.RULES. results is from evaluate_readings(readings).
+    """
+    results = results if results else evaluate_readings(readings, rules)
+    source_index = results.series.source_index
+    return [readings[i] for i in source_index[results.any_critical]]
+
+
+def get_critical_points_by_rule(readings, rules=None, results=None):
+    """Return a dict of each rule's name, and the critical points that meet
+    that rule. results is from evaluate_readings(readings).
+    """
+    results = results if results else evaluate_readings(readings, rules)
+    source_index = results.series.source_index
+    return {name: [readings[i] for i in source_index[mask]]
+                for name, mask in results.get_critical_by_rule().items()}
+
+
+def get_critical_mask(series, rules=None):
+    """Return a boolean mask over a RegularSeries, marking the slots where
+    any rule is met. All the rules are evaluated in one pass.
+    """
+    return critical_rules.evaluate_series(series, rules).any_critical
+
+
+def get_onset_indices(timestamps, suppression_hours=EVENT_SUPPRESSION_HOURS):
+    """From the sorted epoch timestamps of a set of critical points, return
+    the indices of the first critical point in each event.
+
+    A critical point starts a new event when it's more than
+      suppression_hours (in whole hours) after the previous onset.
     """
+    group_seconds = (suppression_hours + 1) * 3600
+    onset_indices = []
+    index = 0
+    while index < len(timestamps):
+        onset_indices.append(index)
+        index = np.searchsorted(timestamps, timestamps[index] + group_seconds)
+
+    return np.array(onset_indices, dtype=np.int64)
 
-    # What's the longest it could take to reach critical?
-    #   RISE_CRITICAL / M_CRITICAL
-    #  If it rises faster than that, we want to know.
-    #    Multiplied by 4, because there are 4 readings/hr.
-    readings_per_hr = get_reading_rate(readings)
-    max_lookback = math.ceil(RISE_CRITICAL / M_CRITICAL) * readings_per_hr
-
-    critical_points = []
-    # Start with 10th reading, so can look back.
-    for reading_index, reading in enumerate(readings[max_lookback:]):
-        # print(f"  Examining reading: {reading.get_formatted_reading()}")
-        # Get prev max_lookback readings.
-        prev_readings = [reading for reading in readings[reading_index-max_lookback:reading_index]]
-        for prev_reading in prev_readings:
-            rise = reading.get_rise(prev_reading)
-            m = reading.get_slope(prev_reading)
-            # print(f"    Rise: {rise} Slope: {m}")
-            if rise >= RISE_CRITICAL and m > M_CRITICAL:
-                # print(f"Critical point: {reading.get_formatted_reading()}")
-                critical_points.append(reading)
-                break
-
-    return critical_points
+
+def get_max_rise(series):
+    """Return the largest rise into each slot of a RegularSeries, from any
+    slot within the critical lookback window. Slots with nothing to compare
+    against are nan.
+    """
+    rule = critical_rules.CriticalRule('max_rise', rise=RISE_CRITICAL,
+            rate=M_CRITICAL)
+    return critical_rules.evaluate_heights(series.heights, series.interval,
+            [rule], details=True).max_rise[0]
 
 
 def get_reading_rate(readings):
     """Return readings/hr.
     Should be 1 or 4, for hourly or 15-min readings.
     """
-    reading_interval = (
-        (readings[1].dt_reading - readings[0].dt_reading).total_seconds() // 60)
-    reading_rate = int(60 / reading_interval)
+    timestamps, _ = resample_utils.readings_to_arrays(readings)
+    reading_interval = resample_utils.infer_interval(timestamps)
+    reading_rate = int(3600 // reading_interval)
     # print(f"Reading rate for this set of readings: {reading_rate}")
 
     return reading_rate
@@ -225,54 +375,86 @@ def get_first_critical_points(readings):
     each potentially critical event.
     Return this set of readings.
     """
+    series = resample_utils.resample_readings(readings)
+    critical_mask = get_critical_mask(series)
+    critical_indices = series.source_index[critical_mask]
 
-    # What's the longest it could take to reach critical?
-    #   RISE_CRITICAL / M_CRITICAL
-    #  If it rises faster than that, we want to know.
-    #    Multiplied by 4, because there are 4 readings/hr.
-    # Determine readings/hr from successive readings.
-    #  reading_interval is in minutes
-    # Assumes all readings in this set of readings are at a consistent interval.
-    reading_interval = (readings[1].dt_reading - readings[0].dt_reading).total_seconds() // 60
-    lookback_factor = int(60 / reading_interval)
-    # print('lf', lookback_factor)
-    max_lookback = math.ceil(RISE_CRITICAL / M_CRITICAL) * lookback_factor
-
-    first_critical_points = []
-    # Start with 10th reading, so can look back.
-    for reading_index, reading in enumerate(readings[max_lookback:]):
-        # print(f"  Examining reading: {reading.get_formatted_reading()}")
-        # Get prev max_lookback readings.
-        prev_readings = [reading for reading in readings[reading_index-max_lookback:reading_index]]
-        for prev_reading in prev_readings:
-            rise = reading.get_rise(prev_reading)
-            m = reading.get_slope(prev_reading)
-            # print(f"    Rise: {rise} Slope: {m}")
-            if rise >= RISE_CRITICAL and m > M_CRITICAL:
-                # print(f"Critical point: {reading.get_formatted_reading()}")
-                # Ignore points 12 hours after an existing critical point.
-                if not first_critical_points:
-                    first_critical_points.append(reading)
-                    break
-                elif (reading.dt_reading - first_critical_points[-1].dt_reading).total_seconds() // 3600 > 12:
-                    first_critical_points.append(reading)
-                    break
-                else:
-                    # This is shortly after an already-identified point.
-                    break
+    # Ignore points 12 hours after an existing critical point.
+    timestamps, _ = resample_utils.readings_to_arrays(
+            [readings[i] for i in critical_indices])
+    onset_indices = get_onset_indices(timestamps)
+    first_critical_points = [readings[critical_indices[i]]
+                                for i in onset_indices]
 
     return first_critical_points
 
 
+def get_min_critical_forecast(readings, num_readings=18, interval_minutes=15):
+    """Return the minimum future readings needed to become, or remain,
+    critical, once every interval_minutes after the last reading.
+
+    These are the heights that would result in a total rise and average
+      rate of rise over the critical period matching the critical values.
+    The default is the next 4.5 hours; looking farther ahead than the
+      critical 5-hour period seems less meaningful.
+    """
+    lookback_hours = RISE_CRITICAL / M_CRITICAL
+    interval = datetime.timedelta(minutes=interval_minutes)
+
+    min_cf_readings = []
+    dt_future = readings[-1].dt_reading
+    for _ in range(num_readings):
+        dt_future += interval
+        dt_lookback = dt_future - datetime.timedelta(hours=lookback_hours)
+        # Get minimum height from the critical period, including future readings.
+        relevant_readings = [r for r in readings
+            if r.dt_reading >= dt_lookback]
+        relevant_readings += min_cf_readings
+        critical_height = min([r.height for r in relevant_readings]) + RISE_CRITICAL
+
+        # Make sure critical_height also gives an average rise over the
+        #   critical period at least as great as M_CRITICAL. Units are ft/hr.
+        m_avg = (critical_height - relevant_readings[0].height) / lookback_hours
+        if m_avg < M_CRITICAL:
+            # The critical height satisfies total rise, but not sustained rate
+            #   of rise. Bump critical height so it satisfies total rise and
+            #   rate of rise.
+            critical_height = lookback_hours * M_CRITICAL + relevant_readings[0].height
+
+        min_cf_readings.append(IRReading(dt_future, critical_height))
+
+    return min_cf_readings
+
+
+def get_nws_critical_forecast(min_cf_readings, forecast_readings):
+    """Compare an NWS river forecast with the minimum critical forecast.
+
+    The NWS forecast is interpolated to the times of the minimum critical
+      readings. Returns the interpolated forecast readings that reach the
+      critical heights; an empty list means the NWS forecast doesn't reach
+      critical conditions.
+    """
+    if not min_cf_readings or len(forecast_readings) < 2:
+        return []
+
+    cf_ts, cf_heights = resample_utils.readings_to_arrays(min_cf_readings)
+    forecast_ts, forecast_heights = resample_utils.readings_to_arrays(
+            forecast_readings)
+    nws_heights = np.interp(cf_ts, forecast_ts, forecast_heights,
+            left=np.nan, right=np.nan)
+    critical = nws_heights >= cf_heights
+    return resample_utils.arrays_to_readings(cf_ts[critical],
+            nws_heights[critical])
+
+
 def get_48hr_readings(first_critical_point, all_readings):
     """Return 24 hrs of readings before, and 24 hrs of readings after the
     first critical point."""
-    readings_per_hr = get_reading_rate(all_readings)
-    # Pull from all_readings, with indices going back 24 hrs and forward
-    #  24 hrs.
-    fcp_index = all_readings.index(first_critical_point)
-    start_index = fcp_index - 24 * readings_per_hr
-    end_index = fcp_index + 24 * readings_per_hr
-    # print(readings_per_hr, start_index, end_index)
-
-    return all_readings[start_index:end_index]
\ No newline at end of file
+    # Find the window by time, not by counting readings, so gaps and
+    #   changes in reading rate don't shift the window.
+    timestamps, _ = resample_utils.readings_to_arrays(all_readings)
+    fcp_ts = first_critical_point.dt_reading.timestamp()
+    start_index = np.searchsorted(timestamps, fcp_ts - 24 * 3600, side='left')
+    end_index = np.searchsorted(timestamps, fcp_ts + 24 * 3600, side='left')
+
+    return all_readings[start_index:end_index]
@@ -0,0 +1,308 @@
+"""Utilities for building animations of the critical forecast plot.
+
+Each frame is the extended critical forecast plot for the 48 hours of
+readings ending at the frame's time. Frames are rendered to a temp
+directory and assembled with ffmpeg.
+
+Animations requested through the site run as background jobs in a local
+process pool. Finished files are cached by a hash of their parameters,
+so a repeated request returns the existing file, and the least recently
+used files are removed when the cache is full. A requested range is
+clamped to the last archived reading, so a cached animation never misses
+readings that arrived after it was rendered.
+
+Job state lives on disk, so every web worker sees every job: each job has
+a small json record, and the process rendering it holds a single-flight
+lease named for the job. If two workers queue the same job, only one
+renders it.
+
+Animations are kept out of media, which the web server may serve to
+anyone. The site serves them only to logged in users, like the plots.
+"""
+
+import datetime, hashlib, json, os, re, subprocess, tempfile, threading, time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import reading_archive, resample_utils, single_flight
+from utils import slide_store, time_utils
+
+
+ANIMATION_DIR = 'historical_data/animations'
+MAX_CACHED_ANIMATIONS = 20
+ANIMATION_FORMATS = ('mp4', 'gif')
+ANIMATION_NAME = re.compile(r'^[0-9a-f]{16}\.(%s)$'
+        % '|'.join(ANIMATION_FORMATS))
+
+# Job records and leases, within the animation dir.
+JOB_DIR = 'jobs'
+# A job that hasn't started rendering this long after it was queued was
+#   lost, ie its web worker exited.
+MAX_QUEUED_MINUTES = 30
+# Records of finished jobs are kept this long.
+JOB_RECORD_HOURS = 24
+
+# Hours of readings shown in each frame.
+FRAME_HOURS = 48
+
+
+def get_framerate(cadence_minutes):
+    """Hourly frames play slower than 15-minute frames."""
+    return 5 if cadence_minutes < 60 else 2
+
+
+def render_animation(readings, filename, dt_start=None, dt_end=None,
+        cadence_minutes=15, known_slides=None):
+    """Render an animation of readings to filename, an mp4 or gif.
+
+    There is one frame every cadence_minutes from dt_start to dt_end; each
+      frame shows the FRAME_HOURS of readings ending at that time. By
+      default the frames run from FRAME_HOURS after the first reading to
+      the last reading.
+    known_slides is a SlideStore.
+    """
+    # Import matplotlib here, so the site can queue jobs without loading it.
+    from utils import plot_utils_mpl
+
+    timestamps, _ = resample_utils.readings_to_arrays(readings)
+    ts_start = (dt_start.timestamp() if dt_start
+                    else timestamps[0] + FRAME_HOURS * 3600)
+    ts_end = dt_end.timestamp() if dt_end else timestamps[-1]
+    if known_slides is None:
+        known_slides = slide_store.SlideStore()
+    # Every frame's times are a slice of these.
+    local_times = time_utils.LocalTimes(timestamps)
+
+    with tempfile.TemporaryDirectory() as frame_dir:
+        num_frames = 0
+        for frame_ts in np.arange(ts_start, ts_end + 1, cadence_minutes * 60):
+            lo = np.searchsorted(timestamps, frame_ts - FRAME_HOURS * 3600)
+            hi = np.searchsorted(timestamps, frame_ts, side='right')
+            frame_readings = readings[lo:hi]
+            if len(frame_readings) < 2:
+                continue
+
+            # ffmpeg will use images in alphabetical order, so zero-pad
+            #   frame numbers.
+            frame_filename = os.path.join(frame_dir,
+                    f"animation_frame_{num_frames:05}.png")
+            critical_points = a_utils.get_critical_points(frame_readings)
+            plot_utils_mpl.plot_critical_forecast_mpl_extended(
+                    frame_readings,
+                    critical_points,
+                    known_slides.get_slides_for_readings(frame_readings),
+                    filename=frame_filename,
+                    thumbnails=False,
+                    local_times=local_times[lo:hi])
+            num_frames += 1
+
+        if not num_frames:
+            raise ValueError("No readings to animate in this time range.")
+
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                '-framerate', str(get_framerate(cadence_minutes)),
+                '-pattern_type', 'glob', '-i', '*.png']
+        if filename.endswith('.gif'):
+            cmd += ['-vf', 'scale=640:-1:flags=lanczos,split[s0][s1];'
+                    '[s0]palettegen[p];[s1][p]paletteuse']
+        else:
+            cmd += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+        cmd.append(os.path.abspath(filename))
+        subprocess.run(cmd, cwd=frame_dir, check=True)
+
+
+def get_job_id(dt_start, dt_end, cadence_minutes, animation_format):
+    """Return a hash that identifies an animation by its parameters."""
+    params = (f"{int(dt_start.timestamp())}-{int(dt_end.timestamp())}-"
+                f"{cadence_minutes}-{animation_format}")
+    return hashlib.sha1(params.encode()).hexdigest()[:16]
+
+
+def get_animation_file(job_id, animation_format,
+        animation_dir=ANIMATION_DIR):
+    return os.path.join(animation_dir, f"{job_id}.{animation_format}")
+
+
+def is_animation_name(name):
+    """Whether name could be a cached animation, ie 3f2a9c01b7d4e5f6.mp4."""
+    return bool(ANIMATION_NAME.match(name))
+
+
+def evict_animations(max_cached=MAX_CACHED_ANIMATIONS,
+        animation_dir=ANIMATION_DIR):
+    """Remove the least recently used animations, beyond max_cached.
+    A file's mtime is its last use; cache hits touch the file.
+    """
+    filenames = [os.path.join(animation_dir, f)
+                    for f in os.listdir(animation_dir)
+                    if f.rsplit('.', 1)[-1] in ANIMATION_FORMATS
+                        and '.tmp.' not in f]
+    filenames.sort(key=os.path.getmtime, reverse=True)
+    for filename in filenames[max_cached:]:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+class AnimationQueue:
+    """Queue of animation jobs, run in a local pool of worker processes.
+
+    Identical requests share one job, and finished animations are served
+      from the cache. Job state is kept on disk, so the status of a job is
+      the same from every process.
+    """
+
+    def __init__(self, max_workers=2, animation_dir=ANIMATION_DIR,
+            archive_dir=reading_archive.ARCHIVE_DIR):
+        self.max_workers = max_workers
+        self.animation_dir = animation_dir
+        self.archive_dir = archive_dir
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, dt_start, dt_end, cadence_minutes=15,
+            animation_format='mp4'):
+        """Queue an animation, unless it's cached or already queued.
+        dt_end is clamped to the last archived reading.
+        Returns the job id.
+        """
+        last_ts = reading_archive.get_last_timestamp(self.archive_dir)
+        if last_ts is not None:
+            dt_end = min(dt_end,
+                    datetime.datetime.fromtimestamp(last_ts, tz=pytz.utc))
+        if last_ts is None or dt_end <= dt_start:
+            raise ValueError("No archived readings in this time range.")
+
+        job_id = get_job_id(dt_start, dt_end, cadence_minutes,
+                animation_format)
+        filename = get_animation_file(job_id, animation_format,
+                self.animation_dir)
+
+        with self._lock:
+            if os.path.exists(filename):
+                os.utime(filename)
+                return job_id
+            if self.get_status(job_id, animation_format)['status'] == 'running':
+                return job_id
+
+            prune_jobs(self.animation_dir)
+            save_job_record(job_id, 'queued', self.animation_dir)
+            if not self._executor:
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            self._executor.submit(_run_job, job_id, filename, dt_start,
+                    dt_end, cadence_minutes, self.animation_dir,
+                    self.archive_dir)
+
+        return job_id
+
+    def get_status(self, job_id, animation_format='mp4'):
+        """Return a dict with the job's status, and its file if it's done.
+        Status is one of 'done', 'running', 'failed', or 'unknown'; a
+        queued job counts as running.
+        """
+        filename = get_animation_file(job_id, animation_format,
+                self.animation_dir)
+        if os.path.exists(filename):
+            return {'status': 'done', 'filename': filename}
+
+        record = load_job_record(job_id, self.animation_dir)
+        if not record:
+            return {'status': 'unknown'}
+        if record['status'] == 'failed':
+            return {'status': 'failed', 'error': record['error']}
+        lease = single_flight.read_lease(job_id,
+                get_job_dir(self.animation_dir))
+        if lease and not single_flight.is_stale(lease):
+            return {'status': 'running'}
+        if (record['status'] == 'queued'
+                and time.time() - record['updated'] < MAX_QUEUED_MINUTES * 60):
+            return {'status': 'running'}
+        # Lost, or finished and since evicted.
+        return {'status': 'unknown'}
+
+
+def get_job_dir(animation_dir=ANIMATION_DIR):
+    return os.path.join(animation_dir, JOB_DIR)
+
+
+def get_job_record_file(job_id, animation_dir=ANIMATION_DIR):
+    return os.path.join(get_job_dir(animation_dir), f"{job_id}.json")
+
+
+def load_job_record(job_id, animation_dir=ANIMATION_DIR):
+    """Return a job's record, or None."""
+    try:
+        with open(get_job_record_file(job_id, animation_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_job_record(job_id, status, animation_dir=ANIMATION_DIR, error=None):
+    """Record a job's status: 'queued', 'running', 'done', or 'failed'."""
+    os.makedirs(get_job_dir(animation_dir), exist_ok=True)
+    record = {'status': status, 'error': error, 'updated': time.time()}
+    filename = get_job_record_file(job_id, animation_dir)
+    # Each process writes its own temp file, and renames it into place.
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_filename, filename)
+
+
+def prune_jobs(animation_dir=ANIMATION_DIR, max_hours=JOB_RECORD_HOURS):
+    """Remove job records and lease guard files that haven't been touched
+    in max_hours.
+    """
+    job_dir = get_job_dir(animation_dir)
+    if not os.path.isdir(job_dir):
+        return
+    cutoff = time.time() - max_hours * 3600
+    for name in os.listdir(job_dir):
+        filename = os.path.join(job_dir, name)
+        try:
+            if os.path.getmtime(filename) < cutoff:
+                os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def _run_job(job_id, filename, dt_start, dt_end, cadence_minutes,
+        animation_dir, archive_dir):
+    """Render one animation job, in a worker process."""
+    # Another web worker may have queued the same job. Whoever holds the
+    #   lease renders it; the rest have nothing to do.
+    lease = single_flight.Lease(job_id, get_job_dir(animation_dir))
+    if not lease.acquire():
+        return filename
+
+    try:
+        if os.path.exists(filename):
+            return filename
+        save_job_record(job_id, 'running', animation_dir)
+        dt_first = dt_start - datetime.timedelta(hours=FRAME_HOURS)
+        readings = reading_archive.load_readings(dt_first, dt_end,
+                archive_dir)
+        if not readings:
+            raise ValueError("No archived readings in this time range.")
+
+        # Render to a temp name, so a partial file is never served.
+        base, ext = os.path.splitext(filename)
+        tmp_filename = f"{base}.tmp{ext}"
+        render_animation(readings, tmp_filename, dt_start, dt_end,
+                cadence_minutes, slide_store.load_slides())
+        lease.check()
+        os.replace(tmp_filename, filename)
+        save_job_record(job_id, 'done', animation_dir)
+    except Exception as e:
+        save_job_record(job_id, 'failed', animation_dir, error=str(e))
+        raise
+    finally:
+        lease.release()
+
+    evict_animations(animation_dir=animation_dir)
+    return filename
@@ -0,0 +1,230 @@
+"""Versioned publishing of rendered plots.
+
+Renderers write into a staging directory, never over a file the site is
+serving. Publishing copies each staged file to a name that includes a hash
+of its contents, ie irg_critical_forecast_plot_current.3f2a9c01b7d4.png,
+and then swaps in a small manifest that maps each plot's plain name to its
+current versioned name. A request sees either the old manifest or the new
+one, and every file either manifest names is complete.
+
+A versioned file never changes, so its url can be cached for a year by
+the viewer's browser. Plots are only for logged in users, so they're
+never cached by shared caches. Files that haven't changed since the last
+refresh keep their name, and stay in every cache.
+
+Text files are also published gzipped and brotli-compressed, ie
+simple_irg_plot_current.b667a895ff32.html.gz and .html.br. They're
+compressed once per refresh, at the highest levels, and every request is
+served whichever variant the client accepts.
+"""
+
+import datetime, gzip, hashlib, json, os, re, shutil
+
+import pytz
+
+
+# The site serves published plots from the project directory, so they're
+#   published there wherever a refresh runs from. The paths below are
+#   within a publish root: the project directory, or a replay's directory.
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGING_DIR = 'historical_data/staging'
+MANIFEST_FILE = 'historical_data/artifacts.json'
+
+# Where published files go, by extension. Plots are only served to logged
+#   in users, so they stay out of media, which the web server may serve to
+#   anyone.
+FRAGMENT_DIR = 'irg_viz/templates/irg_viz/plot_fragments'
+IMAGE_DIR = 'irg_viz/plot_images'
+
+PRIVATE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Precompressed variants, in order of preference.
+COMPRESSIBLE_EXTENSIONS = ('.html', '.json', '.svg', '.js')
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Superseded files are kept this long, so pages that were rendered just
+#   before a refresh can still load their images.
+KEEP_HOURS = 1
+
+HASH_LENGTH = 12
+VERSIONED_NAME = re.compile(r'^[\w.-]+\.[0-9a-f]{%d}\.\w+$' % HASH_LENGTH)
+
+# The manifest each process has loaded, and its modification time.
+_loaded = {}
+
+
+def get_path(path, publish_root=''):
+    """Return a path within a publish root, which is the project directory
+    by default.
+    """
+    return os.path.join(publish_root if publish_root else PROJECT_DIR, path)
+
+
+def get_staging_file(name, staging_dir=None):
+    """Return the path to render a plot to, before it's published."""
+    staging_dir = staging_dir if staging_dir else get_path(STAGING_DIR)
+    os.makedirs(staging_dir, exist_ok=True)
+    return os.path.join(staging_dir, name)
+
+
+def publish_artifacts(staging_dir=None, manifest_file=None, publish_root=''):
+    """Publish everything in the staging directory, and swap in a new
+    manifest. Published files go under publish_root, which is the project
+    directory by default. Returns the manifest.
+    """
+    staging_dir = staging_dir if staging_dir else get_path(STAGING_DIR)
+    manifest_file = manifest_file if manifest_file else get_path(
+            MANIFEST_FILE)
+    old_manifest = load_manifest(manifest_file)
+    artifacts = dict(old_manifest['artifacts'])
+    for name in sorted(os.listdir(staging_dir)):
+        staged_file = os.path.join(staging_dir, name)
+        with open(staged_file, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+
+        base, ext = os.path.splitext(name)
+        versioned_name = f"{base}.{content_hash}{ext}"
+        versioned_file = os.path.join(get_publish_dir(name, publish_root),
+                versioned_name)
+        if not os.path.exists(versioned_file):
+            os.makedirs(os.path.dirname(versioned_file), exist_ok=True)
+            shutil.copyfile(staged_file, f"{versioned_file}.tmp")
+            os.replace(f"{versioned_file}.tmp", versioned_file)
+            if ext in COMPRESSIBLE_EXTENSIONS:
+                write_compressed_variants(versioned_file)
+        artifacts[name] = versioned_name
+
+    # Note when each file stopped being current, and remove the ones that
+    #   have been superseded for a while.
+    now = datetime.datetime.now(pytz.utc).timestamp()
+    current_names = set(artifacts.values())
+    superseded = {name: ts for name, ts in old_manifest['superseded'].items()
+                    if name not in current_names}
+    for name in old_manifest['artifacts'].values():
+        if name not in current_names:
+            superseded.setdefault(name, now)
+    superseded = _remove_superseded(superseded, now - KEEP_HOURS * 3600,
+            publish_root)
+
+    manifest = {
+        'dt_published': datetime.datetime.now(pytz.utc).isoformat(),
+        'artifacts': artifacts,
+        'superseded': superseded,
+    }
+    os.makedirs(os.path.dirname(manifest_file) or '.', exist_ok=True)
+    with open(f"{manifest_file}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+    return manifest
+
+
+def load_manifest(manifest_file=None):
+    """Return the current manifest. Only reads the file again when it's
+    been replaced.
+    """
+    manifest_file = manifest_file if manifest_file else get_path(
+            MANIFEST_FILE)
+    try:
+        mtime = os.stat(manifest_file).st_mtime_ns
+    except FileNotFoundError:
+        return {'dt_published': None, 'artifacts': {}, 'superseded': {}}
+
+    loaded = _loaded.get(manifest_file)
+    if loaded and loaded[0] == mtime:
+        return loaded[1]
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    _loaded[manifest_file] = (mtime, manifest)
+    return manifest
+
+
+def get_versioned_name(name, manifest_file=None):
+    """Return the published name for a plot. Before anything has been
+    published, this is just the plot's name.
+    """
+    return load_manifest(manifest_file)['artifacts'].get(name, name)
+
+
+def write_compressed_variants(path):
+    """Write gzip and brotli variants of a file, next to the file. A
+    variant that doesn't save anything is skipped.
+    """
+    import brotli
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    # mtime=0 keeps the gzip output the same for the same file.
+    variants = {
+        '.gz': gzip.compress(data, compresslevel=9, mtime=0),
+        '.br': brotli.compress(data, quality=11),
+    }
+    for ext, compressed in variants.items():
+        if len(compressed) < len(data):
+            with open(f"{path}{ext}.tmp", 'wb') as f:
+                f.write(compressed)
+            os.replace(f"{path}{ext}.tmp", f"{path}{ext}")
+
+
+def get_encoded_file(path, accept_encoding=''):
+    """Return the variant of a file that the client prefers, and its
+    encoding. The encoding is None for the file itself. Variants the client
+    gives the same quality are chosen in the order of ENCODINGS. The file
+    itself is only preferred if the client lists identity above the
+    encodings it accepts.
+    """
+    qualities = parse_accept_encoding(accept_encoding)
+    best_path, best_encoding = path, None
+    best_q = qualities.get('identity', 0)
+    for encoding, ext in ENCODINGS:
+        q = qualities.get(encoding, qualities.get('*', 0))
+        if q > best_q and os.path.exists(f"{path}{ext}"):
+            best_path, best_encoding, best_q = f"{path}{ext}", encoding, q
+    return best_path, best_encoding
+
+
+def parse_accept_encoding(accept_encoding):
+    """Return the quality the client gave each encoding in an
+    Accept-Encoding header. q=0 means the client refuses the encoding.
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        encoding, _, params = item.partition(';')
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[encoding] = q
+    return qualities
+
+
+def get_publish_dir(name, publish_root=''):
+    """Return the directory a plot is published to."""
+    return get_path(FRAGMENT_DIR if name.endswith('.html') else IMAGE_DIR,
+            publish_root)
+
+
+def is_versioned_name(name):
+    return bool(VERSIONED_NAME.match(name))
+
+
+def _remove_superseded(superseded, cutoff, publish_root=''):
+    """Remove files that were superseded before cutoff.
+    Returns the files that are still waiting to be removed.
+    """
+    remaining = {}
+    for name, ts in superseded.items():
+        if ts >= cutoff:
+            remaining[name] = ts
+            continue
+        path = os.path.join(get_publish_dir(name, publish_root), name)
+        for variant in [path] + [f"{path}{ext}" for _, ext in ENCODINGS]:
+            if os.path.exists(variant):
+                os.remove(variant)
+    return remaining
@@ -0,0 +1,148 @@
+"""Backfill the reading archive from USGS.
+
+A date range is split into chunks of days, and the chunks are fetched
+concurrently, with a small cap on concurrent requests so we're polite to
+the USGS servers. Each chunk is parsed and merged into the archive as
+soon as it arrives, and then recorded in a checkpoint file, so an
+interrupted backfill picks up where it left off.
+"""
+
+import datetime, json, os, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import margin_utils, quality_utils, reading_archive, resample_utils
+from utils import rollup_utils, single_flight
+
+
+CHECKPOINT_FILE = 'historical_data/backfill_checkpoint.json'
+
+CHUNK_DAYS = 30
+CONCURRENCY = 4
+# Never run more requests than this at once, whatever's requested.
+MAX_CONCURRENCY = 8
+
+MAX_ATTEMPTS = 3
+# Seconds to wait before the first retry; each retry waits twice as long.
+BACKOFF_SECONDS = 2
+REQUEST_TIMEOUT = 60
+
+
+def get_chunks(date_start, date_end, chunk_days=CHUNK_DAYS):
+    """Split the dates from date_start to date_end, inclusive, into
+    (first_date, last_date) chunks of at most chunk_days days.
+    """
+    chunks = []
+    chunk_start = date_start
+    while chunk_start <= date_end:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days - 1),
+                date_end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+    return chunks
+
+
+def get_chunk_key(chunk):
+    return f"{chunk[0].isoformat()}_{chunk[1].isoformat()}"
+
+
+def load_checkpoint(checkpoint_file=CHECKPOINT_FILE):
+    """Return the set of chunk keys that have already been backfilled."""
+    if not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file) as f:
+        return set(json.load(f)['completed'])
+
+
+def save_checkpoint(completed, checkpoint_file=CHECKPOINT_FILE):
+    """Write the completed chunk keys, replacing the old file atomically."""
+    os.makedirs(os.path.dirname(checkpoint_file) or '.', exist_ok=True)
+    tmp_filename = f"{checkpoint_file}.tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump({'completed': sorted(completed)}, f, indent=2)
+    os.replace(tmp_filename, checkpoint_file)
+
+
+def fetch_chunk(chunk, base_url=a_utils.USGS_URL, session=None):
+    """Fetch one chunk of readings from USGS.
+    Returns cleaned timestamp and height arrays.
+    """
+    import requests
+
+    usgs_url = a_utils.get_usgs_url(chunk[0].isoformat(),
+            chunk[1].isoformat(), base_url)
+    session = session if session else requests
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            r = session.get(usgs_url, timeout=REQUEST_TIMEOUT)
+            r.raise_for_status()
+        except requests.RequestException:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            # Back off before trying again.
+            time.sleep(BACKOFF_SECONDS * 2 ** (attempt - 1))
+        else:
+            break
+
+    readings = a_utils.parse_usgs_data(r.text.splitlines())
+    timestamps, heights = resample_utils.readings_to_arrays(readings)
+    kept_indices, _, _ = quality_utils.clean_arrays(timestamps, heights)
+    return timestamps[kept_indices], heights[kept_indices]
+
+
+def backfill(date_start, date_end, chunk_days=CHUNK_DAYS,
+        concurrency=CONCURRENCY, base_url=a_utils.USGS_URL,
+        archive_dir=reading_archive.ARCHIVE_DIR,
+        checkpoint_file=CHECKPOINT_FILE, lease=None):
+    """Fetch every chunk between two dates that isn't already in the
+    checkpoint, and merge the readings into the archive.
+    lease is the single_flight.Lease held while writing the archive. It's
+      checked before each chunk is merged; if it's been lost, the chunks
+      that haven't started are cancelled, and LeaseLostError is raised.
+    Returns the number of readings saved.
+    """
+    completed = load_checkpoint(checkpoint_file)
+    chunks = [c for c in get_chunks(date_start, date_end, chunk_days)
+                if get_chunk_key(c) not in completed]
+    print(f"Backfilling {len(chunks)} chunks, {len(completed)} already done.")
+
+    concurrency = max(1, min(concurrency, MAX_CONCURRENCY))
+    today = datetime.datetime.now(pytz.timezone('US/Alaska')).date()
+    num_readings = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(fetch_chunk, chunk, base_url): chunk
+                    for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            key = get_chunk_key(chunk)
+            try:
+                timestamps, heights = future.result()
+            except Exception as e:
+                # Leave it out of the checkpoint, so the next run retries it.
+                print(f"  failed: {key} ({e})")
+                continue
+
+            if lease:
+                try:
+                    lease.check()
+                except single_flight.LeaseLostError:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+
+            # Only this thread writes to the archive and the checkpoint.
+            if len(timestamps):
+                reading_archive.save_arrays(timestamps, heights, archive_dir)
+                rollup_utils.update_rollups(timestamps, heights, archive_dir)
+                margin_utils.update_margins(timestamps, heights, archive_dir)
+            num_readings += len(timestamps)
+            # A chunk that runs up to today isn't finished yet.
+            if chunk[1] < today:
+                completed.add(key)
+                save_checkpoint(completed, checkpoint_file)
+            print(f"  saved: {key}, {len(timestamps)} readings")
+
+    return num_readings
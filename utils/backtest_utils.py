@@ -0,0 +1,134 @@
+"""Backtest critical thresholds against known slides.
+
+Every combination of thresholds in a grid is run over the full history,
+and scored against a list of known slide times. Each worker process
+receives the resampled history once, and then evaluates configurations
+with the same array code used for live detection.
+"""
+
+import itertools, os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import utils.analysis_utils as a_utils
+from utils import critical_rules, resample_utils
+
+
+# A slide counts as a hit if it happens within this many hours after the
+#   onset of a critical event.
+WARNING_HOURS = 12
+
+# The grid that gives the thresholds currently in use. A lookback of None
+#   means RISE_CRITICAL / M_CRITICAL hours, rounded up.
+DEFAULT_GRID = {
+    'rise_critical': [a_utils.RISE_CRITICAL],
+    'm_critical': [a_utils.M_CRITICAL],
+    'lookback_hours': [None],
+    'suppression_hours': [a_utils.EVENT_SUPPRESSION_HOURS],
+}
+
+
+def get_configs(grid):
+    """Return a list of config dicts, one for every combination in grid.
+    Any parameter missing from grid uses its current value.
+    """
+    grid = {**DEFAULT_GRID, **grid}
+    names = list(DEFAULT_GRID.keys())
+    return [dict(zip(names, values))
+                for values in itertools.product(*(grid[n] for n in names))]
+
+
+def evaluate_config(series, slide_timestamps, config,
+        warning_hours=WARNING_HOURS):
+    """Run one configuration over a RegularSeries, and score it against
+    sorted slide timestamps (epoch seconds).
+    Returns a dict with the config and its results.
+    """
+    rule = critical_rules.CriticalRule('backtest',
+            rise=config['rise_critical'], rate=config['m_critical'],
+            lookback_hours=config['lookback_hours'])
+    critical = a_utils.get_critical_mask(series, [rule])
+    critical_timestamps = series.timestamps[critical]
+    onset_indices = a_utils.get_onset_indices(critical_timestamps,
+            config['suppression_hours'])
+    onsets = critical_timestamps[onset_indices]
+
+    # Match every slide to the most recent onset before it.
+    prev_onset = np.searchsorted(onsets, slide_timestamps, side='right') - 1
+    if len(onsets):
+        lead_seconds = slide_timestamps - onsets[np.maximum(prev_onset, 0)]
+    else:
+        lead_seconds = np.zeros(len(slide_timestamps), dtype=np.int64)
+    hit = (prev_onset >= 0) & (lead_seconds <= warning_hours * 3600)
+    num_warned_events = len(np.unique(prev_onset[hit]))
+
+    lead_times = lead_seconds[hit] / 3600
+    results = dict(config)
+    results.update({
+        'events': len(onsets),
+        'hits': int(hit.sum()),
+        'misses': int((~hit).sum()),
+        'false_alarms': len(onsets) - num_warned_events,
+        'lead_times': [round(float(lt), 2) for lt in lead_times],
+        'mean_lead_time': round(float(lead_times.mean()), 2) if len(lead_times) else None,
+    })
+    return results
+
+
+def run_backtest(readings, slide_times, grid=None,
+        warning_hours=WARNING_HOURS, workers=None):
+    """Evaluate every combination of thresholds in grid over readings.
+
+    slide_times is a list of aware datetimes. grid maps parameter names to
+      lists of values; see DEFAULT_GRID.
+    Uses a pool of worker processes; workers=1 runs everything in this
+      process.
+    Returns a list of result dicts, best first.
+    """
+    series = resample_utils.resample_readings(readings)
+    slide_timestamps = np.sort(np.array(
+            [int(dt.timestamp()) for dt in slide_times], dtype=np.int64))
+    configs = get_configs(grid if grid else {})
+
+    if workers == 1:
+        results = [evaluate_config(series, slide_timestamps, config,
+                        warning_hours) for config in configs]
+    else:
+        workers = workers if workers else os.cpu_count()
+        chunksize = max(1, len(configs) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers,
+                initializer=_init_worker,
+                initargs=(series, slide_timestamps, warning_hours)) as executor:
+            results = list(executor.map(_evaluate_in_worker, configs,
+                    chunksize=chunksize))
+
+    results.sort(key=lambda r: (-r['hits'], r['false_alarms']))
+    return results
+
+
+def print_backtest_results(results, max_rows=20):
+    """Print a neat table of backtest results."""
+    print(f"{'rise':>6} {'m':>6} {'lookback':>8} {'suppress':>8} "
+            f"{'events':>6} {'hits':>4} {'misses':>6} {'false':>5} {'lead (hrs)':>10}")
+    for r in results[:max_rows]:
+        lookback = r['lookback_hours'] if r['lookback_hours'] is not None else '-'
+        lead = r['mean_lead_time'] if r['mean_lead_time'] is not None else '-'
+        print(f"{r['rise_critical']:>6} {r['m_critical']:>6} {lookback:>8} "
+                f"{r['suppression_hours']:>8} {r['events']:>6} {r['hits']:>4} "
+                f"{r['misses']:>6} {r['false_alarms']:>5} {lead:>10}")
+
+
+# Each worker process keeps its own copy of the history, so it's only
+#   sent once per process rather than once per configuration.
+_worker_state = {}
+
+def _init_worker(series, slide_timestamps, warning_hours):
+    _worker_state['series'] = series
+    _worker_state['slide_timestamps'] = slide_timestamps
+    _worker_state['warning_hours'] = warning_hours
+
+def _evaluate_in_worker(config):
+    return evaluate_config(_worker_state['series'],
+            _worker_state['slide_timestamps'], config,
+            _worker_state['warning_hours'])
@@ -0,0 +1,200 @@
+"""Rules for critical conditions, and the engine that evaluates them.
+
+A rule is data: a rise within a lookback window, optionally at a minimum
+average rate, or an absolute stage. The river is critical at a reading
+when any rule in RULES is met there. More rules can run side by side by
+adding them to RULES, ie:
+
+    CriticalRule('fast_rise', rise=1.5, rate=0.5, lookback_hours=3),
+    CriticalRule('flood_stage', stage=26.0),
+
+All rules are evaluated in one pass over the series. Each lag, up to the
+longest lookback, is visited once. The rise and rate into every slot are
+computed once per lag, and compared against the thresholds of every rule
+that looks back that far in a single broadcast comparison. Another rule
+adds a row to that comparison, not another pass over the series.
+
+Results are kept per rule, so plots and alerts can show which rule was
+met, as well as whether any was. A refresh evaluates the rules once, and
+passes the results to everything that needs them.
+"""
+
+import math
+
+import numpy as np
+
+
+# Critical values.
+# Critical rise in feet. Critical slope, in ft/hr.
+RISE_CRITICAL = 2.5
+M_CRITICAL = 0.5
+
+
+class CriticalRule:
+    """One rule for critical conditions.
+
+    A rise rule is met at a reading at least rise ft above some reading
+      within lookback_hours, at an average rate greater than rate ft/hr.
+      Without a rate, any rise that large counts. The lookback defaults to
+      rise / rate hours, rounded up.
+    A stage rule is met at any reading at or above stage ft.
+    """
+
+    def __init__(self, name, rise=None, rate=None, lookback_hours=None,
+            stage=None):
+        if (rise is None) == (stage is None):
+            raise ValueError(f"Rule {name} needs either a rise or a stage.")
+        if rise is not None and lookback_hours is None:
+            if not rate:
+                raise ValueError(f"Rule {name} needs a rate or a lookback.")
+            lookback_hours = math.ceil(rise / rate)
+
+        self.name = name
+        self.rise = rise
+        self.rate = rate
+        self.lookback_hours = lookback_hours
+        self.stage = stage
+
+    def __repr__(self):
+        return f"CriticalRule({self.name!r})"
+
+    @property
+    def is_stage_rule(self):
+        return self.stage is not None
+
+    def get_max_lag(self, interval):
+        """Return how many slots back this rule looks, in a series with
+        slots interval seconds apart.
+        """
+        if self.is_stage_rule:
+            return 0
+        return int(math.ceil(self.lookback_hours * 3600 / interval))
+
+    def get_description(self):
+        if self.is_stage_rule:
+            return f"stage at or above {self.stage:g} ft"
+        description = f"{self.rise:g} ft rise within {self.lookback_hours:g} hours"
+        if self.rate:
+            description += f" at over {self.rate:g} ft/hr"
+        return description
+
+
+# The sustained rise rule is the original definition of critical.
+RULES = [
+    CriticalRule('sustained_rise', rise=RISE_CRITICAL, rate=M_CRITICAL),
+]
+
+
+class RuleResults:
+    """The result of evaluating a set of rules over a series.
+
+    Each array has one row per rule, in the order of the rules, and the
+      shape of the heights after that.
+    critical marks where each rule is met. With details, margin is the
+      extra height each slot needed to meet the rule, and max_rise and
+      max_rate are the largest rise and steepest rate into each slot from
+      within the rule's lookback. Without details, these are None.
+    series is the RegularSeries that was evaluated, if there was one.
+    """
+
+    def __init__(self, rules, critical, margin=None, max_rise=None,
+            max_rate=None, series=None):
+        self.rules = rules
+        self.critical = critical
+        self.margin = margin
+        self.max_rise = max_rise
+        self.max_rate = max_rate
+        self.series = series
+
+    @property
+    def any_critical(self):
+        """Where any rule is met."""
+        return self.critical.any(axis=0)
+
+    def get_rule_index(self, name):
+        for index, rule in enumerate(self.rules):
+            if rule.name == name:
+                return index
+        raise KeyError(name)
+
+    def get_critical_by_rule(self):
+        """Return a dict of each rule's name, and where it's met."""
+        return {rule.name: self.critical[index]
+                    for index, rule in enumerate(self.rules)}
+
+
+def evaluate_heights(heights, interval, rules=None, details=False):
+    """Evaluate rules over heights at a fixed interval in seconds, in one
+    pass. heights can have more than one dimension, ie a set of simulated
+    paths; time runs along the last axis. Returns a RuleResults.
+    """
+    rules = rules if rules is not None else RULES
+    heights = np.asarray(heights, dtype=np.float64)
+    shape = (len(rules),) + heights.shape
+    critical = np.zeros(shape, dtype=bool)
+    margin = max_rise = max_rate = None
+    if details:
+        margin = np.full(shape, np.nan)
+        max_rise = np.full(shape, np.nan)
+        max_rate = np.full(shape, np.nan)
+
+    for index, rule in enumerate(rules):
+        if rule.is_stage_rule:
+            critical[index] = heights >= rule.stage
+            if details:
+                margin[index] = rule.stage - heights
+
+    # Thresholds of the rise rules, as columns to broadcast against.
+    rows = np.array([index for index, rule in enumerate(rules)
+                        if not rule.is_stage_rule], dtype=np.int64)
+    if not len(rows):
+        return RuleResults(rules, critical, margin, max_rise, max_rate)
+    column = (slice(None),) + (np.newaxis,) * heights.ndim
+    rise_critical = np.array([rules[i].rise for i in rows])[column]
+    m_critical = np.array([rules[i].rate if rules[i].rate else -np.inf
+                                for i in rows])[column]
+    max_lags = np.array([rules[i].get_max_lag(interval) for i in rows])
+
+    interval_hr = interval / 3600
+    num_slots = heights.shape[-1]
+    for lag in range(1, min(max_lags.max(), num_slots - 1) + 1):
+        rise = heights[..., lag:] - heights[..., :-lag]
+        m = rise / (lag * interval_hr)
+        active = max_lags >= lag
+        active_rows = rows[active]
+        critical[active_rows, ..., lag:] |= ((rise >= rise_critical[active])
+                & (m > m_critical[active]))
+        if details:
+            # The extra height needed to meet both the rise and the rate.
+            needed = np.fmax(rise_critical[active] - rise,
+                    m_critical[active] * lag * interval_hr - rise)
+            margin[active_rows, ..., lag:] = np.fmin(
+                    margin[active_rows, ..., lag:], needed)
+            max_rise[active_rows, ..., lag:] = np.fmax(
+                    max_rise[active_rows, ..., lag:], rise)
+            max_rate[active_rows, ..., lag:] = np.fmax(
+                    max_rate[active_rows, ..., lag:], m)
+
+    return RuleResults(rules, critical, margin, max_rise, max_rate)
+
+
+def evaluate_series(series, rules=None, details=False):
+    """Evaluate rules over a RegularSeries. Returns a RuleResults.
+
+    Gaps never compare as critical, and interpolated slots can serve as a
+      starting point but are never critical themselves.
+    """
+    results = evaluate_heights(series.heights, series.interval, rules,
+            details)
+    results.critical &= series.source_index >= 0
+    results.series = series
+    return results
+
+
+def get_lookback_hours(rules=None):
+    """Return the longest lookback of any rule, in whole hours. Readings
+    this far back can affect whether a reading is critical.
+    """
+    rules = rules if rules is not None else RULES
+    return math.ceil(max([rule.lookback_hours for rule in rules
+                            if not rule.is_stage_rule], default=0))
@@ -0,0 +1,143 @@
+"""Downsampling for long-range plots.
+
+A season of 15-minute readings is tens of thousands of points, and several
+years is hundreds of thousands. That's far more than a browser can plot
+smoothly, and far more than a screen can show. These functions pick a few
+thousand points that keep the shape of the series, so that rises, peaks,
+and drops all survive. The long-range view starts with an overview of the
+whole archive, and asks for a new set of points for each zoomed range.
+"""
+
+import numpy as np
+
+from utils import reading_archive, rollup_utils, time_utils
+
+
+# The browser never gets more points than this for one view.
+MAX_POINTS = 2000
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+
+def lttb(timestamps, heights, num_points):
+    """Largest-triangle-three-buckets downsampling.
+
+    Keeps the first and last points, and from each bucket in between keeps
+      the point that forms the largest triangle with the point kept from
+      the previous bucket and the average of the next bucket. This keeps
+      peaks and sharp turns, and drops points on straight runs.
+    Returns the indices of the points to keep.
+    """
+    n = len(timestamps)
+    if num_points >= n:
+        return np.arange(n)
+    if num_points < 3:
+        return np.array([0, n - 1][:num_points], dtype=np.int64)
+
+    # Work relative to the first timestamp, so the areas don't lose
+    #   precision.
+    x = (timestamps - timestamps[0]).astype(np.float64)
+    y = np.asarray(heights, dtype=np.float64)
+
+    # Buckets for everything but the first and last points. The last
+    #   bucket is followed by the last point on its own.
+    num_buckets = num_points - 2
+    every = (n - 2) / num_buckets
+    edges = (np.arange(num_buckets + 1) * every).astype(np.int64) + 1
+    edges = np.append(edges, n)
+    sizes = np.diff(edges)
+    avg_x = (np.add.reduceat(x, edges[:-1]) / sizes)[1:]
+    avg_y = (np.add.reduceat(y, edges[:-1]) / sizes)[1:]
+
+    # One row of indices per bucket. Short buckets repeat their last
+    #   point, which never wins over the point itself.
+    width = sizes[:num_buckets].max()
+    rows = np.minimum(edges[:num_buckets, None] + np.arange(width),
+            edges[1:num_buckets + 1, None] - 1)
+    bucket_x, bucket_y = x[rows], y[rows]
+
+    # The point kept from each bucket depends on the point kept from the
+    #   bucket before it, so only this step runs a bucket at a time.
+    kept = np.empty(num_points, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    prev_x, prev_y = x[0], y[0]
+    for b in range(num_buckets):
+        areas = np.abs((prev_x - avg_x[b]) * (bucket_y[b] - prev_y)
+                - (prev_x - bucket_x[b]) * (avg_y[b] - prev_y))
+        i = areas.argmax()
+        kept[b + 1] = rows[b, i]
+        prev_x, prev_y = bucket_x[b, i], bucket_y[b, i]
+
+    return kept
+
+
+def min_max(timestamps, heights, num_points):
+    """Min/max bucket downsampling.
+
+    Splits the points into buckets, and keeps the lowest and highest point
+      in each bucket, along with the first and last points. Every extreme
+      survives, which matters more than a smooth line when looking for the
+      biggest rises.
+    Returns the indices of the points to keep, in order.
+    """
+    n = len(timestamps)
+    num_buckets = (num_points - 2) // 2
+    if num_points >= n:
+        return np.arange(n)
+    if num_buckets < 1:
+        # Too few points for a bucket; keep the largest triangle instead.
+        return lttb(timestamps, heights, num_points)
+
+    # Pad the last bucket with the final height, so every bucket is full.
+    bucket_size = -(-n // num_buckets)
+    padded = np.full(num_buckets * bucket_size, heights[-1], dtype=np.float64)
+    padded[:n] = heights
+    buckets = padded.reshape(num_buckets, bucket_size)
+
+    offsets = np.arange(num_buckets) * bucket_size
+    kept = np.concatenate(([0, n - 1], offsets + buckets.argmin(axis=1),
+            offsets + buckets.argmax(axis=1)))
+    return np.unique(np.minimum(kept, n - 1))
+
+
+def downsample(timestamps, heights, max_points=MAX_POINTS, method='lttb'):
+    """Return at most max_points timestamps and heights, chosen so the
+    shape of the series is kept.
+    """
+    if len(timestamps) <= max_points:
+        return timestamps, heights
+    if method == 'minmax':
+        kept = min_max(timestamps, heights, max_points)
+    else:
+        kept = lttb(timestamps, heights, max_points)
+    return timestamps[kept], heights[kept]
+
+
+def get_long_range_data(dt_start=None, dt_end=None, max_points=MAX_POINTS,
+        method='lttb', archive_dir=reading_archive.ARCHIVE_DIR):
+    """Return downsampled archive readings from dt_start to dt_end, ready
+    to send to plotly. Either end can be left open.
+
+    Long ranges are read from the hourly rollups, using the lowest and
+      highest reading in each hour, so a multi-year view reads tens of
+      thousands of rows rather than hundreds of thousands of readings.
+    Returns a dict with x as local time strings, y as heights, and the
+      number of readings the points were chosen from.
+    """
+    rollups = rollup_utils.load_rollups('hourly', dt_start, dt_end,
+            rollup_utils.get_rollup_dir(archive_dir))
+    if 2 * len(rollups) > max_points:
+        timestamps = np.concatenate((rollups['min_ts'], rollups['max_ts']))
+        heights = np.concatenate((rollups['min'], rollups['max']))
+        timestamps, kept = np.unique(timestamps, return_index=True)
+        heights = heights[kept]
+        num_readings = int(rollups['count'].sum())
+    else:
+        timestamps, heights = reading_archive.load_arrays(dt_start, dt_end,
+                archive_dir)
+        num_readings = len(timestamps)
+    timestamps, heights = downsample(timestamps, heights, max_points, method)
+
+    # Plotly considers everything UTC. Send it local time strings, and it
+    #   will plot the dates as they read.
+    x = time_utils.to_local_strings(timestamps).tolist()
+    return {'x': x, 'y': heights.tolist(), 'num_readings': num_readings}
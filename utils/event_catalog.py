@@ -0,0 +1,276 @@
+"""Catalog of historical critical events.
+
+Finding the events in a long archive means running the critical point
+detector over every reading, and then searching the archive for each
+event's window. The catalog does that work once, stores a summary of each
+event, and only looks at new readings when it's updated.
+
+The catalog is tied to one archive of readings: a chronological list that
+only ever grows at the end. Window bounds are stored as indices into that
+list. Each refresh updates the catalog from the end of the archive, so only
+the last few days are ever loaded; a backfill, which can add readings
+anywhere, rebuilds it.
+"""
+
+import datetime, json, os
+
+import pytz
+import numpy as np
+
+import utils.analysis_utils as a_utils
+from utils import critical_rules, reading_archive, resample_utils
+
+
+aktz = pytz.timezone('US/Alaska')
+
+CATALOG_FILE = 'historical_data/event_catalog.json'
+
+# Hours of readings on either side of an event's onset, for its window.
+WINDOW_HOURS = 24
+
+
+class CriticalEvent:
+    """Summary of a single critical event.
+    All times are stored as epoch seconds.
+    """
+
+    def __init__(self, onset_ts, peak_ts, peak_rise, end_ts,
+            window_start_index=0, window_end_index=0):
+        self.onset_ts = onset_ts
+        self.peak_ts = peak_ts
+        self.peak_rise = peak_rise
+        self.end_ts = end_ts
+        self.window_start_index = window_start_index
+        self.window_end_index = window_end_index
+
+    @property
+    def dt_onset(self):
+        return _ts_to_dt(self.onset_ts)
+
+    @property
+    def dt_peak(self):
+        return _ts_to_dt(self.peak_ts)
+
+    @property
+    def dt_end(self):
+        return _ts_to_dt(self.end_ts)
+
+    @property
+    def duration(self):
+        """Time from the first to the last critical reading in the event."""
+        return datetime.timedelta(seconds=self.end_ts - self.onset_ts)
+
+    @property
+    def window_start_ts(self):
+        return self.onset_ts - WINDOW_HOURS * 3600
+
+    @property
+    def window_end_ts(self):
+        return self.onset_ts + WINDOW_HOURS * 3600
+
+    @property
+    def year(self):
+        """Year of the onset, in local time."""
+        return self.dt_onset.astimezone(aktz).year
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, event_dict):
+        return cls(**event_dict)
+
+    def get_formatted_event(self):
+        """Print a neat string of the event."""
+        dt = self.dt_onset.astimezone(aktz).strftime('%m/%d/%Y %H:%M:%S')
+        hours = self.duration.total_seconds() / 3600
+        return f"{dt} - rise {self.peak_rise:.2f} ft, {hours:.2f} hrs"
+
+
+class EventCatalog:
+    """All critical events found in an archive of readings."""
+
+    def __init__(self, events=None, last_ts=None, num_readings=0):
+        self.events = events if events else []
+        # Timestamp of the last reading scanned, and how many readings
+        #   have been scanned.
+        self.last_ts = last_ts
+        self.num_readings = num_readings
+
+        self._build_year_index()
+
+    def __len__(self):
+        return len(self.events)
+
+    def get_event(self, event_number):
+        """Return the event with this number. Events are numbered from 0,
+        in chronological order.
+        """
+        return self.events[event_number]
+
+    def get_events_for_year(self, year):
+        """Return all events with an onset in this year, local time."""
+        return [self.events[i] for i in self._events_by_year.get(year, [])]
+
+    def get_window(self, event_number, readings):
+        """Return the readings within WINDOW_HOURS of the event's onset.
+        readings must be the archive this catalog was built from.
+        """
+        event = self.events[event_number]
+        return readings[event.window_start_index:event.window_end_index]
+
+    def update(self, readings, start_index=0):
+        """Scan any readings added to the archive since the last update.
+        readings can be the end of the archive, starting at start_index, as
+          long as it reaches back get_context_seconds() before the last
+          update.
+        Returns a list of new or changed events.
+        """
+        if start_index + len(readings) <= self.num_readings:
+            return []
+
+        # An event that started recently can still pick up critical points
+        #   from new readings. Drop it and find it again.
+        group_seconds = _get_group_seconds()
+        scan_from_ts = self.last_ts
+        if self.events and self.last_ts - self.events[-1].onset_ts < group_seconds:
+            scan_from_ts = self.events[-1].onset_ts - 1
+            self.events.pop()
+
+        # Include enough earlier readings for the detector to look back on.
+        if scan_from_ts is None:
+            context_index = 0
+        else:
+            lookback_seconds = _get_lookback_seconds()
+            context_index = _bisect_readings(readings,
+                    scan_from_ts - lookback_seconds)
+        context = readings[context_index:]
+
+        series = resample_utils.resample_readings(context)
+        critical = a_utils.get_critical_mask(series)
+        max_rise = a_utils.get_max_rise(series)
+
+        new_events = []
+        event = None
+        for slot in np.flatnonzero(critical):
+            reading = context[series.source_index[slot]]
+            ts = int(reading.dt_reading.timestamp())
+            if scan_from_ts is not None and ts <= scan_from_ts:
+                continue
+            rise = float(max_rise[slot])
+
+            if event and ts - event.onset_ts < group_seconds:
+                event.end_ts = ts
+                if rise > event.peak_rise:
+                    event.peak_ts, event.peak_rise = ts, rise
+            else:
+                event = CriticalEvent(ts, ts, rise, ts)
+                new_events.append(event)
+
+        # Windows that ran past the end of the archive can be extended now.
+        prev_last_ts = self.last_ts
+        changed_events = [e for e in self.events
+                            if e.window_end_ts > prev_last_ts]
+        for event in changed_events + new_events:
+            event.window_start_index = start_index + _bisect_readings(
+                    readings, event.window_start_ts)
+            event.window_end_index = start_index + _bisect_readings(
+                    readings, event.window_end_ts)
+
+        self.events += new_events
+        self.last_ts = int(readings[-1].dt_reading.timestamp())
+        self.num_readings = start_index + len(readings)
+        self._build_year_index()
+
+        return changed_events + new_events
+
+    def update_from_archive(self, archive_dir=reading_archive.ARCHIVE_DIR):
+        """Scan any readings added to the archive since the last update,
+        loading only the end of the archive. Returns a list of new or
+        changed events.
+        """
+        if self.last_ts is None:
+            return self.update(reading_archive.load_readings(
+                    archive_dir=archive_dir))
+
+        dt_start = _ts_to_dt(self.last_ts - get_context_seconds())
+        timestamps, heights = reading_archive.load_arrays(dt_start,
+                archive_dir=archive_dir)
+        # Readings up to the last update were all counted before, so the
+        #   index of the first loaded reading follows from how many of
+        #   them were loaded again.
+        num_seen = int(np.searchsorted(timestamps, self.last_ts, side='right'))
+        return self.update(
+                resample_utils.arrays_to_readings(timestamps, heights),
+                start_index=self.num_readings - num_seen)
+
+    def save(self, filename=CATALOG_FILE):
+        """Write the catalog to a json file."""
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        catalog_dict = {
+            'last_ts': self.last_ts,
+            'num_readings': self.num_readings,
+            'events': [event.to_dict() for event in self.events],
+        }
+        # Write to a temp file and rename, so readers never see a partly
+        #   written catalog.
+        with open(f"{filename}.tmp", 'w') as f:
+            json.dump(catalog_dict, f, indent=2)
+        os.replace(f"{filename}.tmp", filename)
+
+    @classmethod
+    def load(cls, filename=CATALOG_FILE):
+        """Read a catalog from a json file."""
+        with open(filename) as f:
+            catalog_dict = json.load(f)
+        events = [CriticalEvent.from_dict(e) for e in catalog_dict['events']]
+        return cls(events, catalog_dict['last_ts'],
+                catalog_dict['num_readings'])
+
+    def _build_year_index(self):
+        self._events_by_year = {}
+        for event_number, event in enumerate(self.events):
+            self._events_by_year.setdefault(event.year, []).append(event_number)
+
+
+def load_catalog(filename=CATALOG_FILE):
+    """Load a saved catalog, or start an empty one if there isn't one yet."""
+    if not os.path.exists(filename):
+        return EventCatalog()
+    return EventCatalog.load(filename)
+
+
+def get_context_seconds():
+    """Return how far back from the last update an update can look: far
+    enough to find a recent event again, and to extend the windows of
+    events near the end of the archive.
+    """
+    return max(_get_group_seconds() + _get_lookback_seconds(),
+            2 * WINDOW_HOURS * 3600)
+
+
+def _get_group_seconds():
+    """Critical points this close together belong to one event."""
+    return (a_utils.EVENT_SUPPRESSION_HOURS + 1) * 3600
+
+
+def _get_lookback_seconds():
+    """How far back the detector looks, plus a gap it interpolates over."""
+    return (critical_rules.get_lookback_hours() * 3600
+            + resample_utils.MAX_GAP_MINUTES * 60)
+
+
+def _ts_to_dt(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=pytz.utc)
+
+
+def _bisect_readings(readings, ts):
+    """Return the index of the first reading at or after ts."""
+    lo, hi = 0, len(readings)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if readings[mid].dt_reading.timestamp() < ts:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
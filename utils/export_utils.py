@@ -0,0 +1,189 @@
+"""Columnar export of the gauge history, for analysts.
+
+The cleaned readings, with a flag marking critical readings, and the event
+catalog are written as Parquet and as Arrow IPC files. Neither needs this
+codebase to read.
+
+Readings are written one archive month at a time, so each month is its own
+Parquet row group and Arrow record batch. A Parquet reader with a time range
+filter skips every month outside the range using the row group statistics,
+without reading it. An Arrow file is uncompressed, so it can be
+memory-mapped and read into numpy without copying:
+
+    import pyarrow as pa
+    table = pa.ipc.open_file(pa.memory_map('readings.arrow')).read_all()
+    heights = table['height'].to_numpy()
+"""
+
+import datetime, io, os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import critical_rules, event_catalog, reading_archive
+from utils import resample_utils
+
+
+EXPORT_DIR = 'historical_data/exports'
+FORMATS = ('parquet', 'arrow')
+TABLES = ('readings', 'events')
+
+READINGS_SCHEMA = pa.schema([
+    ('ts', pa.timestamp('s', tz='UTC')),
+    ('height', pa.float64()),
+    ('critical', pa.bool_()),
+])
+
+EVENTS_SCHEMA = pa.schema([
+    ('onset_ts', pa.timestamp('s', tz='UTC')),
+    ('peak_ts', pa.timestamp('s', tz='UTC')),
+    ('end_ts', pa.timestamp('s', tz='UTC')),
+    ('peak_rise', pa.float64()),
+    ('duration_hours', pa.float64()),
+])
+
+
+def get_readings_batches(dt_start=None, dt_end=None,
+        archive_dir=reading_archive.ARCHIVE_DIR):
+    """Return archived readings from dt_start to dt_end, with critical
+    flags, as one record batch per archive month.
+    """
+    # Critical flags near dt_start depend on readings before it.
+    lookback = datetime.timedelta(hours=critical_rules.get_lookback_hours())
+    timestamps, heights = reading_archive.load_arrays(
+            dt_start - lookback if dt_start else None, dt_end, archive_dir)
+    critical = get_critical_flags(timestamps, heights)
+
+    first = np.searchsorted(timestamps, dt_start.timestamp()) if dt_start else 0
+    timestamps, heights = timestamps[first:], heights[first:]
+    critical = critical[first:]
+
+    # Split at month boundaries, to match the archive.
+    months = timestamps.astype('datetime64[s]').astype('datetime64[M]')
+    splits = np.flatnonzero(months[1:] != months[:-1]) + 1
+    ts_type = READINGS_SCHEMA.field('ts').type
+    batches = []
+    for lo, hi in zip(np.r_[0, splits], np.r_[splits, len(timestamps)]):
+        if hi > lo:
+            batches.append(pa.record_batch([
+                pa.array(timestamps[lo:hi], type=ts_type),
+                pa.array(heights[lo:hi]),
+                pa.array(critical[lo:hi]),
+            ], schema=READINGS_SCHEMA))
+    return batches
+
+
+def get_critical_flags(timestamps, heights):
+    """Return a boolean array marking the critical readings."""
+    critical = np.zeros(len(timestamps), dtype=bool)
+    if len(timestamps) < 2:
+        return critical
+    series = resample_utils.resample_arrays(timestamps, heights)
+    critical[series.source_index[a_utils.get_critical_mask(series)]] = True
+    return critical
+
+
+def get_events_table(dt_start=None, dt_end=None,
+        catalog_file=event_catalog.CATALOG_FILE):
+    """Return the cataloged events with an onset from dt_start to dt_end."""
+    events = event_catalog.load_catalog(catalog_file).events
+    ts_start = dt_start.timestamp() if dt_start else -np.inf
+    ts_end = dt_end.timestamp() if dt_end else np.inf
+    events = [e for e in events if ts_start <= e.onset_ts <= ts_end]
+
+    ts_type = EVENTS_SCHEMA.field('onset_ts').type
+    return pa.table([
+        pa.array([e.onset_ts for e in events], type=ts_type),
+        pa.array([e.peak_ts for e in events], type=ts_type),
+        pa.array([e.end_ts for e in events], type=ts_type),
+        pa.array([float(e.peak_rise) for e in events], type=pa.float64()),
+        pa.array([e.duration.total_seconds() / 3600 for e in events],
+                type=pa.float64()),
+    ], schema=EVENTS_SCHEMA)
+
+
+def write_batches(sink, batches, schema, export_format):
+    """Write record batches to a file or buffer, one row group or record
+    batch each.
+    """
+    if export_format == 'parquet':
+        with pq.ParquetWriter(sink, schema) as writer:
+            for batch in batches:
+                writer.write_table(pa.Table.from_batches([batch], schema))
+    else:
+        with pa.ipc.new_file(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+
+
+def export_history(export_dir=EXPORT_DIR, formats=FORMATS,
+        dt_start=None, dt_end=None, archive_dir=reading_archive.ARCHIVE_DIR,
+        catalog_file=event_catalog.CATALOG_FILE):
+    """Write the readings and events tables in each format.
+    Returns the files written.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    tables = {
+        'readings': (get_readings_batches(dt_start, dt_end, archive_dir),
+                READINGS_SCHEMA),
+        'events': (get_events_table(dt_start, dt_end,
+                catalog_file).to_batches(), EVENTS_SCHEMA),
+    }
+
+    filenames = []
+    for export_format in formats:
+        for name, (batches, schema) in tables.items():
+            filename = os.path.join(export_dir, f"{name}.{export_format}")
+            # Write to a temp file and rename, so readers never see a
+            #   partly written export.
+            tmp_filename = f"{filename}.tmp"
+            write_batches(tmp_filename, batches, schema, export_format)
+            os.replace(tmp_filename, filename)
+            filenames.append(filename)
+    return filenames
+
+
+def export_to_bytes(table_name, export_format, dt_start=None, dt_end=None,
+        archive_dir=reading_archive.ARCHIVE_DIR,
+        catalog_file=event_catalog.CATALOG_FILE):
+    """Return one table for a time range, as the bytes of a file."""
+    if table_name == 'readings':
+        batches = get_readings_batches(dt_start, dt_end, archive_dir)
+        schema = READINGS_SCHEMA
+    else:
+        batches = get_events_table(dt_start, dt_end, catalog_file).to_batches()
+        schema = EVENTS_SCHEMA
+    sink = io.BytesIO()
+    write_batches(sink, batches, schema, export_format)
+    return sink.getvalue()
+
+
+def read_readings(filename, dt_start=None, dt_end=None):
+    """Read exported readings from dt_start to dt_end, as a pyarrow Table.
+
+    Parquet files only read the row groups that overlap the range. Arrow
+      files are memory-mapped, and the range is a zero-copy slice.
+    """
+    if filename.endswith('.parquet'):
+        filters = []
+        if dt_start:
+            filters.append(('ts', '>=', _to_utc(dt_start)))
+        if dt_end:
+            filters.append(('ts', '<=', _to_utc(dt_end)))
+        return pq.read_table(filename, filters=filters if filters else None)
+
+    table = pa.ipc.open_file(pa.memory_map(filename)).read_all()
+    # Batches are in time order, so the range is a single slice.
+    ts = np.concatenate([np.empty(0, np.int64)] + [
+            chunk.cast(pa.int64()).to_numpy() for chunk in table['ts'].chunks])
+    lo = np.searchsorted(ts, dt_start.timestamp()) if dt_start else 0
+    hi = (np.searchsorted(ts, dt_end.timestamp(), side='right') if dt_end
+            else len(ts))
+    return table.slice(lo, hi - lo)
+
+
+def _to_utc(dt):
+    return dt.astimezone(pytz.utc)
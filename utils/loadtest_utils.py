@@ -0,0 +1,223 @@
+"""Load testing for the site.
+
+Starts the site under gunicorn, the way it's deployed, logs in a set of
+simulated viewers, and has them request a realistic mix of pages and
+assets at each of a series of concurrency levels. Every viewer has its own
+session, and requests the next url as soon as the last one finishes.
+
+The report shows the throughput and latency percentiles of each endpoint
+at each level, so it's easy to see where latency starts to climb.
+"""
+
+import os, random, re, subprocess, sys, threading, time
+
+import numpy as np
+
+
+HOST = '127.0.0.1'
+PORT = 8765
+WORKERS = 3
+CONCURRENCY_LEVELS = [1, 2, 4, 8, 16, 32]
+LEVEL_SECONDS = 20
+REQUEST_TIMEOUT = 30
+PERCENTILES = [50, 95, 99]
+
+LOGIN_PATH = '/users/login/'
+
+# Endpoints, and how often viewers request each one. Pages are what people
+#   open; assets are what those pages load. Asset paths are filled in from
+#   the pages, because they include the current version of each plot.
+TRAFFIC_MIX = [
+    ('index', '/', 5),
+    ('simple plot', '/simple_irg_plot', 10),
+    ('interactive plot', '/irg_critical_forecast_plot_interactive', 15),
+    ('static plot', '/irg_critical_forecast_plot', 15),
+    ('extended plot', '/irg_critical_forecast_plot_extended', 10),
+    ('long-range plot', '/long_range_plot', 5),
+    ('plot fragment', None, 15),
+    ('plot image', None, 15),
+    ('latest json', '/latest.json', 5),
+    ('long-range readings', '/long_range_plot/readings', 5),
+]
+PAGES = ['index', 'simple plot', 'interactive plot', 'static plot',
+        'extended plot', 'long-range plot']
+
+
+class LoadTestReport:
+    """Latencies of every request at each concurrency level."""
+
+    def __init__(self):
+        # {concurrency: {endpoint: [seconds, ...]}}
+        self.latencies = {}
+        self.errors = {}
+        self.durations = {}
+
+    def add_level(self, concurrency, latencies, errors, duration):
+        self.latencies[concurrency] = latencies
+        self.errors[concurrency] = errors
+        self.durations[concurrency] = duration
+
+    def get_formatted_report(self):
+        """Return a table of throughput and latency, by level and endpoint."""
+        lines = []
+        for concurrency, latencies in self.latencies.items():
+            duration = self.durations[concurrency]
+            num_requests = sum(len(times) for times in latencies.values())
+            num_errors = sum(self.errors[concurrency].values())
+            lines.append(f"{concurrency} concurrent viewers:"
+                    f" {num_requests / duration:.1f} req/s,"
+                    f" {num_errors} errors")
+            lines.append(f"  {'endpoint':<22}{'req/s':>8}{'p50':>9}"
+                    f"{'p95':>9}{'p99':>9}{'errors':>8}")
+            for name, times in latencies.items():
+                num_errors = self.errors[concurrency].get(name, 0)
+                if times:
+                    percentiles = ''.join(f"{p:>7.0f}ms"
+                            for p in get_percentiles(times))
+                elif num_errors:
+                    percentiles = f"{'-':>9}" * 3
+                else:
+                    continue
+                lines.append(f"  {name:<22}{len(times) / duration:>8.1f}"
+                        f"{percentiles}{num_errors:>8}")
+        return '\n'.join(lines)
+
+
+def get_percentiles(times, percentiles=PERCENTILES):
+    """Return the latency percentiles of times in seconds, in ms."""
+    return np.percentile(np.array(times) * 1000, percentiles)
+
+
+def start_server(host=HOST, port=PORT, workers=WORKERS):
+    """Start the site under gunicorn, and wait until it answers.
+    Returns the server process.
+    """
+    import requests
+
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn',
+            'irg_realtime.wsgi', '--bind', f"{host}:{port}",
+            '--workers', str(workers), '--log-level', 'warning'])
+    base_url = f"http://{host}:{port}"
+    for _ in range(100):
+        try:
+            requests.get(base_url, timeout=1)
+            return process
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise RuntimeError("The server exited while starting.")
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("The server didn't start.")
+
+
+def log_in(base_url, username, password):
+    """Return a requests session that's logged in to the site."""
+    import requests
+
+    session = requests.Session()
+    login_url = f"{base_url}{LOGIN_PATH}"
+    session.get(login_url, timeout=REQUEST_TIMEOUT)
+    response = session.post(login_url, timeout=REQUEST_TIMEOUT, data={
+        'username': username,
+        'password': password,
+        'csrfmiddlewaretoken': session.cookies.get('csrftoken', ''),
+    }, headers={'Referer': login_url})
+    if 'sessionid' not in session.cookies:
+        raise RuntimeError(f"Couldn't log in as {username}"
+                f" (status {response.status_code}).")
+    # Browsers accept compressed responses.
+    session.headers['Accept-Encoding'] = 'gzip, deflate, br'
+    return session
+
+
+def find_asset_paths(session, base_url):
+    """Return the current plot fragment and plot image paths, from the
+    pages that include them.
+    """
+    paths = {'plot fragment': [], 'plot image': []}
+    for name, path, _ in TRAFFIC_MIX:
+        if name not in PAGES:
+            continue
+        html = session.get(f"{base_url}{path}", timeout=REQUEST_TIMEOUT).text
+        paths['plot fragment'] += re.findall(r'<iframe[^>]*src="([^"]+)"', html)
+        paths['plot image'] += re.findall(
+                r'src="([^"]*plot_images/[^"]+)"', html)
+    return paths
+
+
+def run_level(sessions, base_url, asset_paths, seconds=LEVEL_SECONDS,
+        seed=None):
+    """Have each session request urls from the traffic mix, back to back,
+    for a number of seconds.
+    Returns the latencies and error counts by endpoint.
+    """
+    # Leave out assets the site hasn't published yet.
+    mix = [(name, path) for name, path, _ in TRAFFIC_MIX
+            if path or asset_paths.get(name)]
+    weights = [weight for name, path, weight in TRAFFIC_MIX
+            if path or asset_paths.get(name)]
+    latencies = {name: [] for name, _ in mix}
+    errors = {name: 0 for name, _ in mix}
+    lock = threading.Lock()
+    t_end = time.perf_counter() + seconds
+
+    def viewer(session, viewer_number):
+        rng = random.Random(None if seed is None else seed + viewer_number)
+        while time.perf_counter() < t_end:
+            name, path = rng.choices(mix, weights)[0]
+            path = path if path else rng.choice(asset_paths[name])
+            start = time.perf_counter()
+            try:
+                response = session.get(f"{base_url}{path}",
+                        timeout=REQUEST_TIMEOUT)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies[name].append(elapsed)
+                else:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=viewer, args=(session, i))
+            for i, session in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def run_load_test(username, password, base_url=None,
+        concurrency_levels=CONCURRENCY_LEVELS, seconds=LEVEL_SECONDS,
+        workers=WORKERS, seed=None):
+    """Run the traffic mix at each concurrency level, starting a local
+    server unless base_url is given. Returns a LoadTestReport.
+    """
+    process = None
+    if not base_url:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                'irg_realtime.settings')
+        process = start_server(workers=workers)
+        base_url = f"http://{HOST}:{PORT}"
+
+    try:
+        sessions = [log_in(base_url, username, password)
+                for _ in range(max(concurrency_levels))]
+        asset_paths = find_asset_paths(sessions[0], base_url)
+
+        report = LoadTestReport()
+        for concurrency in concurrency_levels:
+            print(f"  {concurrency} concurrent viewers...")
+            start = time.perf_counter()
+            latencies, errors = run_level(sessions[:concurrency], base_url,
+                    asset_paths, seconds, seed)
+            report.add_level(concurrency, latencies, errors,
+                    time.perf_counter() - start)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    return report
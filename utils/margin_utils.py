@@ -0,0 +1,260 @@
+"""How close every reading came to being critical.
+
+For each reading, the margin is how much higher it would have needed to be
+to count as critical: the smallest extra height that would give a rise of
+RISE_CRITICAL, at a rate above M_CRITICAL, from some reading in the lookback
+window. A margin of zero or less means the reading was critical. The rise
+deficit and slope deficit say which part of the rule fell short: how far
+the largest rise was below RISE_CRITICAL, and how far the steepest rate of
+rise was below M_CRITICAL.
+
+Margins for the whole archive are stored next to it, one file per month
+like the archive, and updated whenever readings are merged, like the
+rollups. Stretches that came close but never became critical are also
+stored as closest calls, sorted by margin, so "the 20 closest calls since
+2014" is a filter over a few hundred rows. An update only rewrites the
+months it touches, and only finds the calls that its margins can be part
+of again.
+"""
+
+import datetime, os, shutil
+
+import numpy as np
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import critical_rules, reading_archive, resample_utils
+
+
+aktz = pytz.timezone('US/Alaska')
+
+MONTH_DIR = 'months'
+CALLS_FILE = 'closest_calls.npy'
+
+MARGIN_DTYPE = np.dtype([
+    ('ts', '<i8'), ('height', '<f8'), ('margin', '<f8'),
+    ('rise_deficit', '<f8'), ('slope_deficit', '<f8'),
+])
+
+# ts is the reading with the smallest margin in the call; start_ts and
+#   end_ts bound the readings within CALL_MARGIN.
+CALL_DTYPE = np.dtype([
+    ('ts', '<i8'), ('start_ts', '<i8'), ('end_ts', '<i8'),
+    ('height', '<f8'), ('margin', '<f8'),
+    ('rise_deficit', '<f8'), ('slope_deficit', '<f8'),
+])
+
+# Readings within this many feet of critical are part of a call. Readings
+#   close together in time are one call, the same way critical points are
+#   grouped into events.
+CALL_MARGIN = 1.0
+
+# Readings this far back can affect a reading's margin.
+LOOKBACK_SECONDS = (critical_rules.get_lookback_hours() * 3600
+        + resample_utils.MAX_GAP_MINUTES * 60)
+
+
+def compute_margins(timestamps, heights, rise_critical=a_utils.RISE_CRITICAL,
+        m_critical=a_utils.M_CRITICAL):
+    """Compute the margin to critical of sorted readings, given as
+    epoch-second and height arrays. Returns a MARGIN_DTYPE array.
+
+    Readings with nothing to look back on have a margin of nan.
+    """
+    margins = np.empty(len(timestamps), dtype=MARGIN_DTYPE)
+    margins['ts'] = timestamps
+    margins['height'] = heights
+    for field in ('margin', 'rise_deficit', 'slope_deficit'):
+        margins[field] = np.nan
+    if len(timestamps) < 2:
+        return margins
+
+    # Evaluated by the same engine as critical points, so margin <= 0
+    #   matches the rule being met.
+    series = resample_utils.resample_arrays(timestamps, heights)
+    rule = critical_rules.CriticalRule('margin', rise=rise_critical,
+            rate=m_critical)
+    results = critical_rules.evaluate_heights(series.heights, series.interval,
+            [rule], details=True)
+
+    source_slots = np.flatnonzero(series.source_index >= 0)
+    reading_index = series.source_index[source_slots]
+    margins['margin'][reading_index] = results.margin[0][source_slots]
+    margins['rise_deficit'][reading_index] = (rise_critical
+            - results.max_rise[0][source_slots])
+    margins['slope_deficit'][reading_index] = (m_critical
+            - results.max_rate[0][source_slots])
+    return margins
+
+
+def find_closest_calls(margins, call_margin=CALL_MARGIN,
+        suppression_hours=a_utils.EVENT_SUPPRESSION_HOURS):
+    """Find every stretch of readings within call_margin of critical that
+    never became critical. Returns a CALL_DTYPE array, closest first.
+    """
+    close = margins[margins['margin'] <= call_margin]
+    if not len(close):
+        return np.empty(0, dtype=CALL_DTYPE)
+
+    # Start a new call after a long enough break, as with events.
+    breaks = np.diff(close['ts']) > (suppression_hours + 1) * 3600
+    starts = np.flatnonzero(np.append(True, breaks))
+    ends = np.append(starts[1:], len(close))
+    critical = np.logical_or.reduceat(close['margin'] <= 0, starts)
+
+    # Index of the smallest margin in each call.
+    call_index = np.repeat(np.arange(len(starts)), ends - starts)
+    order = np.lexsort((close['margin'], call_index))
+    closest = order[starts]
+
+    calls = np.empty(len(starts), dtype=CALL_DTYPE)
+    calls['start_ts'] = close['ts'][starts]
+    calls['end_ts'] = close['ts'][ends - 1]
+    for field in ('ts', 'height', 'margin', 'rise_deficit', 'slope_deficit'):
+        calls[field] = close[field][closest]
+    calls = calls[~critical]
+    return calls[np.argsort(calls['margin'], kind='stable')]
+
+
+def update_margins(timestamps, heights, archive_dir=reading_archive.ARCHIVE_DIR,
+        margin_dir=None):
+    """Bring the margins and closest calls up to date after readings in this
+    range have been merged into the archive.
+    """
+    if not len(timestamps):
+        return
+    margin_dir = margin_dir if margin_dir else get_margin_dir(archive_dir)
+
+    # Readings can change the margins of readings up to LOOKBACK_SECONDS
+    #   later.
+    ts_first = int(np.min(timestamps))
+    ts_last = int(np.max(timestamps)) + LOOKBACK_SECONDS
+    archive_ts, archive_heights = reading_archive.load_arrays(
+            _ts_to_dt(ts_first - LOOKBACK_SECONDS), _ts_to_dt(ts_last),
+            archive_dir)
+    margins = compute_margins(archive_ts, archive_heights)
+    affected = margins['ts'] >= ts_first
+    save_margins(margins[affected], margin_dir)
+
+
+def rebuild_margins(archive_dir=reading_archive.ARCHIVE_DIR, margin_dir=None):
+    """Compute the margins for the whole archive from scratch."""
+    margin_dir = margin_dir if margin_dir else get_margin_dir(archive_dir)
+    shutil.rmtree(os.path.join(margin_dir, MONTH_DIR), ignore_errors=True)
+    calls_file = os.path.join(margin_dir, CALLS_FILE)
+    if os.path.exists(calls_file):
+        os.remove(calls_file)
+    timestamps, heights = reading_archive.load_arrays(archive_dir=archive_dir)
+    save_margins(compute_margins(timestamps, heights), margin_dir)
+
+
+def save_margins(margins, margin_dir):
+    """Merge margin rows into the stored margins, and update the closest
+    calls. A row for a reading that's already stored replaces it.
+    """
+    if not len(margins):
+        return
+    reading_archive.save_records(margins, os.path.join(margin_dir, MONTH_DIR))
+    update_closest_calls(int(margins['ts'].min()), margin_dir)
+
+
+def update_closest_calls(ts_first, margin_dir, call_margin=CALL_MARGIN,
+        suppression_hours=a_utils.EVENT_SUPPRESSION_HOURS):
+    """Bring the closest calls up to date after the margins from ts_first
+    on have changed. Calls that ended before the call ts_first can be part
+    of are kept, and the rest are found again.
+    """
+    calls_file = os.path.join(margin_dir, CALLS_FILE)
+    calls = (np.load(calls_file) if os.path.exists(calls_file)
+                else np.empty(0, dtype=CALL_DTYPE))
+    ts_start = _get_call_start(ts_first, os.path.join(margin_dir, MONTH_DIR),
+            call_margin, (suppression_hours + 1) * 3600)
+    margins = reading_archive.load_records(_ts_to_dt(ts_start),
+            record_dir=os.path.join(margin_dir, MONTH_DIR),
+            dtype=MARGIN_DTYPE)
+
+    # Kept calls are already closest first. A stable sort keeps ties in
+    #   time order, the same as find_closest_calls().
+    calls = np.concatenate((calls[calls['start_ts'] < ts_start],
+            find_closest_calls(margins, call_margin, suppression_hours)))
+    _save_atomic(calls_file, calls[np.argsort(calls['margin'], kind='stable')])
+
+
+def load_margins(dt_start=None, dt_end=None, margin_dir=None):
+    """Return the margin rows from dt_start to dt_end, inclusive."""
+    margin_dir = margin_dir if margin_dir else get_margin_dir()
+    return reading_archive.load_records(dt_start, dt_end,
+            os.path.join(margin_dir, MONTH_DIR), MARGIN_DTYPE)
+
+
+def get_closest_calls(num_calls=20, dt_start=None, dt_end=None,
+        margin_dir=None):
+    """Return the num_calls closest calls from dt_start to dt_end, closest
+    first.
+    """
+    margin_dir = margin_dir if margin_dir else get_margin_dir()
+    filename = os.path.join(margin_dir, CALLS_FILE)
+    if not os.path.exists(filename):
+        return np.empty(0, dtype=CALL_DTYPE)
+    calls = np.load(filename)
+    in_range = np.ones(len(calls), dtype=bool)
+    if dt_start:
+        in_range &= calls['ts'] >= dt_start.timestamp()
+    if dt_end:
+        in_range &= calls['ts'] <= dt_end.timestamp()
+    return calls[in_range][:num_calls]
+
+
+def get_formatted_margin(row):
+    """Print a neat summary of one reading's margin."""
+    dt_str = _ts_to_dt(row['ts']).astimezone(aktz).strftime('%m/%d/%Y %H:%M')
+    return f"{dt_str} - {row['height']:.2f} ft, margin {row['margin']:.2f} ft"
+
+
+def get_formatted_call(call):
+    """Print a neat summary of one closest call."""
+    dt_str = _ts_to_dt(call['ts']).astimezone(aktz).strftime('%m/%d/%Y %H:%M')
+    return (f"{dt_str} - {call['margin']:.2f} ft short"
+            f" (rise short by {call['rise_deficit']:.2f} ft,"
+            f" rate short by {call['slope_deficit']:.2f} ft/hr)")
+
+
+def get_margin_dir(archive_dir=reading_archive.ARCHIVE_DIR):
+    """Return the margin directory that goes with an archive."""
+    return os.path.join(archive_dir, 'margins')
+
+
+def _get_call_start(ts_first, month_dir, call_margin, group_seconds):
+    """Return where the call that a margin at ts_first could join starts:
+    the first close reading after the last break before ts_first. Only
+    reads back through the months until it finds a break.
+    """
+    # The earliest close reading found so far, that the readings before it
+    #   are checked against.
+    later_ts = ts_first
+    for month in reversed(reading_archive.get_months(month_dir)):
+        month_start, _ = reading_archive.get_month_bounds(month)
+        if month_start >= ts_first:
+            continue
+        margins = reading_archive.load_month(month, month_dir,
+                ts_end=ts_first - 1)
+        close_ts = margins['ts'][margins['margin'] <= call_margin]
+        close_ts = np.append(close_ts, later_ts)
+        breaks = np.flatnonzero(np.diff(close_ts) > group_seconds)
+        if len(breaks):
+            return int(close_ts[breaks[-1] + 1])
+        later_ts = int(close_ts[0])
+        # Any close reading in an earlier month is too far back to join.
+        if later_ts - month_start > group_seconds:
+            return later_ts
+    return later_ts
+
+
+def _save_atomic(filename, array):
+    tmp_filename = f"{filename}.tmp.npy"
+    np.save(tmp_filename, array)
+    os.replace(tmp_filename, filename)
+
+
+def _ts_to_dt(ts):
+    return datetime.datetime.fromtimestamp(int(ts), tz=pytz.utc)
@@ -0,0 +1,325 @@
+"""Probabilistic nowcast of reaching critical conditions.
+
+The minimum critical forecast shows how high the river would need to get to
+become critical, but not how likely that is. The nowcast simulates
+thousands of possible paths for the river over the next 4.5 hours, all at
+once as arrays, and counts how many of them become critical.
+
+Paths are drawn from history where possible: every time the river was
+rising at about the current rate, what did it do over the next 4.5 hours?
+Those storm analogs come from the reading archive. Without enough analogs,
+paths are a random walk on the current rate of rise, with noise matching
+the last few hours of readings.
+
+The analog library is saved, and each refresh only looks for analogs in
+the new readings. It's rebuilt from the whole archive when readings from
+before the last update have changed, ie after a backfill.
+"""
+
+import datetime, json, os
+
+import numpy as np
+import pytz
+
+from utils import critical_rules, reading_archive, resample_utils
+
+
+NOWCAST_FILE = 'historical_data/nowcast.json'
+LIBRARY_FILE = 'historical_data/nowcast_library.npz'
+
+NUM_TRAJECTORIES = 5000
+# Matches the minimum critical forecast: 18 readings, 15 minutes apart.
+HORIZON_READINGS = 18
+INTERVAL_MINUTES = 15
+
+# Analogs are times the river was rising at least this fast, in ft/hr,
+#   and within RATE_TOLERANCE of the current rate.
+STORM_RATE = 0.1
+RATE_TOLERANCE = 0.1
+MIN_ANALOGS = 50
+
+# Random walk fallback: how much the rate of rise can drift each step,
+#   in ft/hr.
+RATE_STEP_STD = 0.05
+
+PERCENTILES = (10, 50, 90)
+
+# Analog libraries, by archive directory and library file.
+_libraries = {}
+
+
+class Nowcast:
+    """Results of one nowcast run."""
+
+    def __init__(self, last_ts, timestamps, probability, probability_by_step,
+            percentiles, method, num_trajectories, num_analogs=0):
+        # Timestamp of the last reading the nowcast started from.
+        self.last_ts = last_ts
+        # Timestamps of each future step.
+        self.timestamps = timestamps
+        # Chance of becoming critical within the horizon, and by each step.
+        self.probability = probability
+        self.probability_by_step = probability_by_step
+        # Heights at each step, for each of PERCENTILES.
+        self.percentiles = percentiles
+        self.method = method
+        self.num_trajectories = num_trajectories
+        self.num_analogs = num_analogs
+
+    @property
+    def datetimes(self):
+        return [datetime.datetime.fromtimestamp(ts, tz=pytz.utc)
+                    for ts in self.timestamps]
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, nowcast_dict):
+        return cls(**nowcast_dict)
+
+    def get_formatted_nowcast(self):
+        """Print a neat summary of the nowcast."""
+        hours = HORIZON_READINGS * INTERVAL_MINUTES / 60
+        return (f"{self.probability:.0%} chance of critical within {hours} hrs"
+                f" ({self.method}, {self.num_trajectories} paths)")
+
+
+class AnalogLibrary:
+    """Storm analogs found in an archive of readings.
+
+    rates is the rate of rise over the hour before each analog, in ft/hr,
+      and paths is the change in height at each of the following
+      HORIZON_READINGS steps, with one row per analog. start_ts is the
+      epoch time each analog starts from.
+    """
+
+    def __init__(self, rates=None, paths=None, start_ts=None, last_ts=None,
+            num_readings=0, next_start_ts=None):
+        self.rates = rates if rates is not None else np.empty(0)
+        self.paths = (paths if paths is not None
+                        else np.empty((0, HORIZON_READINGS)))
+        self.start_ts = (start_ts if start_ts is not None
+                            else np.empty(0, dtype=np.int64))
+        # Timestamp of the last archived reading, and how many readings
+        #   were archived up to it, at the last update.
+        self.last_ts = last_ts
+        self.num_readings = num_readings
+        # The first start that hasn't been checked for an analog yet.
+        self.next_start_ts = next_start_ts
+
+    @property
+    def analogs(self):
+        return self.rates, self.paths
+
+    def update(self, archive_dir=reading_archive.ARCHIVE_DIR):
+        """Add analogs from readings archived since the last update.
+        Returns True if the library changed.
+        """
+        last_ts = reading_archive.get_last_timestamp(archive_dir)
+        if last_ts == self.last_ts:
+            return False
+        if (self.next_start_ts is None or reading_archive.count_readings(
+                    _ts_to_dt(self.last_ts), archive_dir) != self.num_readings):
+            # Nothing to extend, or the past has changed.
+            self.__init__()
+            timestamps, heights = reading_archive.load_arrays(
+                    archive_dir=archive_dir)
+        else:
+            # A start looks back an hour, and a slot can be filled in from
+            #   readings MAX_GAP_MINUTES away.
+            context_seconds = (3600 + resample_utils.MAX_GAP_MINUTES * 60
+                    + INTERVAL_MINUTES * 60)
+            timestamps, heights = reading_archive.load_arrays(
+                    _ts_to_dt(self.next_start_ts - context_seconds),
+                    archive_dir=archive_dir)
+
+        series = resample_utils.resample_arrays(timestamps, heights,
+                INTERVAL_MINUTES)
+        rates, paths, start_ts = find_analogs(series, self.next_start_ts)
+        self.rates = np.concatenate((self.rates, rates))
+        self.paths = np.concatenate((self.paths, paths))
+        self.start_ts = np.concatenate((self.start_ts, start_ts))
+
+        if len(series) > HORIZON_READINGS:
+            self.next_start_ts = int(series.timestamps[-HORIZON_READINGS])
+        self.last_ts = last_ts
+        self.num_readings = reading_archive.count_readings(_ts_to_dt(last_ts),
+                archive_dir)
+        return True
+
+    def save(self, filename=LIBRARY_FILE):
+        """Write the library to an npz file, replacing the old file
+        atomically.
+        """
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        tmp_filename = f"{filename}.tmp.npz"
+        np.savez(tmp_filename, rates=self.rates, paths=self.paths,
+                start_ts=self.start_ts,
+                meta=np.array([_or_nan(self.last_ts), self.num_readings,
+                    _or_nan(self.next_start_ts)], dtype=np.float64))
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename=LIBRARY_FILE):
+        """Read a library from an npz file."""
+        with np.load(filename) as data:
+            last_ts, num_readings, next_start_ts = data['meta'].tolist()
+            return cls(data['rates'], data['paths'], data['start_ts'],
+                    _nan_or_int(last_ts), int(num_readings),
+                    _nan_or_int(next_start_ts))
+
+
+def find_analogs(series, first_start_ts=None):
+    """Find storm analogs in a 15-minute RegularSeries, starting from
+    first_start_ts. Returns the rates, paths, and start times of the
+    analogs, as in AnalogLibrary.
+    """
+    h = series.heights
+    steps_per_hr = series.readings_per_hr
+    first_start = steps_per_hr
+    if first_start_ts is not None and len(series):
+        first_start = max(first_start,
+                (first_start_ts - series.start) // series.interval)
+    if len(h) < first_start + HORIZON_READINGS + 1:
+        return (np.empty(0), np.empty((0, HORIZON_READINGS)),
+                np.empty(0, dtype=np.int64))
+
+    starts = np.arange(first_start, len(h) - HORIZON_READINGS)
+    rates = h[starts] - h[starts - steps_per_hr]
+    starts, rates = starts[rates >= STORM_RATE], rates[rates >= STORM_RATE]
+
+    steps = starts[:, None] + np.arange(1, HORIZON_READINGS + 1)
+    paths = h[steps] - h[starts][:, None]
+    usable = np.isfinite(paths).all(axis=1)
+    return (rates[usable], paths[usable],
+            series.timestamps[starts[usable]])
+
+
+def build_library(timestamps, heights):
+    """Build a library of storm analogs from archived readings.
+    Returns rates and paths, as in AnalogLibrary.
+    """
+    series = resample_utils.resample_arrays(timestamps, heights,
+            INTERVAL_MINUTES)
+    rates, paths, _ = find_analogs(series)
+    return rates, paths
+
+
+def get_library(archive_dir=reading_archive.ARCHIVE_DIR,
+        library_file=LIBRARY_FILE):
+    """Return the analogs (rates, paths) for an archive's current contents.
+    The saved library is extended with any new readings, and only rebuilt
+    when older readings have changed.
+    """
+    key = (archive_dir, library_file)
+    library = _libraries.get(key)
+    if library is None or not os.path.exists(library_file):
+        library = (AnalogLibrary.load(library_file)
+                    if os.path.exists(library_file) else AnalogLibrary())
+        _libraries[key] = library
+    if library.update(archive_dir):
+        library.save(library_file)
+    return library.analogs
+
+
+def run_nowcast(readings, library=None, num_trajectories=NUM_TRAJECTORIES,
+        seed=None):
+    """Simulate the river over the next HORIZON_READINGS steps, and estimate
+    the chance of becoming critical.
+
+    library is (rates, paths) from build_library(); pass None to skip
+      analogs and use the random walk.
+    Returns a Nowcast.
+    """
+    rng = np.random.default_rng(seed)
+    lookback_hours = critical_rules.get_lookback_hours()
+    steps_per_hr = 60 // INTERVAL_MINUTES
+    num_past = lookback_hours * steps_per_hr
+
+    series = resample_utils.resample_readings(readings, INTERVAL_MINUTES)
+    past = series.heights[-(num_past + 1):]
+    current = past[-1]
+    rate = past[-1] - past[-1 - steps_per_hr] if len(past) > steps_per_hr else 0.0
+    if not np.isfinite(rate):
+        rate = 0.0
+    # Noise in the recent readings, per step.
+    recent_steps = np.diff(past[-(3 * steps_per_hr + 1):])
+    noise_std = np.nanstd(recent_steps) if len(recent_steps) > 1 else 0.0
+
+    rates, analog_paths = library if library else (np.empty(0), None)
+    analogs = np.flatnonzero(np.abs(rates - rate) <= RATE_TOLERANCE)
+    if rate >= STORM_RATE and len(analogs) >= MIN_ANALOGS:
+        method = 'analog'
+        rows = analogs[rng.integers(len(analogs), size=num_trajectories)]
+        paths = analog_paths[rows]
+    else:
+        method = 'random walk'
+        step_rates = rate + np.cumsum(rng.normal(0, RATE_STEP_STD,
+                (num_trajectories, HORIZON_READINGS)), axis=1)
+        paths = np.cumsum(step_rates / steps_per_hr, axis=1)
+    paths = paths + np.cumsum(rng.normal(0, noise_std,
+            (num_trajectories, HORIZON_READINGS)), axis=1)
+    future = current + paths
+
+    # Same rules as the critical point detector, on every path at once.
+    full = np.concatenate((np.broadcast_to(past, (num_trajectories, len(past))),
+            future), axis=1)
+    critical = critical_rules.evaluate_heights(full,
+            INTERVAL_MINUTES * 60).any_critical[:, len(past):]
+
+    critical_by_step = np.logical_or.accumulate(critical, axis=1)
+    last_ts = int(readings[-1].dt_reading.timestamp())
+    timestamps = last_ts + np.arange(1, HORIZON_READINGS + 1) * INTERVAL_MINUTES * 60
+
+    return Nowcast(
+        last_ts=last_ts,
+        timestamps=timestamps.tolist(),
+        probability=float(critical_by_step[:, -1].mean()),
+        probability_by_step=critical_by_step.mean(axis=0).tolist(),
+        percentiles={str(p): np.percentile(future, p, axis=0).tolist()
+                        for p in PERCENTILES},
+        method=method,
+        num_trajectories=num_trajectories,
+        num_analogs=int(len(analogs)) if method == 'analog' else 0,
+    )
+
+
+def get_nowcast(readings, archive_dir=reading_archive.ARCHIVE_DIR,
+        filename=NOWCAST_FILE, library_file=LIBRARY_FILE):
+    """Return the nowcast for the latest readings.
+
+    The nowcast is saved with each refresh, so it's only run once for each
+      new reading.
+    """
+    last_ts = int(readings[-1].dt_reading.timestamp())
+    if os.path.exists(filename):
+        with open(filename) as f:
+            nowcast = Nowcast.from_dict(json.load(f))
+        if nowcast.last_ts == last_ts:
+            return nowcast
+
+    nowcast = run_nowcast(readings, get_library(archive_dir, library_file))
+    save_nowcast(nowcast, filename)
+    return nowcast
+
+
+def save_nowcast(nowcast, filename=NOWCAST_FILE):
+    """Write a nowcast to a json file, replacing the old file atomically."""
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(nowcast.to_dict(), f)
+    os.replace(tmp_filename, filename)
+
+
+def _ts_to_dt(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=pytz.utc)
+
+
+def _or_nan(value):
+    return np.nan if value is None else value
+
+
+def _nan_or_int(value):
+    return None if np.isnan(value) else int(value)
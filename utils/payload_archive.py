@@ -0,0 +1,202 @@
+"""Archive of raw USGS responses.
+
+Each refresh fetches the last 3 days of readings, so most of every
+response repeats the last one. Responses are split into blocks: the
+header, and one block per day of readings. Each block is stored once,
+gzipped and named by its hash. A response is stored as the list of its
+blocks, so an overlapping fetch only adds the blocks that changed,
+usually just today's. The header's retrieval time changes with every
+fetch, so that line is kept in the response's list instead of in a block,
+and the rest of the header is stored once. Every fetch is logged, and any
+response can be rebuilt exactly, for audits or for replaying.
+
+Only readings newer than the archive's last reading are parsed. Days
+before that are skipped without being read, so parse work grows with new
+data only.
+"""
+
+import datetime, gzip, hashlib, json, os
+
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import quality_utils, reading_archive, resample_utils
+
+
+aktz = pytz.timezone('US/Alaska')
+
+PAYLOAD_DIR = 'historical_data/payloads'
+INDEX_FILE = 'index.jsonl'
+
+# Header lines that are different in every response.
+VOLATILE_PREFIXES = ('# retrieved:',)
+
+
+def split_blocks(payload):
+    """Split a USGS rdb response into blocks of lines.
+    Returns a list of (key, text) pairs, where key is 'header', 'volatile'
+    for a header line that changes with every fetch, or the local date of
+    the block's readings.
+    """
+    blocks = []
+    for line in payload.splitlines(keepends=True):
+        if line.startswith(VOLATILE_PREFIXES):
+            key = 'volatile'
+        else:
+            key = _get_line_date(line) or 'header'
+        if blocks and blocks[-1][0] == key:
+            blocks[-1][1].append(line)
+        else:
+            blocks.append((key, [line]))
+    return [(key, ''.join(lines)) for key, lines in blocks]
+
+
+def save_payload(payload, url=None, dt_fetched=None, payload_dir=PAYLOAD_DIR):
+    """Store a response, and log the fetch.
+    Returns the response's hash.
+    """
+    os.makedirs(payload_dir, exist_ok=True)
+    dt_fetched = dt_fetched if dt_fetched else datetime.datetime.now(pytz.utc)
+    payload_hash = _get_hash(payload)
+
+    # The manifest lists each block's hash, and the text of volatile lines.
+    new_blocks = 0
+    block_hashes = []
+    manifest = []
+    for key, text in split_blocks(payload):
+        if key == 'volatile':
+            manifest.append({'text': text})
+            continue
+        block_hash = _get_hash(text)
+        block_hashes.append(block_hash)
+        manifest.append(block_hash)
+        block_file = _get_block_file(block_hash, payload_dir)
+        if not os.path.exists(block_file):
+            _write_atomic(block_file, gzip.compress(text.encode()))
+            new_blocks += 1
+
+    manifest_file = _get_manifest_file(payload_hash, payload_dir)
+    if not os.path.exists(manifest_file):
+        _write_atomic(manifest_file, json.dumps(manifest).encode())
+
+    fetch = {
+        'dt_fetched': dt_fetched.isoformat(),
+        'url': url,
+        'payload': payload_hash,
+        'size': len(payload.encode()),
+        'num_blocks': len(block_hashes),
+        'new_blocks': new_blocks,
+    }
+    with open(os.path.join(payload_dir, INDEX_FILE), 'a') as f:
+        f.write(json.dumps(fetch) + '\n')
+
+    return payload_hash
+
+
+def load_payload(payload_hash, payload_dir=PAYLOAD_DIR):
+    """Rebuild a stored response, exactly as it was fetched."""
+    with open(_get_manifest_file(payload_hash, payload_dir)) as f:
+        manifest = json.load(f)
+
+    blocks = []
+    for entry in manifest:
+        if isinstance(entry, dict):
+            blocks.append(entry['text'])
+            continue
+        with open(_get_block_file(entry, payload_dir), 'rb') as f:
+            blocks.append(gzip.decompress(f.read()).decode())
+    return ''.join(blocks)
+
+
+def get_fetches(payload_dir=PAYLOAD_DIR):
+    """Return the log of every fetch, oldest first."""
+    index_file = os.path.join(payload_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_stored_size(payload_dir=PAYLOAD_DIR):
+    """Return the bytes used by stored blocks and manifests."""
+    total = 0
+    for dirpath, _, filenames in os.walk(payload_dir):
+        total += sum(os.path.getsize(os.path.join(dirpath, f))
+                        for f in filenames if f != INDEX_FILE)
+    return total
+
+
+def parse_new_readings(payload, last_ts=None):
+    """Parse only the readings in a response that are newer than last_ts.
+    Returns cleaned epoch-second and height arrays, and a QualityReport.
+    """
+    # Local dates sort as strings. Start a day early, in case of
+    #   readings right around midnight or a change to or from daylight
+    #   saving time.
+    first_date = ''
+    if last_ts is not None:
+        dt_last = datetime.datetime.fromtimestamp(last_ts, tz=pytz.utc)
+        first_date = (dt_last.astimezone(aktz).date()
+                        - datetime.timedelta(days=1)).isoformat()
+
+    rows = []
+    for key, text in split_blocks(payload):
+        if key in ('header', 'volatile') or key < first_date:
+            continue
+        rows += [line.rstrip('\r\n').split('\t') for line in text.splitlines()]
+
+    readings = a_utils.parse_usgs_rows(rows)
+    timestamps, heights = resample_utils.readings_to_arrays(readings)
+    context = None
+    if last_ts is not None:
+        # The older readings in the response are already archived, but the
+        #   first new reading is checked for a spike against them.
+        new = timestamps > last_ts
+        context = (timestamps[~new], heights[~new])
+        timestamps, heights = timestamps[new], heights[new]
+
+    kept_indices, _, report = quality_utils.clean_arrays(timestamps, heights,
+            context=context)
+    return timestamps[kept_indices], heights[kept_indices], report
+
+
+def ingest_payload(payload, url=None, archive_dir=reading_archive.ARCHIVE_DIR,
+        payload_dir=PAYLOAD_DIR):
+    """Store a response, and return the readings in it that are newer than
+    anything in the archive, as epoch-second and height arrays, and a
+    QualityReport for them.
+    """
+    save_payload(payload, url, payload_dir=payload_dir)
+    last_ts = reading_archive.get_last_timestamp(archive_dir)
+    return parse_new_readings(payload, last_ts)
+
+
+def _get_line_date(line):
+    """Return the local date of a line of readings, or None for any other
+    line.
+    """
+    if not line.startswith('USGS\t'):
+        return None
+    fields = line.split('\t')
+    return fields[2][:10] if len(fields) > 2 else None
+
+
+def _get_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _get_block_file(block_hash, payload_dir):
+    return os.path.join(payload_dir, 'blocks', block_hash[:2],
+            f"{block_hash}.gz")
+
+
+def _get_manifest_file(payload_hash, payload_dir):
+    return os.path.join(payload_dir, 'payloads', f"{payload_hash}.json")
+
+
+def _write_atomic(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
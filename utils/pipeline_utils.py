@@ -0,0 +1,210 @@
+"""The refresh pipeline, from freshly fetched readings to a published site.
+
+Every refresh runs the same stages: ingest the readings into the archive,
+detect critical conditions and send any alerts, publish the analyzed
+series for the web workers, and render and publish the plots. Refresh and
+replay both run the pipeline through run_pipeline(), so a replay
+exercises exactly what runs live.
+
+Everything the pipeline reads and writes is named in a PipelinePaths. By
+default these are the live paths, relative to the working directory except
+for the published plots, which go under the project directory where the
+site serves them; a replay puts them all under its own directory.
+"""
+
+import datetime, functools, os, time
+
+import numpy as np
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import alert_utils, artifact_store, downsample_utils, event_catalog
+from utils import margin_utils
+from utils import nowcast_utils, reading_archive, resample_utils, rollup_utils
+from utils import series_cache, slide_store, time_utils
+
+
+STAGES = ('ingest', 'detect', 'publish', 'render')
+
+# Analysis and plots focus on this many hours of the latest readings.
+RECENT_HOURS = 48
+# A live fetch covers this many days.
+FETCH_DAYS = 3
+
+
+class PipelinePaths:
+    """Where the pipeline reads and writes. Every path is under root,
+    which is the working directory by default; published plots default to
+    the project directory instead.
+    """
+
+    def __init__(self, root=''):
+        self.root = root
+        self.archive_dir = os.path.join(root, reading_archive.ARCHIVE_DIR)
+        self.rollup_dir = rollup_utils.get_rollup_dir(self.archive_dir)
+        self.margin_dir = margin_utils.get_margin_dir(self.archive_dir)
+        self.catalog_file = os.path.join(root, event_catalog.CATALOG_FILE)
+        self.nowcast_file = os.path.join(root, nowcast_utils.NOWCAST_FILE)
+        self.library_file = os.path.join(root, nowcast_utils.LIBRARY_FILE)
+        self.alert_state_file = os.path.join(root, alert_utils.STATE_FILE)
+        self.alert_log_file = os.path.join(root, alert_utils.ALERT_LOG_FILE)
+        self.cache_dir = os.path.join(root, series_cache.CACHE_DIR)
+        self.staging_dir = artifact_store.get_path(artifact_store.STAGING_DIR,
+                root)
+        self.manifest_file = artifact_store.get_path(
+                artifact_store.MANIFEST_FILE, root)
+
+
+LIVE_PATHS = PipelinePaths()
+
+
+def load_recent_readings(days=FETCH_DAYS,
+        archive_dir=reading_archive.ARCHIVE_DIR):
+    """Return the last few days of archived readings."""
+    last_ts = reading_archive.get_last_timestamp(archive_dir)
+    if last_ts is None:
+        return []
+    timestamps, heights = _load_days_before(last_ts, days, archive_dir)
+    return resample_utils.arrays_to_readings(timestamps, heights)
+
+
+def load_fetch_window(new_timestamps, new_heights, days=FETCH_DAYS,
+        archive_dir=reading_archive.ARCHIVE_DIR):
+    """Return what a full fetch would have: the last few days of archived
+    readings, followed by new readings that haven't been merged yet.
+    """
+    if not len(new_timestamps):
+        return load_recent_readings(days, archive_dir)
+
+    last_ts = max(reading_archive.get_last_timestamp(archive_dir) or 0,
+            int(new_timestamps[-1]))
+    timestamps, heights = _load_days_before(last_ts, days, archive_dir)
+    older = timestamps < new_timestamps[0]
+    timestamps = np.concatenate((timestamps[older], new_timestamps))
+    heights = np.concatenate((heights[older], new_heights))
+    return resample_utils.arrays_to_readings(timestamps, heights)
+
+
+def run_pipeline(readings, dt_ingest, slides=None, alert_engine=None,
+        render=True, verbose=True, new_arrays=None, paths=LIVE_PATHS,
+        lease=None):
+    """Run one refresh cycle on a set of freshly fetched readings.
+
+    dt_ingest is when the cycle began, for measuring alert latency.
+    new_arrays is the epoch-second and height arrays of the readings to
+      merge into the archive; by default, all of readings are merged.
+    paths is a PipelinePaths; alert_engine should use the same state file.
+    lease is the single-flight lease the cycle runs under, if any. It's
+      checked before each stage that writes, so a run that has lost its
+      lease stops before overlapping the run that replaced it.
+    Returns the seconds spent in each stage, and a list of alerts sent.
+    """
+    # Plotting libraries are slow to import, so only pay for them when
+    #   rendering.
+    if render:
+        from utils import plot_utils, plot_utils_mpl
+
+    stage_times = {}
+
+    check_lease = lease.check if lease else lambda: None
+
+    stage_start = time.perf_counter()
+    check_lease()
+    if new_arrays is None:
+        new_arrays = resample_utils.readings_to_arrays(readings)
+    timestamps, heights = new_arrays
+    if len(timestamps):
+        reading_archive.save_arrays(timestamps, heights, paths.archive_dir)
+        rollup_utils.update_rollups(timestamps, heights, paths.archive_dir,
+                paths.rollup_dir)
+        margin_utils.update_margins(timestamps, heights, paths.archive_dir,
+                paths.margin_dir)
+        catalog = event_catalog.load_catalog(paths.catalog_file)
+        if catalog.update_from_archive(paths.archive_dir):
+            catalog.save(paths.catalog_file)
+    stage_times['ingest'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    # Focus on most recent readings, not an entire week.
+    recent_readings = a_utils.get_recent_readings(readings, RECENT_HOURS)
+    # Evaluate the critical rules once, for the plots and the alerts.
+    rule_results = a_utils.evaluate_readings(recent_readings)
+    critical_points = a_utils.get_critical_points(recent_readings,
+            results=rule_results)
+    critical_points_by_rule = a_utils.get_critical_points_by_rule(
+            recent_readings, results=rule_results)
+
+    # Alert as soon as the readings are in, before spending time on plots.
+    check_lease()
+    if not alert_engine:
+        alert_engine = alert_utils.AlertEngine(
+                state_file=paths.alert_state_file, verbose=verbose)
+    alerts = alert_engine.check(recent_readings, dt_ingest, rule_results)
+
+    nowcast = nowcast_utils.get_nowcast(recent_readings, paths.archive_dir,
+            paths.nowcast_file, paths.library_file)
+    if verbose:
+        print(nowcast.get_formatted_nowcast())
+    stage_times['detect'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    # Publish the analyzed series for the web workers.
+    check_lease()
+    series_cache.publish_series(recent_readings, critical_points,
+            a_utils.get_min_critical_forecast(recent_readings), nowcast,
+            meta={'dt_ingest': dt_ingest.isoformat()},
+            cache_dir=paths.cache_dir)
+    stage_times['publish'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    if render:
+        slides = slides if slides else slide_store.load_slides()
+        known_slides = slides.get_slides_for_readings(recent_readings)
+        staging_file = functools.partial(artifact_store.get_staging_file,
+                staging_dir=paths.staging_dir)
+        # Convert the readings' times once, for every plot.
+        local_times = time_utils.LocalTimes.from_readings(recent_readings)
+
+        # Simple interactive plot of current data.
+        plot_utils.plot_current_data_html(recent_readings,
+                known_slides=known_slides, local_times=local_times,
+                filename=staging_file('simple_irg_plot_current.html'))
+
+        # Interactive forecast plot.
+        plot_utils.plot_interactive_critical_forecast_html(recent_readings,
+                known_slides=known_slides, nowcast=nowcast,
+                local_times=local_times,
+                critical_points_by_rule=critical_points_by_rule,
+                filename=staging_file('irg_critical_forecast_current.html'))
+
+        # Static forecast plot.
+        plot_utils_mpl.plot_critical_forecast_mpl(recent_readings,
+                critical_points, known_slides, local_times=local_times,
+                filename=staging_file('irg_critical_forecast_plot_current.png'))
+
+        # Static forecast plot, extended.
+        plot_utils_mpl.plot_critical_forecast_mpl_extended(recent_readings,
+                critical_points, known_slides, local_times=local_times,
+                filename=staging_file(
+                    'irg_critical_forecast_plot_current_extended.png'))
+
+        # Long-range overview of the archive.
+        plot_utils.plot_long_range_html(
+                downsample_utils.get_long_range_data(
+                    archive_dir=paths.archive_dir),
+                known_slides=slides.slides,
+                filename=staging_file('long_range_plot_current.html'))
+
+        # Swap all the new plots in at once.
+        check_lease()
+        artifact_store.publish_artifacts(paths.staging_dir,
+                paths.manifest_file, paths.root)
+    stage_times['render'] = time.perf_counter() - stage_start
+
+    return stage_times, alerts
+
+
+def _load_days_before(last_ts, days, archive_dir):
+    dt_first = datetime.datetime.fromtimestamp(last_ts - days * 86400,
+            tz=pytz.utc)
+    return reading_archive.load_arrays(dt_first, archive_dir=archive_dir)
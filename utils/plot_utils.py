@@ -1,29 +1,38 @@
 """Utilities for plotting stream gauge data.
 """
 
+import math
+
 import pytz
 
-from plotly.graph_objs import Scatter, Layout
 from plotly import offline
 
+import utils.analysis_utils as a_utils
+from utils import time_utils
+
 
 aktz = pytz.timezone('US/Alaska')
 
 
 def plot_current_data_html(readings, critical_points=[], known_slides=[],
-        filename=None):
+        filename=None, local_times=None):
     """Plot IR gauge data, with critical points in red. Known slide
     events are indicated by a vertical line at the time of the event.
+    local_times is the readings' LocalTimes, if they've already been
+    converted for another plot.
     """
     # DEV: This fn should receive any relevant slides, it shouldn't do any
     #   data processing.
 
     # Plotly considers everything UTC. Send it strings, and it will
     #  plot the dates as they read.
-    datetimes = [str(reading.dt_reading.astimezone(aktz)) for reading in readings]
+    if local_times is None:
+        local_times = time_utils.LocalTimes.from_readings(readings)
+    datetimes = local_times.strings
     heights = [reading.height for reading in readings]
 
-    critical_datetimes = [str(reading.dt_reading.astimezone(aktz)) for reading in critical_points]
+    critical_datetimes = time_utils.LocalTimes.from_readings(
+            critical_points).strings
     critical_heights = [reading.height for reading in critical_points]
 
     min_height = min([reading.height for reading in readings])
@@ -38,7 +47,7 @@ def plot_current_data_html(readings, critical_points=[], known_slides=[],
 
     # Set filename.
     if not filename:
-        filename = f"ir_plot_{readings[-1].dt_reading.__str__()[:10]}.html"
+        filename = 'irg_viz/templates/irg_viz/plot_fragments/simple_irg_plot_current.html'
 
     data = [
         {
@@ -80,7 +89,8 @@ def plot_current_data_html(readings, critical_points=[], known_slides=[],
         'yaxis': {
                 'title': 'River height (ft)',
                 'range': [y_min, y_max]
-            }
+            },
+        'shapes': get_slide_shapes(known_slides, y_min, y_max),
     }
 
     fig = {'data': data, 'layout': my_layout}
@@ -91,76 +101,43 @@ def plot_current_data_html(readings, critical_points=[], known_slides=[],
     # filename = 'plot_files/simple_irg_plot_current.html'
     # offline.plot(fig, filename=filename, auto_open=False)
 
-    filename = 'irg_viz/templates/irg_viz/plot_fragments/simple_irg_plot_current.html'
     offline.plot(fig, filename=filename, auto_open=False)
 
 def plot_interactive_critical_forecast_html(readings, critical_points=[], known_slides=[],
-        filename=None):
+        filename=None, nowcast=None, local_times=None,
+        critical_points_by_rule=None):
     """Plot IR gauge data, with critical points in red. Known slide
     events are indicated by a vertical line at the time of the event.
+    If there's a nowcast, show its likely range of heights, and the chance
+    of becoming critical.
+    local_times is the readings' LocalTimes, if they've already been
+    converted for another plot.
+    If there's more than one critical rule, critical_points_by_rule marks
+    which rules each critical point met.
     """
     # DEV: This fn should receive any relevant slides, it shouldn't do any
     #   data processing.
 
     # Plotly considers everything UTC. Send it strings, and it will
     #  plot the dates as they read.
-    datetimes = [str(reading.dt_reading.astimezone(aktz)) for reading in readings]
+    if local_times is None:
+        local_times = time_utils.LocalTimes.from_readings(readings)
+    datetimes = local_times.strings
     heights = [reading.height for reading in readings]
 
-    critical_datetimes = [str(reading.dt_reading.astimezone(aktz)) for reading in critical_points]
+    critical_datetimes = time_utils.LocalTimes.from_readings(
+            critical_points).strings
     critical_heights = [reading.height for reading in critical_points]
 
     min_height = min([reading.height for reading in readings])
     max_height = max([reading.height for reading in readings])
 
-    # Build a set of future readings, once every 15 minutes for the next
-    #   6 hours.
-    # DEV: May want to only look ahead 4.5 hrs; looking farther ahead
-    #   than the critical 5-hour period seems less meaningful.
-    # DEV: Doing some imports here, because this will be moved to 
-    #   analysis_utils
-    import datetime
-    from .ir_reading import IRReading
-
-    interval = datetime.timedelta(minutes=15)
-    future_readings = []
-    new_reading_dt = readings[-1].dt_reading + interval
-    for _ in range(18):
-        new_reading = IRReading(new_reading_dt, 23.0)
-        future_readings.append(new_reading)
-        new_reading_dt += interval
-    future_datetimes = [str(r.dt_reading.astimezone(aktz)) for r in future_readings]
-    future_heights = [r.height for r in future_readings]
-
     # What are the future critical points?
-    #   These are the heights that would result in 5-hour total rise and 
-    #     average rate matching critical values.
     #   These are the minimum values needed to become, or remain, critical.
-    # DEV: Replace all 0.5 and 2.5 with M_CRITICAL and CRITICAL_RISE
-    min_cf_readings = []
-    latest_reading = readings[-1]
-    for reading in future_readings:
-        dt_lookback = reading.dt_reading - datetime.timedelta(hours=5)
-        # Get minimum height from last 5 hours of readings, including future readings.
-        # print(reading.dt_reading - datetime.timedelta(hours=5))
-        relevant_readings = [r for r in readings
-            if r.dt_reading >= dt_lookback]
-        relevant_readings += min_cf_readings
-        critical_height = min([r.height for r in relevant_readings]) + 2.5
-
-        # Make sure critical_height also gives a 5-hour average rise at least
-        #   as great as M_CRITICAL. Units are ft/hr.
-        m_avg = (critical_height - relevant_readings[0].height) / 5
-        if m_avg < 0.5:
-            # The critical height satisfies total rise, but not sustained rate
-            #   of rise. Bump critical height so it satisfies total rise and
-            #   rate of rise.
-            critical_height = 5 * 0.5 + relevant_readings[0].height
-
-        new_reading = IRReading(reading.dt_reading, critical_height)
-        min_cf_readings.append(new_reading)
-
-    min_cf_datetimes = [str(r.dt_reading.astimezone(aktz)) for r in min_cf_readings]
+    min_cf_readings = a_utils.get_min_critical_forecast(readings)
+
+    min_cf_datetimes = time_utils.LocalTimes.from_readings(
+            min_cf_readings).strings
     min_cf_heights = [r.height for r in min_cf_readings]
 
     # Want current data to be plotted with a consistent scale on the y axis.
@@ -172,7 +149,7 @@ def plot_interactive_critical_forecast_html(readings, critical_points=[], known_
 
     # Set filename.
     if not filename:
-        filename = f"ir_plot_{readings[-1].dt_reading.__str__()[:10]}.html"
+        filename = 'irg_viz/templates/irg_viz/plot_fragments/irg_critical_forecast_current.html'
 
     data = [
         {
@@ -206,6 +183,8 @@ def plot_interactive_critical_forecast_html(readings, critical_points=[], known_
                 'textposition': 'middle left'
             }
         )
+    if critical_points_by_rule and len(critical_points_by_rule) > 1:
+        data += get_rule_traces(critical_points_by_rule)
     # Plot minimum future critical readings.
     data.append(
         {
@@ -227,16 +206,21 @@ def plot_interactive_critical_forecast_html(readings, critical_points=[], known_
             'name': 'critical region',
         }
     )
+    title = f"Current Indian River Gauge Readings, {title_date_str}"
+    if nowcast:
+        data += get_nowcast_traces(nowcast)
+        title += f"<br>{nowcast.probability:.0%} chance of critical in the next 4.5 hours"
 
     my_layout = {
-        'title': f"Current Indian River Gauge Readings, {title_date_str}",
+        'title': title,
         'xaxis': {
                 'title': 'Date/ Time',
             },
         'yaxis': {
                 'title': 'River height (ft)',
                 'range': [y_min, y_max]
-            }
+            },
+        'shapes': get_slide_shapes(known_slides, y_min, y_max),
     }
 
     fig = {'data': data, 'layout': my_layout}
@@ -247,6 +231,129 @@ def plot_interactive_critical_forecast_html(readings, critical_points=[], known_
     # filename = 'plot_files/plot_interactive_critical_forecast.html'
     # offline.plot(fig, filename=filename, auto_open=False)
 
-    filename = 'irg_viz/templates/irg_viz/plot_fragments/irg_critical_forecast_current.html'
     offline.plot(fig, filename=filename, auto_open=False)
 
+
+def plot_long_range_html(long_range_data, known_slides=[], filename=None):
+    """Plot a downsampled overview of the reading archive. The page that
+    shows this plot asks for more detail whenever the x range changes.
+
+    long_range_data comes from downsample_utils.get_long_range_data().
+    """
+    heights = long_range_data['y']
+    if not heights:
+        print("No archived readings to plot.")
+        return
+
+    y_min, y_max = math.floor(min(heights)), math.ceil(max(heights))
+
+    data = [
+        {
+            # Downsampled gauge height data. This trace gets replaced as
+            #   the user zooms, so it has to stay first.
+            'type': 'scattergl',
+            'x': long_range_data['x'],
+            'y': heights,
+            'mode': 'lines',
+            'name': 'readings',
+        }
+    ]
+
+    my_layout = {
+        'title': "Indian River Gauge Readings, all archived data",
+        'xaxis': {
+                'title': 'Date/ Time',
+            },
+        'yaxis': {
+                'title': 'River height (ft)',
+                'range': [y_min, y_max]
+            },
+        'shapes': get_slide_shapes(known_slides, y_min, y_max),
+    }
+
+    fig = {'data': data, 'layout': my_layout}
+
+    if not filename:
+        filename = 'irg_viz/templates/irg_viz/plot_fragments/long_range_plot_current.html'
+    offline.plot(fig, filename=filename, auto_open=False)
+
+
+def get_nowcast_traces(nowcast):
+    """Return plotly traces for the middle 80% and median of the nowcast
+    paths.
+    """
+    nowcast_datetimes = time_utils.to_local_strings(
+            [dt.timestamp() for dt in nowcast.datetimes])
+    return [
+        {
+            'type': 'scatter',
+            'x': nowcast_datetimes,
+            'y': nowcast.percentiles['10'],
+            'mode': 'lines',
+            'line': {'width': 0},
+            'showlegend': False,
+            'hoverinfo': 'skip',
+        },
+        {
+            'type': 'scatter',
+            'x': nowcast_datetimes,
+            'y': nowcast.percentiles['90'],
+            'mode': 'lines',
+            'line': {'width': 0},
+            'fill': 'tonexty',
+            'fillcolor': 'rgba(31, 119, 180, 0.2)',
+            'name': 'likely range',
+        },
+        {
+            'type': 'scatter',
+            'x': nowcast_datetimes,
+            'y': nowcast.percentiles['50'],
+            'mode': 'lines',
+            'line': {'dash': 'dash', 'color': 'rgb(31, 119, 180)'},
+            'name': 'likely path',
+        },
+    ]
+
+
+def get_rule_traces(critical_points_by_rule):
+    """Return plotly traces marking the critical points that met each
+    rule, with a different marker for each rule.
+    """
+    symbols = ['circle-open', 'diamond-open', 'square-open', 'triangle-up-open']
+    traces = []
+    for index, (name, points) in enumerate(critical_points_by_rule.items()):
+        if not points:
+            continue
+        traces.append({
+            'type': 'scatter',
+            'x': time_utils.LocalTimes.from_readings(points).strings,
+            'y': [reading.height for reading in points],
+            'mode': 'markers',
+            'marker': {'color': 'black', 'size': 10,
+                    'symbol': symbols[index % len(symbols)]},
+            'name': name,
+        })
+    return traces
+
+
+def get_slide_shapes(known_slides, y_min, y_max):
+    """Return plotly shapes marking known slides. A slide with an exact
+    time is a vertical line; a slide with an uncertain time is a band
+    covering the interval.
+    """
+    shapes = []
+    for slide in known_slides:
+        shape = {
+            'type': 'line',
+            'x0': str(slide.dt_start.astimezone(aktz)),
+            'x1': str(slide.dt_end.astimezone(aktz)),
+            'y0': y_min,
+            'y1': y_max,
+            'line': {'color': 'black', 'width': 2, 'dash': 'dot'},
+        }
+        if slide.dt_end > slide.dt_start:
+            shape.update({'type': 'rect', 'fillcolor': 'black',
+                    'opacity': 0.15, 'line': {'width': 0}})
+        shapes.append(shape)
+
+    return shapes
@@ -1,80 +1,64 @@
 """Plotting utility functions, using mpl."""
 
+import os
+
+import numpy as np
 import pytz
 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+import utils.analysis_utils as a_utils
+from utils import margin_utils, time_utils
 
 
 aktz = pytz.timezone('US/Alaska')
 
+# Every static plot is drawn once at full size, and then saved at each of
+#   these widths. The full size image is 1280x768. Keep these in sync with
+#   the srcset in irg_viz/plot_image.html, and IMAGE_SUFFIXES in
+#   irg_viz/views.py.
+IMAGE_SIZES = [('', 1280), ('_640', 640), ('_320', 320)]
+WEBP_QUALITY = 80
+
+# The look of matplotlib's 'seaborn' style. It's applied to each figure as
+#   it's built, rather than with style.context(), which swaps the global
+#   rcParams and isn't safe when plots are rendered on several threads.
+FACE_COLOR = '#EAEAF2'
+TEXT_COLOR = '.15'
+LINE_WIDTH = 1.75
+PATCH_LINE_WIDTH = 0.3
+
 
 def plot_critical_forecast_mpl(readings, critical_points=[],
-        filename=None):
+        known_slides=[], filename=None, local_times=None):
     """Plot IR gauge data, with critical points in red. Known slide
     events are indicated by a vertical line at the time of the event.
+    local_times is the readings' LocalTimes, if they've already been
+    converted for another plot.
     """
     # DEV: This fn should receive any relevant slides, it shouldn't do any
     #   data processing.
 
-    # Matplotlib accepts datetimes as x values, so it should be handling
-    #   timezones appropriately.
-    datetimes = [reading.dt_reading.astimezone(aktz) for reading in readings]
+    # Plot utc datetime64 values, and label the x axis in local time.
+    if local_times is None:
+        local_times = time_utils.LocalTimes.from_readings(readings)
+    datetimes = local_times.utc
     heights = [reading.height for reading in readings]
 
-    critical_datetimes = [reading.dt_reading.astimezone(aktz) for reading in critical_points]
+    critical_datetimes = time_utils.LocalTimes.from_readings(
+            critical_points).utc
     critical_heights = [reading.height for reading in critical_points]
 
     min_height = min([reading.height for reading in readings])
     max_height = max([reading.height for reading in readings])
 
-    # Build a set of future readings, once every 15 minutes for the next
-    #   6 hours.
-    # DEV: May want to only look ahead 4.5 hrs; looking farther ahead
-    #   than the critical 5-hour period seems less meaningful.
-    # DEV: Doing some imports here, because this will be moved to 
-    #   analysis_utils
-    import datetime
-    from .ir_reading import IRReading
-
-    interval = datetime.timedelta(minutes=15)
-    future_readings = []
-    new_reading_dt = readings[-1].dt_reading + interval
-    for _ in range(18):
-        new_reading = IRReading(new_reading_dt, 23.0)
-        future_readings.append(new_reading)
-        new_reading_dt += interval
-    future_datetimes = [r.dt_reading.astimezone(aktz) for r in future_readings]
-    future_heights = [r.height for r in future_readings]
-
     # What are the future critical points?
-    #   These are the heights that would result in 5-hour total rise and 
-    #     average rate matching critical values.
     #   These are the minimum values needed to become, or remain, critical.
-    # DEV: Replace all 0.5 and 2.5 with M_CRITICAL and CRITICAL_RISE
-    min_cf_readings = []
-    latest_reading = readings[-1]
-    for reading in future_readings:
-        dt_lookback = reading.dt_reading - datetime.timedelta(hours=5)
-        # Get minimum height from last 5 hours of readings, including future readings.
-        # print(reading.dt_reading - datetime.timedelta(hours=5))
-        relevant_readings = [r for r in readings
-            if r.dt_reading >= dt_lookback]
-        relevant_readings += min_cf_readings
-        critical_height = min([r.height for r in relevant_readings]) + 2.5
-
-        # Make sure critical_height also gives a 5-hour average rise at least
-        #   as great as M_CRITICAL. Units are ft/hr.
-        m_avg = (critical_height - relevant_readings[0].height) / 5
-        if m_avg < 0.5:
-            # The critical height satisfies total rise, but not sustained rate
-            #   of rise. Bump critical height so it satisfies total rise and
-            #   rate of rise.
-            critical_height = 5 * 0.5 + relevant_readings[0].height
-
-        new_reading = IRReading(reading.dt_reading, critical_height)
-        min_cf_readings.append(new_reading)
-
-    min_cf_datetimes = [r.dt_reading.astimezone(aktz) for r in min_cf_readings]
+    min_cf_readings = a_utils.get_min_critical_forecast(readings)
+
+    min_cf_datetimes = time_utils.LocalTimes.from_readings(min_cf_readings).utc
     min_cf_heights = [r.height for r in min_cf_readings]
 
     # Want current data to be plotted with a consistent scale on the y axis.
@@ -84,15 +68,11 @@ def plot_critical_forecast_mpl(readings, critical_points=[],
     dt_title = readings[-1].dt_reading.astimezone(aktz)
     title_date_str = dt_title.strftime('%m/%d/%Y')
 
-    # Set filename.
-    if not filename:
-        filename = f"ir_plot_{readings[-1].dt_reading.__str__()[:10]}.html"
-
     # --- Plotting code
 
     # Build static plot image.
-    plt.style.use('seaborn')
-    fig, ax = plt.subplots(figsize=(10, 6), dpi=128)
+    fig, ax = new_figure()
+    ax.xaxis_date(aktz)
 
     # Always plot on an absolute y scale.
     ax.set_ylim([20.0, 27.5])
@@ -116,14 +96,19 @@ def plot_critical_forecast_mpl(readings, critical_points=[],
 
     # Plot minimum future critical readings.
     #   Plot these points, and shade to max y value.
-    ax.plot(min_cf_datetimes, min_cf_heights, c='red', alpha=0.4)
-    ax.fill_between(min_cf_datetimes, min_cf_heights, 27.5, color='red', alpha=0.2)
+    ax.plot(min_cf_datetimes, min_cf_heights, c='red', alpha=0.4,
+            linewidth=LINE_WIDTH)
+    ax.fill_between(min_cf_datetimes, min_cf_heights, 27.5, color='red',
+            alpha=0.2, linewidth=PATCH_LINE_WIDTH)
+
+    # Mark known slides.
+    plot_known_slides(ax, known_slides)
 
     # Set chart and axes titles, and other formatting.
     title = f"Indian River Gauge Readings, {title_date_str}"
-    ax.set_title(title, loc='left')
+    ax.set_title(title, loc='left', fontsize=12, color=TEXT_COLOR)
     ax.set_xlabel('', fontsize=16)
-    ax.set_ylabel("River height (ft)")
+    ax.set_ylabel("River height (ft)", fontsize=11, color=TEXT_COLOR)
 
 
 
@@ -166,12 +151,13 @@ def plot_critical_forecast_mpl(readings, critical_points=[],
 
     # DEV: Uncomment this to see interactive plots during dev work,
     #   rather than opening file images.
-    # plt.show()
+    # fig.show()
 
     # Save to file.
     # filename = f"current_ir_plots/ir_plot_{readings[-1].dt_reading.__str__()[:10]}.png"
-    filename = "media/plot_images/irg_critical_forecast_plot_current.png"
-    plt.savefig(filename)
+    if not filename:
+        filename = "media/plot_images/irg_critical_forecast_plot_current.png"
+    save_figure(fig, filename)
 
     # filename = "irg_viz/"
 
@@ -188,102 +174,46 @@ def plot_critical_forecast_mpl(readings, critical_points=[],
 
 
 def plot_critical_forecast_mpl_extended(readings, critical_points=[],
-        filename=None):
+        known_slides=[], filename=None, thumbnails=True, local_times=None):
     """Extends critical forecast back 6 hours as well.
+    local_times is the readings' LocalTimes, if they've already been
+    converted for another plot.
     """
     # DEV: This fn should receive any relevant slides, it shouldn't do any
     #   data processing.
 
-    # Matplotlib accepts datetimes as x values, so it should be handling
-    #   timezones appropriately.
-    datetimes = [reading.dt_reading.astimezone(aktz) for reading in readings]
+    # Plot utc datetime64 values, and label the x axis in local time.
+    if local_times is None:
+        local_times = time_utils.LocalTimes.from_readings(readings)
+    datetimes = local_times.utc
     heights = [reading.height for reading in readings]
 
-    critical_datetimes = [reading.dt_reading.astimezone(aktz) for reading in critical_points]
+    critical_datetimes = time_utils.LocalTimes.from_readings(
+            critical_points).utc
     critical_heights = [reading.height for reading in critical_points]
 
     min_height = min([reading.height for reading in readings])
     max_height = max([reading.height for reading in readings])
 
-    # Build a set of future readings, once every 15 minutes for the next
-    #   6 hours.
-    # DEV: May want to only look ahead 4.5 hrs; looking farther ahead
-    #   than the critical 5-hour period seems less meaningful.
-    # DEV: Doing some imports here, because this will be moved to 
-    #   analysis_utils
-    import datetime
-    from .ir_reading import IRReading
-
-    interval = datetime.timedelta(minutes=15)
-    future_readings = []
-    new_reading_dt = readings[-1].dt_reading + interval
-    for _ in range(18):
-        new_reading = IRReading(new_reading_dt, 23.0)
-        future_readings.append(new_reading)
-        new_reading_dt += interval
-    future_datetimes = [r.dt_reading.astimezone(aktz) for r in future_readings]
-    future_heights = [r.height for r in future_readings]
-
     # What are the future critical points?
-    #   These are the heights that would result in 5-hour total rise and 
-    #     average rate matching critical values.
     #   These are the minimum values needed to become, or remain, critical.
-    # DEV: Replace all 0.5 and 2.5 with M_CRITICAL and CRITICAL_RISE
-    min_cf_readings = []
-    latest_reading = readings[-1]
-    for reading in future_readings:
-        dt_lookback = reading.dt_reading - datetime.timedelta(hours=5)
-        # Get minimum height from last 5 hours of readings, including future readings.
-        # print(reading.dt_reading - datetime.timedelta(hours=5))
-        relevant_readings = [r for r in readings
-            if r.dt_reading >= dt_lookback]
-        relevant_readings += min_cf_readings
-        critical_height = min([r.height for r in relevant_readings]) + 2.5
-
-        # Make sure critical_height also gives a 5-hour average rise at least
-        #   as great as M_CRITICAL. Units are ft/hr.
-        m_avg = (critical_height - relevant_readings[0].height) / 5
-        if m_avg < 0.5:
-            # The critical height satisfies total rise, but not sustained rate
-            #   of rise. Bump critical height so it satisfies total rise and
-            #   rate of rise.
-            critical_height = 5 * 0.5 + relevant_readings[0].height
-
-        new_reading = IRReading(reading.dt_reading, critical_height)
-        min_cf_readings.append(new_reading)
-
-    min_cf_datetimes = [r.dt_reading.astimezone(aktz) for r in min_cf_readings]
+    min_cf_readings = a_utils.get_min_critical_forecast(readings)
+
+    min_cf_datetimes = time_utils.LocalTimes.from_readings(min_cf_readings).utc
     min_cf_heights = [r.height for r in min_cf_readings]
 
     # What would the critical points have been over the last 6 hours?
     #   This shows how close conditions were to being critical over the
-    #   previous 6 hours.
-    dt_first_min_prev_reading = latest_reading.dt_reading - datetime.timedelta(hours=6)
-    min_crit_prev_readings = [IRReading(r.dt_reading, 27.0)
-                                for r in readings
-                                if r.dt_reading >= dt_first_min_prev_reading]
-
-    for reading in min_crit_prev_readings:
-        dt_lookback = reading.dt_reading - datetime.timedelta(hours=5)
-        # Get minimum height from last 5 hours of readings.
-        relevant_readings = [r for r in readings
-            if (r.dt_reading >= dt_lookback) and (r.dt_reading < reading.dt_reading)]
-        critical_height = min([r.height for r in relevant_readings]) + 2.5
-
-        # Make sure critical_height also gives a 5-hour average rise at least
-        #   as great as M_CRITICAL. Units are ft/hr.
-        m_avg = (critical_height - relevant_readings[0].height) / 5
-        if m_avg < 0.5:
-            # The critical height satisfies total rise, but not sustained rate
-            #   of rise. Bump critical height so it satisfies total rise and
-            #   rate of rise.
-            critical_height = 5 * 0.5 + relevant_readings[0].height
-
-        reading.height = critical_height
-
-    min_crit_prev_datetimes = [r.dt_reading.astimezone(aktz)
-                                for r in min_crit_prev_readings]
-    min_crit_prev_heights = [r.height for r in min_crit_prev_readings]
+    #   previous 6 hours: each reading's height, plus its margin to critical.
+    #   The first reading has nothing to look back on, so it has no margin.
+    ts_first_min_prev_reading = local_times.timestamps[-1] - 6 * 3600
+    margins = margin_utils.compute_margins(local_times.timestamps,
+            np.asarray(heights))
+    in_prev = ((local_times.timestamps >= ts_first_min_prev_reading)
+            & ~np.isnan(margins['margin']))
+
+    min_crit_prev_datetimes = local_times.utc[in_prev]
+    min_crit_prev_heights = (margins['height'] + margins['margin'])[in_prev]
 
     # Want current data to be plotted with a consistent scale on the y axis.
     y_min, y_max = 20.0, 27.5
@@ -299,8 +229,8 @@ def plot_critical_forecast_mpl_extended(readings, critical_points=[],
     # --- Plotting code
 
     # Build static plot image.
-    plt.style.use('seaborn')
-    fig, ax = plt.subplots(figsize=(10, 6), dpi=128)
+    fig, ax = new_figure()
+    ax.xaxis_date(aktz)
 
     # Always plot on an absolute y scale.
     ax.set_ylim([20.0, 27.5])
@@ -324,21 +254,27 @@ def plot_critical_forecast_mpl_extended(readings, critical_points=[],
 
     # Plot minimum future critical readings.
     #   Plot these points, and shade to max y value.
-    ax.plot(min_cf_datetimes, min_cf_heights, c='red', alpha=0.4)
-    ax.fill_between(min_cf_datetimes, min_cf_heights, 27.5, color='red', alpha=0.2)
+    ax.plot(min_cf_datetimes, min_cf_heights, c='red', alpha=0.4,
+            linewidth=LINE_WIDTH)
+    ax.fill_between(min_cf_datetimes, min_cf_heights, 27.5, color='red',
+            alpha=0.2, linewidth=PATCH_LINE_WIDTH)
+
+    # Mark known slides.
+    plot_known_slides(ax, known_slides)
 
     # Plot previous critical readings, and shade to max y value.
-    ax.plot(min_crit_prev_datetimes, min_crit_prev_heights, c='red', alpha=0.3)
+    ax.plot(min_crit_prev_datetimes, min_crit_prev_heights, c='red', alpha=0.3,
+            linewidth=LINE_WIDTH)
     ax.fill_between(min_crit_prev_datetimes, min_crit_prev_heights, 27.5,
-                                                    color='red', alpha=0.1)
+            color='red', alpha=0.1, linewidth=PATCH_LINE_WIDTH)
 
 
     # Set chart and axes titles, and other formatting.
     ts_title = dt_title.strftime("%H:%M:%S")
     title = f"Indian River Gauge Readings, {title_date_str}, {ts_title}"
-    ax.set_title(title, loc='left')
+    ax.set_title(title, loc='left', fontsize=12, color=TEXT_COLOR)
     ax.set_xlabel('', fontsize=16)
-    ax.set_ylabel("River height (ft)")
+    ax.set_ylabel("River height (ft)", fontsize=11, color=TEXT_COLOR)
 
 
     # Make major and minor x ticks small.
@@ -346,15 +282,67 @@ def plot_critical_forecast_mpl_extended(readings, critical_points=[],
 
     # DEV: Uncomment this to see interactive plots during dev work,
     #   rather than opening file images.
-    # plt.show()
+    # fig.show()
 
     # Save to file.
     # filename = f"current_ir_plots/ir_plot_{readings[-1].dt_reading.__str__()[:10]}.png"
     if not filename:
         filename = "media/plot_images/irg_critical_forecast_plot_current_extended.png"
-    plt.savefig(filename)
+    save_figure(fig, filename, thumbnails=thumbnails)
 
     print(f"  saved: {filename}")
 
-    # Close figure, especially helpful when rendering many frames for animation.
-    plt.close('all')
\ No newline at end of file
+
+def new_figure():
+    """Return a new figure and its axes, in the 'seaborn' look."""
+    fig = Figure(figsize=(10, 6), dpi=128, facecolor='white')
+    ax = fig.add_subplot(111, facecolor=FACE_COLOR, axisbelow=True)
+    ax.grid(True, color='white', linestyle='-', linewidth=1.0)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.tick_params(which='both', length=0, pad=7, colors=TEXT_COLOR,
+            labelsize=10)
+    return fig, ax
+
+
+def plot_known_slides(ax, known_slides):
+    """Mark known slides with a vertical line, or a band if the time of
+    the slide is uncertain.
+    """
+    for slide in known_slides:
+        dt_start = slide.dt_start.astimezone(aktz)
+        dt_end = slide.dt_end.astimezone(aktz)
+        if dt_end > dt_start:
+            ax.axvspan(dt_start, dt_end, color='black', alpha=0.15,
+                    linewidth=PATCH_LINE_WIDTH)
+        else:
+            ax.axvline(dt_start, color='black', linestyle=':', linewidth=1.5)
+
+
+def save_figure(fig, filename, thumbnails=True):
+    """Draw the figure once, and save the result at every size in
+    IMAGE_SIZES, as png and webp.
+
+    filename is the full size png; the other files are named from it, ie
+      irg_plot.png, irg_plot.webp, irg_plot_640.png, irg_plot_640.webp...
+    If thumbnails is False, only the full size png is saved.
+    """
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    image = Image.frombuffer('RGBA', (width, height), canvas.buffer_rgba(),
+            'raw', 'RGBA', 0, 1).convert('RGB')
+
+    if not thumbnails:
+        image.save(filename, optimize=True)
+        return
+
+    base, _ = os.path.splitext(filename)
+    for suffix, size_width in IMAGE_SIZES:
+        if size_width < width:
+            size_height = round(height * size_width / width)
+            sized_image = image.resize((size_width, size_height), Image.LANCZOS)
+        else:
+            sized_image = image
+        sized_image.save(f"{base}{suffix}.png", optimize=True)
+        sized_image.save(f"{base}{suffix}.webp", quality=WEBP_QUALITY, method=6)
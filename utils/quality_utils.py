@@ -0,0 +1,158 @@
+"""Data quality checks for gauge readings.
+
+Every source of readings goes through the same cleaning stage before
+analysis: readings are sorted, duplicate timestamps and invalid heights are
+dropped, and single-reading spikes and gaps are flagged. All of the work
+is done on arrays, so cleaning millions of readings takes a fraction of a
+second.
+
+Flags are per reading, and nothing is dropped for a flag unless asked: a
+sharp crest can look like a spike, and losing a real crest is worse than
+plotting a bad reading.
+"""
+
+import datetime
+
+import numpy as np
+import pytz
+
+from utils import resample_utils
+
+
+# A reading that jumps at least this far from both of its neighbors, in
+#   the same direction, is a sensor spike rather than a change in the river.
+SPIKE_FT = 1.0
+
+# Anything longer than this between readings is a gap.
+GAP_MINUTES = resample_utils.MAX_GAP_MINUTES
+
+# Quality flags, as bits.
+FLAG_SPIKE = 1
+# The first reading after a gap.
+FLAG_AFTER_GAP = 2
+
+
+class QualityReport:
+    """Summary of what the cleaning stage found."""
+
+    def __init__(self, num_readings=0, num_out_of_order=0, num_duplicates=0,
+            num_invalid=0, num_spikes=0, gaps=None, spikes_dropped=False):
+        self.num_readings = num_readings
+        self.num_out_of_order = num_out_of_order
+        self.num_duplicates = num_duplicates
+        self.num_invalid = num_invalid
+        self.num_spikes = num_spikes
+        # List of (last_ts before the gap, first_ts after the gap).
+        self.gaps = gaps if gaps else []
+        self.spikes_dropped = spikes_dropped
+
+    @property
+    def num_removed(self):
+        num_removed = self.num_duplicates + self.num_invalid
+        if self.spikes_dropped:
+            num_removed += self.num_spikes
+        return num_removed
+
+    def has_issues(self):
+        return bool(self.num_out_of_order or self.num_removed
+                or self.num_spikes or self.gaps)
+
+    def get_formatted_report(self):
+        """Print a neat summary of the report."""
+        lines = [
+            f"Readings: {self.num_readings}, "
+                f"kept: {self.num_readings - self.num_removed}",
+            f"  out of order: {self.num_out_of_order}",
+            f"  duplicates: {self.num_duplicates}",
+            f"  invalid heights: {self.num_invalid}",
+            f"  spikes: {self.num_spikes}"
+                f" ({'removed' if self.spikes_dropped else 'flagged'})",
+            f"  gaps over {GAP_MINUTES} min: {len(self.gaps)}",
+        ]
+        for ts_before, ts_after in self.gaps[:10]:
+            dt_before = datetime.datetime.fromtimestamp(ts_before, tz=pytz.utc)
+            hours = (ts_after - ts_before) / 3600
+            lines.append(f"    {dt_before.strftime('%m/%d/%Y %H:%M:%S')} - {hours:.2f} hrs")
+        return '\n'.join(lines)
+
+
+def clean_arrays(timestamps, heights, spike_ft=SPIKE_FT,
+        gap_minutes=GAP_MINUTES, drop_spikes=False, context=None):
+    """Clean readings given as epoch-second and height arrays.
+
+    context is the epoch-second and height arrays of clean readings just
+      before these, ie the end of the archive. They're neighbors for the
+      spike and gap checks, but aren't returned or counted.
+    Returns the indices of the readings to keep, in chronological order,
+      their quality flags, and a QualityReport. Of duplicate timestamps,
+      the last one wins. Spikes are only dropped with drop_spikes.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.float64)
+    num_readings = len(timestamps)
+    report = QualityReport(num_readings, spikes_dropped=drop_spikes)
+    if not num_readings:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8),
+                report)
+
+    report.num_out_of_order = int((np.diff(timestamps) < 0).sum())
+    if context is not None:
+        # Context goes first, so a new reading replaces it.
+        context_ts, context_heights = context
+        num_context = len(context_ts)
+        timestamps = np.concatenate((np.asarray(context_ts, dtype=np.int64),
+                timestamps))
+        heights = np.concatenate((np.asarray(context_heights,
+                dtype=np.float64), heights))
+    else:
+        num_context = 0
+
+    # Sort, keeping input order among duplicates so the last one wins.
+    order = np.argsort(timestamps, kind='stable')
+    sorted_ts = timestamps[order]
+    is_last = np.append(sorted_ts[1:] != sorted_ts[:-1], True)
+    report.num_duplicates = int((~is_last & (order >= num_context)).sum())
+    order = order[is_last]
+
+    valid = np.isfinite(heights[order])
+    report.num_invalid = int((~valid & (order >= num_context)).sum())
+    order = order[valid]
+
+    # A spike jumps away from both neighbors, in the same direction.
+    #   Neighbors across a gap don't count.
+    h, ts = heights[order], timestamps[order]
+    flags = np.zeros(len(order), dtype=np.uint8)
+    if len(h) > 2:
+        d_prev = h[1:-1] - h[:-2]
+        d_next = h[1:-1] - h[2:]
+        close = ((ts[1:-1] - ts[:-2] <= gap_minutes * 60)
+                & (ts[2:] - ts[1:-1] <= gap_minutes * 60))
+        spikes = (close & (np.sign(d_prev) == np.sign(d_next))
+                & (np.minimum(np.abs(d_prev), np.abs(d_next)) >= spike_ft))
+        flags[1:-1][spikes] |= FLAG_SPIKE
+
+    is_new = order >= num_context
+    report.num_spikes = int(((flags & FLAG_SPIKE) > 0)[is_new].sum())
+    if drop_spikes:
+        kept = ((flags & FLAG_SPIKE) == 0) | ~is_new
+        order, flags, is_new = order[kept], flags[kept], is_new[kept]
+
+    kept_ts = timestamps[order]
+    after_gap = np.flatnonzero(np.diff(kept_ts) > gap_minutes * 60) + 1
+    after_gap = after_gap[is_new[after_gap]]
+    flags[after_gap] |= FLAG_AFTER_GAP
+    report.gaps = [(int(kept_ts[i - 1]), int(kept_ts[i])) for i in after_gap]
+
+    return order[is_new] - num_context, flags[is_new], report
+
+
+def clean_readings(readings, spike_ft=SPIKE_FT, gap_minutes=GAP_MINUTES,
+        drop_spikes=False):
+    """Clean a list of IRReadings.
+    Returns the cleaned readings, in chronological order, their quality
+    flags, and a QualityReport.
+    """
+    timestamps, heights = resample_utils.readings_to_arrays(readings)
+    kept_indices, flags, report = clean_arrays(timestamps, heights, spike_ft,
+            gap_minutes, drop_spikes)
+    return [readings[i] for i in kept_indices], flags, report
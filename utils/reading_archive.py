@@ -0,0 +1,164 @@
+"""Local archive of historical gauge readings.
+
+Readings are stored as arrays of epoch seconds and heights, one .npy file
+per month (utc), sorted and without duplicate timestamps. Loading a time
+range only opens the months that overlap it, and months are memory-mapped
+so nothing is parsed. Other stores kept by reading time, like the rollups
+and the margins, use the same layout through save_records() and
+load_records().
+"""
+
+import os
+
+import numpy as np
+
+from utils import resample_utils
+
+
+ARCHIVE_DIR = 'historical_data/readings'
+
+READING_DTYPE = np.dtype([('ts', '<i8'), ('height', '<f8')])
+
+
+def save_arrays(timestamps, heights, archive_dir=ARCHIVE_DIR):
+    """Merge readings into the archive. A reading with the same timestamp
+    as one already stored replaces it.
+    """
+    records = np.empty(len(timestamps), dtype=READING_DTYPE)
+    records['ts'] = timestamps
+    records['height'] = heights
+    save_records(records, archive_dir)
+
+
+def save_readings(readings, archive_dir=ARCHIVE_DIR):
+    """Merge a list of IRReadings into the archive."""
+    timestamps = [int(r.dt_reading.timestamp()) for r in readings]
+    heights = [r.height for r in readings]
+    save_arrays(np.array(timestamps, dtype=np.int64), np.array(heights),
+            archive_dir)
+
+
+def load_arrays(dt_start=None, dt_end=None, archive_dir=ARCHIVE_DIR):
+    """Return epoch seconds and heights for all archived readings from
+    dt_start to dt_end, inclusive. Either end can be left open.
+    """
+    records = load_records(dt_start, dt_end, archive_dir, READING_DTYPE)
+    return records['ts'], records['height']
+
+
+def save_records(records, record_dir):
+    """Merge structured records with a 'ts' field into one file per month
+    in record_dir. Only the months the records fall in are rewritten. A
+    record with the same timestamp as one already stored replaces it.
+    """
+    os.makedirs(record_dir, exist_ok=True)
+    months = get_month_keys(records['ts'])
+    for month in np.unique(months):
+        month_records = records[months == month]
+        filename = _get_month_file(month, record_dir)
+        if os.path.exists(filename):
+            month_records = np.concatenate((np.load(filename), month_records))
+        month_records = _sort_unique(month_records)
+
+        # Write to a temp file and rename, so readers never see a
+        #   partly written month.
+        tmp_filename = f"{filename}.tmp.npy"
+        np.save(tmp_filename, month_records)
+        os.replace(tmp_filename, filename)
+
+
+def load_records(dt_start=None, dt_end=None, record_dir=ARCHIVE_DIR,
+        dtype=READING_DTYPE):
+    """Return the records in record_dir from dt_start to dt_end, inclusive,
+    as one array of dtype. Either end can be left open.
+    """
+    ts_start = dt_start.timestamp() if dt_start else -np.inf
+    ts_end = dt_end.timestamp() if dt_end else np.inf
+
+    chunks = []
+    for month in get_months(record_dir):
+        month_start, month_end = get_month_bounds(month)
+        if month_end <= ts_start or month_start > ts_end:
+            continue
+        chunks.append(load_month(month, record_dir, ts_start, ts_end))
+
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def load_month(month, record_dir=ARCHIVE_DIR, ts_start=-np.inf,
+        ts_end=np.inf):
+    """Return one month's records from ts_start to ts_end, inclusive,
+    memory-mapped.
+    """
+    records = np.load(_get_month_file(month, record_dir), mmap_mode='r')
+    lo = np.searchsorted(records['ts'], ts_start, side='left')
+    hi = np.searchsorted(records['ts'], ts_end, side='right')
+    return records[lo:hi]
+
+
+def load_readings(dt_start=None, dt_end=None, archive_dir=ARCHIVE_DIR):
+    """Return archived readings from dt_start to dt_end as IRReadings."""
+    timestamps, heights = load_arrays(dt_start, dt_end, archive_dir)
+    return resample_utils.arrays_to_readings(timestamps, heights)
+
+
+def get_months(archive_dir=ARCHIVE_DIR):
+    """Return the months in the archive, as sorted 'YYYY-MM' strings."""
+    if not os.path.isdir(archive_dir):
+        return []
+    return sorted(f[:-4] for f in os.listdir(archive_dir)
+                    if f.endswith('.npy') and '.tmp' not in f)
+
+
+def get_last_timestamp(archive_dir=ARCHIVE_DIR):
+    """Return the epoch time of the latest archived reading, or None."""
+    months = get_months(archive_dir)
+    if not months:
+        return None
+    records = np.load(_get_month_file(months[-1], archive_dir), mmap_mode='r')
+    return int(records['ts'][-1]) if len(records) else None
+
+
+def count_readings(dt_end=None, archive_dir=ARCHIVE_DIR):
+    """Return how many readings are archived up to dt_end, inclusive. Only
+    the last month counted is searched; the rest are just memory-mapped.
+    """
+    ts_end = dt_end.timestamp() if dt_end else np.inf
+    num_readings = 0
+    for month in get_months(archive_dir):
+        month_start, month_end = get_month_bounds(month)
+        if month_start > ts_end:
+            break
+        records = np.load(_get_month_file(month, archive_dir), mmap_mode='r')
+        if month_end <= ts_end:
+            num_readings += len(records)
+        else:
+            num_readings += int(np.searchsorted(records['ts'], ts_end,
+                    side='right'))
+    return num_readings
+
+
+def get_month_keys(timestamps):
+    """Return a 'YYYY-MM' key for each timestamp."""
+    return np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='M')
+
+
+def get_month_bounds(month):
+    """Return epoch seconds for the start of this month and the next."""
+    start = np.datetime64(month, 'M')
+    bounds = np.array([start, start + 1]).astype('datetime64[s]')
+    return bounds.astype(np.int64)
+
+
+def _get_month_file(month, archive_dir):
+    return os.path.join(archive_dir, f"{month}.npy")
+
+
+def _sort_unique(records):
+    """Sort records by timestamp, keeping the last of any duplicates."""
+    order = np.argsort(records['ts'], kind='stable')
+    records = records[order]
+    is_last = np.append(records['ts'][1:] != records['ts'][:-1], True)
+    return records[is_last]
@@ -0,0 +1,195 @@
+"""Replay archived readings through the live refresh pipeline.
+
+A replay steps a virtual clock through a stretch of history, one refresh
+cycle at a time. Each cycle sees only the readings a live fetch would have
+returned at that moment, and runs them through the same pipeline as
+refresh: ingest, detect, publish, and render. The clock runs at a speedup
+over real time, so a storm that took two days replays in minutes.
+
+Everything the pipeline writes goes into a separate replay directory, so
+a replay never touches the live archive, alert state or site. Each replay
+starts from an empty directory, so its archive, alerts and plots are its
+own. A directory left by an earlier replay is cleared; any other directory
+that isn't empty is refused.
+
+The report shows whether the pipeline kept up. If cycles take longer than
+the real time between them, the backlog grows; the fastest sustainable
+speedup is the cycle length divided by the mean cycle time.
+"""
+
+import bisect, datetime, os, shutil, time
+
+import numpy as np
+
+from utils import alert_utils, pipeline_utils
+
+
+REPLAY_DIR = 'replay_output'
+
+# Live refreshes run every 15 minutes, and fetch the last 3 days.
+CYCLE_MINUTES = 15
+FETCH_DAYS = pipeline_utils.FETCH_DAYS
+SPEEDUP = 60
+# Without a start time, start once there's enough history to detect
+#   critical conditions.
+WARMUP_HOURS = 6
+
+# Marks a directory as a replay's output, so it's safe to clear.
+MARKER_FILE = '.irg_replay'
+
+
+class VirtualClock:
+    """A clock that's set at the start of each cycle, and then runs at
+    speedup times real time.
+    """
+
+    def __init__(self, dt_start, speedup=SPEEDUP):
+        self.speedup = speedup if speedup else 1
+        self.set(dt_start)
+
+    def set(self, dt):
+        self._dt = dt
+        self._real_start = time.perf_counter()
+
+    def now(self):
+        elapsed = time.perf_counter() - self._real_start
+        return self._dt + datetime.timedelta(seconds=elapsed * self.speedup)
+
+
+class ReplayReport:
+    """Timing of every cycle in a replay."""
+
+    def __init__(self, speedup, cycle_minutes):
+        self.speedup = speedup
+        self.cycle_minutes = cycle_minutes
+        self.cycle_times = []
+        self.stage_times = {stage: [] for stage in pipeline_utils.STAGES}
+        # How far behind schedule each cycle started, in real seconds.
+        self.lags = []
+        self.num_readings = 0
+        self.alerts = []
+        self.real_seconds = 0
+
+    def add_cycle(self, cycle_time, stage_times, lag, num_new_readings,
+            alerts):
+        self.cycle_times.append(cycle_time)
+        for stage, seconds in stage_times.items():
+            self.stage_times[stage].append(seconds)
+        self.lags.append(lag)
+        self.num_readings += num_new_readings
+        self.alerts += alerts
+
+    @property
+    def max_speedup(self):
+        """The fastest speedup the pipeline could sustain."""
+        return self.cycle_minutes * 60 / np.mean(self.cycle_times)
+
+    def get_formatted_report(self):
+        """Return a neat summary of the replay."""
+        if not self.cycle_times:
+            return "No cycles replayed; no readings in the replay's range."
+
+        cycle_times = np.array(self.cycle_times) * 1000
+        speedup = f"{self.speedup}x" if self.speedup else "as fast as possible"
+        lines = [
+            f"Replayed {len(cycle_times)} cycles, {self.num_readings} readings,"
+                f" in {self.real_seconds:.1f} s ({speedup}).",
+            f"  throughput: {len(cycle_times) / self.real_seconds:.2f} cycles/s,"
+                f" {self.num_readings / self.real_seconds:.1f} readings/s",
+            f"  cycle time: p50 {np.percentile(cycle_times, 50):.0f} ms,"
+                f" p95 {np.percentile(cycle_times, 95):.0f} ms,"
+                f" max {cycle_times.max():.0f} ms",
+        ]
+        for stage, times in self.stage_times.items():
+            lines.append(f"    {stage}: mean {np.mean(times) * 1000:.0f} ms")
+        if self.speedup:
+            cycle_real = self.cycle_minutes * 60 / self.speedup
+            lines.append(f"  backlog: max {max(self.lags):.1f} s"
+                    f" ({max(self.lags) / cycle_real:.1f} cycles),"
+                    f" final {self.lags[-1]:.1f} s")
+        lines.append(f"  max sustainable speedup: {self.max_speedup:.0f}x")
+        lines.append(f"  alerts: {len(self.alerts)}")
+        for alert in self.alerts:
+            latency = alert.reading_latency.total_seconds() / 60
+            lines.append(f"    {alert.get_formatted_alert()}"
+                    f" ({latency:.1f} min after the reading)")
+        return '\n'.join(lines)
+
+
+def replay(readings, dt_start=None, dt_end=None, speedup=SPEEDUP,
+        cycle_minutes=CYCLE_MINUTES, render=True, replay_dir=REPLAY_DIR,
+        slides=None):
+    """Replay readings through the refresh pipeline, one cycle every
+    cycle_minutes of virtual time from dt_start to dt_end.
+
+    A speedup of 0 runs every cycle as soon as the last one finishes, to
+      find the pipeline's maximum rate.
+    Returns a ReplayReport.
+    """
+    dts = [r.dt_reading for r in readings]
+    dt_start = dt_start if dt_start else dts[0] + datetime.timedelta(
+            hours=WARMUP_HOURS)
+    dt_end = dt_end if dt_end else dts[-1]
+    cycle = datetime.timedelta(minutes=cycle_minutes)
+    fetch = datetime.timedelta(days=FETCH_DAYS)
+
+    prepare_replay_dir(replay_dir)
+    paths = pipeline_utils.PipelinePaths(replay_dir)
+    clock = VirtualClock(dt_start, speedup)
+    alert_engine = alert_utils.AlertEngine(
+            [alert_utils.FileChannel(paths.alert_log_file)],
+            state_file=paths.alert_state_file, clock=clock.now)
+
+    report = ReplayReport(speedup, cycle_minutes)
+    real_start = time.perf_counter()
+    num_fed = bisect.bisect_right(dts, dt_start - cycle)
+    dt_cycle = dt_start
+    cycle_number = 0
+    while dt_cycle <= dt_end:
+        lag = 0
+        if speedup:
+            scheduled = real_start + cycle_number * cycle.total_seconds() / speedup
+            lag = time.perf_counter() - scheduled
+            if lag < 0:
+                time.sleep(-lag)
+                lag = 0
+
+        # What a live fetch would return at this moment.
+        first = bisect.bisect_left(dts, dt_cycle - fetch)
+        last = bisect.bisect_right(dts, dt_cycle)
+        clock.set(dt_cycle)
+
+        cycle_start = time.perf_counter()
+        if last > first:
+            stage_times, alerts = pipeline_utils.run_pipeline(
+                    readings[first:last], clock.now(), slides,
+                    alert_engine, render, verbose=False, paths=paths)
+            report.add_cycle(time.perf_counter() - cycle_start,
+                    stage_times, lag, last - num_fed, alerts)
+        num_fed = max(num_fed, last)
+
+        dt_cycle += cycle
+        cycle_number += 1
+
+    report.real_seconds = time.perf_counter() - real_start
+    return report
+
+
+def prepare_replay_dir(replay_dir=REPLAY_DIR):
+    """Start a replay from an empty directory. A directory left by an
+    earlier replay is cleared; any other directory that isn't empty
+    raises ValueError.
+    """
+    if os.path.isdir(replay_dir) and os.listdir(replay_dir):
+        if not os.path.exists(os.path.join(replay_dir, MARKER_FILE)):
+            raise ValueError(f"{replay_dir} isn't empty, and isn't the output"
+                    " of an earlier replay.")
+        for name in os.listdir(replay_dir):
+            path = os.path.join(replay_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    os.makedirs(replay_dir, exist_ok=True)
+    open(os.path.join(replay_dir, MARKER_FILE), 'w').close()
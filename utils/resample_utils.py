@@ -0,0 +1,167 @@
+"""Utilities for putting readings on a regular time grid.
+
+Older archives are hourly, recent data comes in every 15 minutes, and the
+feed drops readings now and then. Anything that looks back a fixed number
+of readings needs a guaranteed stride, so resample the readings first and
+work with the regular series.
+"""
+
+import datetime
+
+import numpy as np
+import pytz
+
+from utils.ir_reading import IRReading
+
+
+# Gaps in the source data longer than this are left as gaps, rather than
+#   being filled by interpolation. Hourly data is filled in when resampled
+#   to a 15-minute grid.
+MAX_GAP_MINUTES = 60
+
+
+class RegularSeries:
+    """A set of heights on a fixed time grid.
+
+    Slots that no reading landed on, and that are too far from real readings
+      to interpolate, have a height of nan. source_index maps each slot back
+      to the reading it came from, or -1 if the slot was filled or is a gap.
+    """
+
+    def __init__(self, start, interval, heights, source_index):
+        """start is epoch seconds of the first slot; interval is in seconds."""
+        self.start = int(start)
+        self.interval = int(interval)
+        self.heights = heights
+        self.source_index = source_index
+
+    def __len__(self):
+        return len(self.heights)
+
+    @property
+    def readings_per_hr(self):
+        return 3600 // self.interval
+
+    @property
+    def timestamps(self):
+        """Epoch seconds of every slot."""
+        return self.start + np.arange(len(self.heights),
+                dtype=np.int64) * self.interval
+
+    @property
+    def gaps(self):
+        """Boolean mask of slots with no usable height."""
+        return np.isnan(self.heights)
+
+    @property
+    def interpolated(self):
+        """Boolean mask of slots filled in from neighboring readings."""
+        return (self.source_index < 0) & ~self.gaps
+
+    def get_index(self, dt):
+        """Return the slot for a datetime, in constant time.
+        The index may fall outside the series.
+        """
+        return int(round((dt.timestamp() - self.start) / self.interval))
+
+    def get_datetime(self, index):
+        """Return the utc datetime for a slot."""
+        ts = self.start + index * self.interval
+        return datetime.datetime.fromtimestamp(ts, tz=pytz.utc)
+
+    def get_gap_periods(self):
+        """Return a list of (first_dt, last_dt) for each run of missing slots."""
+        gaps = self.gaps.astype(np.int8)
+        edges = np.diff(np.concatenate(([0], gaps, [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1) - 1
+        return [(self.get_datetime(s), self.get_datetime(e))
+                    for s, e in zip(starts, ends)]
+
+
+def readings_to_arrays(readings):
+    """Return epoch seconds and heights for a set of readings, as arrays."""
+    timestamps = np.fromiter((r.dt_reading.timestamp() for r in readings),
+            dtype=np.float64, count=len(readings)).astype(np.int64)
+    heights = np.fromiter((r.height for r in readings), dtype=np.float64,
+            count=len(readings))
+    return timestamps, heights
+
+
+def arrays_to_readings(timestamps, heights):
+    """Return a list of IRReadings from epoch seconds and heights."""
+    return [IRReading(datetime.datetime.fromtimestamp(ts, tz=pytz.utc),
+                float(height)) for ts, height in zip(timestamps.tolist(), heights)]
+
+
+def infer_interval(timestamps):
+    """Return the reading interval, in seconds.
+
+    Uses the finest interval that shows up regularly, so a set of readings
+      that switches from hourly to 15-minute data resolves to 15 minutes.
+      A single odd interval doesn't count.
+    """
+    diffs = np.diff(np.sort(timestamps))
+    diffs = diffs[diffs > 0]
+    if not len(diffs):
+        return 3600
+
+    intervals, counts = np.unique(diffs, return_counts=True)
+    common = intervals[counts >= max(1, 0.1 * len(diffs))]
+    if not len(common):
+        return int(np.median(diffs))
+    return int(common[0])
+
+
+def resample_readings(readings, interval_minutes=None,
+        max_gap_minutes=MAX_GAP_MINUTES):
+    """Put a set of readings on a regular grid.
+    Returns a RegularSeries.
+
+    If interval_minutes is None, the interval is inferred from the readings.
+    Readings are snapped to the nearest slot; if two land on the same slot,
+      the later one in the input wins. Empty slots between readings no more
+      than max_gap_minutes apart are filled by linear interpolation, and
+      longer stretches are marked as gaps.
+    """
+    timestamps, heights = readings_to_arrays(readings)
+    return resample_arrays(timestamps, heights, interval_minutes,
+            max_gap_minutes)
+
+
+def resample_arrays(timestamps, heights, interval_minutes=None,
+        max_gap_minutes=MAX_GAP_MINUTES):
+    """Same as resample_readings(), for epoch-second and height arrays."""
+    if interval_minutes:
+        interval = int(interval_minutes * 60)
+    else:
+        interval = infer_interval(timestamps)
+
+    if not len(timestamps):
+        return RegularSeries(0, interval, np.empty(0), np.empty(0, np.int64))
+
+    # Stable sort, so duplicates keep their input order.
+    order = np.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+
+    start = timestamps[0] - timestamps[0] % interval
+    slots = np.rint((timestamps - start) / interval).astype(np.int64)
+    num_slots = slots[-1] + 1
+
+    series_heights = np.full(num_slots, np.nan)
+    source_index = np.full(num_slots, -1, dtype=np.int64)
+    series_heights[slots] = heights[order]
+    source_index[slots] = order
+
+    # Fill short runs of empty slots, and leave longer runs as gaps.
+    filled = np.flatnonzero(source_index >= 0)
+    empty = np.flatnonzero(source_index < 0)
+    if len(empty):
+        next_filled = filled[np.searchsorted(filled, empty)]
+        prev_filled = filled[np.searchsorted(filled, empty) - 1]
+        fillable = (next_filled - prev_filled) * interval <= max_gap_minutes * 60
+        fill_slots = empty[fillable]
+        series_heights[fill_slots] = np.interp(fill_slots, filled,
+                series_heights[filled])
+
+    return RegularSeries(start, interval, series_heights, source_index)
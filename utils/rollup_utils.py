@@ -0,0 +1,204 @@
+"""Hourly and daily rollups of the reading archive.
+
+Questions about more than a few days, such as the biggest rise each day
+this fall, shouldn't need every 15-minute reading. Each rollup row
+summarizes one hour, or one local day: the lowest, highest, mean, first and
+last heights, and the largest rise into any reading in that period from the
+readings within the critical lookback before it.
+
+Rollups are stored next to the archive, one file per month for each
+resolution like the archive, and updated whenever readings are merged into
+it. Only the periods the new readings can affect are recomputed, and only
+the months those periods start in are rewritten.
+"""
+
+import datetime, os, shutil
+
+import numpy as np
+import pytz
+
+import utils.analysis_utils as a_utils
+from utils import critical_rules, reading_archive, resample_utils
+
+
+aktz = pytz.timezone('US/Alaska')
+
+ROLLUP_DIR = os.path.join(reading_archive.ARCHIVE_DIR, 'rollups')
+RESOLUTIONS = ('hourly', 'daily')
+
+# ts is the start of the period, as epoch seconds. Daily periods are local
+#   days. min_ts and max_ts are the times of the lowest and highest readings.
+ROLLUP_DTYPE = np.dtype([
+    ('ts', '<i8'), ('count', '<i8'),
+    ('min', '<f8'), ('max', '<f8'), ('mean', '<f8'),
+    ('first', '<f8'), ('last', '<f8'), ('max_rise', '<f8'),
+    ('min_ts', '<i8'), ('max_ts', '<i8'),
+])
+
+# Readings this far back can affect a reading's max rise.
+LOOKBACK_SECONDS = (critical_rules.get_lookback_hours() * 3600
+        + resample_utils.MAX_GAP_MINUTES * 60)
+
+
+def compute_rollups(timestamps, heights, resolution='hourly'):
+    """Roll up sorted readings, given as epoch-second and height arrays.
+    Returns a structured array of ROLLUP_DTYPE, one row per period with
+    readings in it.
+
+    The first LOOKBACK_SECONDS of readings have nothing to look back on, so
+      max rises there can come out low. Pass in earlier readings as well,
+      and drop the rows that aren't needed.
+    """
+    if not len(timestamps):
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+
+    rises = get_reading_rises(timestamps, heights)
+
+    keys = get_period_starts(timestamps, resolution)
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    ends = np.append(starts[1:], len(keys))
+    period_index = np.repeat(np.arange(len(starts)), ends - starts)
+
+    rollups = np.empty(len(starts), dtype=ROLLUP_DTYPE)
+    rollups['ts'] = keys[starts]
+    rollups['count'] = ends - starts
+    rollups['min'] = np.minimum.reduceat(heights, starts)
+    rollups['max'] = np.maximum.reduceat(heights, starts)
+    rollups['mean'] = np.add.reduceat(heights, starts) / rollups['count']
+    rollups['first'] = heights[starts]
+    rollups['last'] = heights[ends - 1]
+    rollups['max_rise'] = np.fmax.reduceat(rises, starts)
+
+    # Time of the first reading at each period's min and max.
+    never = np.iinfo(np.int64).max
+    for field in ('min', 'max'):
+        at_extreme = heights == rollups[field][period_index]
+        rollups[f"{field}_ts"] = np.minimum.reduceat(
+                np.where(at_extreme, timestamps, never), starts)
+
+    return rollups
+
+
+def get_reading_rises(timestamps, heights):
+    """Return the largest rise into each reading, from any reading within
+    the critical lookback window. Readings with nothing to compare against
+    are nan.
+    """
+    series = resample_utils.resample_arrays(timestamps, heights)
+    max_rise = a_utils.get_max_rise(series)
+
+    rises = np.full(len(timestamps), np.nan)
+    source_slots = np.flatnonzero(series.source_index >= 0)
+    rises[series.source_index[source_slots]] = max_rise[source_slots]
+    return rises
+
+
+def get_period_starts(timestamps, resolution='hourly'):
+    """Return the start of the hour, or local day, of each timestamp."""
+    if resolution == 'hourly':
+        return timestamps - timestamps % 3600
+
+    # Alaska's utc offset is a whole number of hours, and changes on the
+    #   hour, so one offset per hour is enough.
+    hours, hour_index = np.unique(timestamps // 3600, return_inverse=True)
+    offsets = np.array([_get_local_offset(h * 3600) for h in hours.tolist()],
+            dtype=np.int64)
+    local_days = (timestamps + offsets[hour_index]) // 86400
+
+    days, day_index = np.unique(local_days, return_inverse=True)
+    day_starts = np.array([_get_local_midnight(d) for d in days.tolist()],
+            dtype=np.int64)
+    return day_starts[day_index]
+
+
+def update_rollups(timestamps, heights, archive_dir=reading_archive.ARCHIVE_DIR,
+        rollup_dir=None):
+    """Bring the rollups up to date after readings in this range have been
+    merged into the archive.
+    """
+    if not len(timestamps):
+        return
+    rollup_dir = rollup_dir if rollup_dir else get_rollup_dir(archive_dir)
+
+    # Readings can change the max rise of readings up to LOOKBACK_SECONDS
+    #   later. Load enough on either side to recompute whole local days.
+    ts_first = int(np.min(timestamps))
+    ts_last = int(np.max(timestamps)) + LOOKBACK_SECONDS
+    context_seconds = 86400 + LOOKBACK_SECONDS
+    archive_ts, archive_heights = reading_archive.load_arrays(
+            _ts_to_dt(ts_first - context_seconds),
+            _ts_to_dt(ts_last + 86400), archive_dir)
+
+    for resolution in RESOLUTIONS:
+        rollups = compute_rollups(archive_ts, archive_heights, resolution)
+        first_period, last_period = get_period_starts(
+                np.array([ts_first, ts_last]), resolution)
+        affected = (rollups['ts'] >= first_period) & (rollups['ts'] <= last_period)
+        save_rollups(rollups[affected], resolution, rollup_dir)
+
+
+def rebuild_rollups(archive_dir=reading_archive.ARCHIVE_DIR, rollup_dir=None):
+    """Compute the rollups for the whole archive from scratch."""
+    rollup_dir = rollup_dir if rollup_dir else get_rollup_dir(archive_dir)
+    timestamps, heights = reading_archive.load_arrays(archive_dir=archive_dir)
+    for resolution in RESOLUTIONS:
+        shutil.rmtree(_get_resolution_dir(resolution, rollup_dir),
+                ignore_errors=True)
+        save_rollups(compute_rollups(timestamps, heights, resolution),
+                resolution, rollup_dir)
+
+
+def save_rollups(rollups, resolution, rollup_dir=ROLLUP_DIR):
+    """Merge rollup rows into the stored rollups. A row for a period that's
+    already stored replaces it. Only the months the rows fall in are
+    rewritten.
+    """
+    if not len(rollups):
+        return
+    reading_archive.save_records(rollups,
+            _get_resolution_dir(resolution, rollup_dir))
+
+
+def load_rollups(resolution='hourly', dt_start=None, dt_end=None,
+        rollup_dir=ROLLUP_DIR):
+    """Return the rollup rows for periods starting from dt_start to dt_end,
+    inclusive. Either end can be left open.
+    """
+    return reading_archive.load_records(dt_start, dt_end,
+            _get_resolution_dir(resolution, rollup_dir), ROLLUP_DTYPE)
+
+
+def get_formatted_rollup(row, resolution='hourly'):
+    """Print a neat summary of one rollup row."""
+    dt = _ts_to_dt(row['ts']).astimezone(aktz)
+    dt_format = '%m/%d/%Y' if resolution == 'daily' else '%m/%d/%Y %H:%M'
+    dt_str = dt.strftime(dt_format)
+    return (f"{dt_str} - min {row['min']:.2f}, max {row['max']:.2f}, "
+            f"mean {row['mean']:.2f}, max rise {row['max_rise']:.2f} ft")
+
+
+def get_rollup_dir(archive_dir=reading_archive.ARCHIVE_DIR):
+    """Return the rollup directory that goes with an archive."""
+    return os.path.join(archive_dir, 'rollups')
+
+
+def _get_resolution_dir(resolution, rollup_dir):
+    return os.path.join(rollup_dir, resolution)
+
+
+def _get_local_offset(ts):
+    """Return Alaska's utc offset at ts, in seconds."""
+    return int(_ts_to_dt(ts).astimezone(aktz).utcoffset().total_seconds())
+
+
+def _get_local_midnight(local_day):
+    """Return epoch seconds at the start of a local day, given as days
+    since the epoch.
+    """
+    date = datetime.date(1970, 1, 1) + datetime.timedelta(days=local_day)
+    return int(aktz.localize(datetime.datetime(date.year, date.month,
+            date.day)).timestamp())
+
+
+def _ts_to_dt(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=pytz.utc)
@@ -0,0 +1,208 @@
+"""Shared cache of the latest analyzed series.
+
+Refresh publishes the latest readings, critical points, minimum critical
+forecast and nowcast as a new version: a directory of .npy files, plus a
+small json file of metadata. Once the version is complete, a pointer file
+is swapped to it atomically, so readers only ever see complete versions.
+
+Every web worker memory-maps the current version read-only. The OS shares
+those pages between processes, nothing is parsed, and no locks are needed.
+A worker only reopens the files when the pointer moves to a new version.
+
+Each version also holds the json the site serves, already gzipped and
+brotli-compressed, so serving it is just sending bytes.
+"""
+
+import json, os, shutil
+
+import numpy as np
+
+from utils import artifact_store, resample_utils, time_utils
+
+
+CACHE_DIR = 'historical_data/latest'
+POINTER_FILE = 'CURRENT'
+META_FILE = 'meta.json'
+JSON_FILE = 'latest.json'
+# Series included in the json.
+JSON_SERIES = ('readings', 'critical_points', 'min_critical_forecast')
+
+# Old versions are kept for a little while, for readers that are still
+#   partway through a request. Readers that have mapped an old version keep
+#   their data even after it's removed.
+KEEP_VERSIONS = 3
+
+SERIES_DTYPE = np.dtype([('ts', '<i8'), ('height', '<f8')])
+
+# The version each process has mapped, by cache directory.
+_mapped = {}
+
+
+class LatestSeries:
+    """One published version of the latest series. Arrays are read-only
+    memory maps.
+    """
+
+    def __init__(self, version, arrays, meta, json_file=None):
+        self.version = version
+        self.arrays = arrays
+        self.meta = meta
+        # The version's json, written when it was published.
+        self.json_file = json_file
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def get_readings(self, name='readings'):
+        """Return one of the published series as IRReadings."""
+        series = self.arrays[name]
+        return resample_utils.arrays_to_readings(series['ts'], series['height'])
+
+    def get_json_data(self, since_ts=None):
+        """Return the json data for this version. With since_ts, each
+        series only has the points after it. The arrays are sorted, so
+        these are slices of the maps, not copies.
+        """
+        arrays = self.arrays
+        if since_ts is not None:
+            arrays = {name: series[np.searchsorted(series['ts'], since_ts,
+                            side='right'):]
+                        for name, series in arrays.items()}
+        return get_json_data(arrays, self.meta)
+
+
+def publish(arrays, meta=None, cache_dir=CACHE_DIR):
+    """Publish a new version of the cache.
+
+    arrays is a dict of numpy arrays by name, and meta is a dict of anything
+      json can hold.
+    Returns the new version number.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    version = (get_current_version(cache_dir) or 0) + 1
+
+    # Write everything into a temp directory, then rename it into place.
+    tmp_dir = os.path.join(cache_dir, f".tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    meta = dict(meta if meta else {}, version=version)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    json_file = os.path.join(tmp_dir, JSON_FILE)
+    with open(json_file, 'w') as f:
+        json.dump(get_json_data(arrays, meta), f)
+    artifact_store.write_compressed_variants(json_file)
+    # A publish that died before swapping the pointer can leave this
+    #   version behind. No reader has seen it, so it's replaced.
+    version_dir = _get_version_dir(version, cache_dir)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.rename(tmp_dir, version_dir)
+
+    # Swap the pointer. Readers see either the old version or the new one.
+    pointer_file = os.path.join(cache_dir, POINTER_FILE)
+    with open(f"{pointer_file}.tmp", 'w') as f:
+        f.write(str(version))
+    os.replace(f"{pointer_file}.tmp", pointer_file)
+
+    _remove_old_versions(version, cache_dir)
+    return version
+
+
+def publish_series(readings, critical_points=[], min_cf_readings=[],
+        nowcast=None, meta=None, cache_dir=CACHE_DIR):
+    """Publish the results of analyzing the latest readings."""
+    arrays = {
+        'readings': readings_to_series(readings),
+        'critical_points': readings_to_series(critical_points),
+        'min_critical_forecast': readings_to_series(min_cf_readings),
+    }
+    meta = dict(meta if meta else {})
+    if nowcast:
+        for p, heights in nowcast.percentiles.items():
+            arrays[f"nowcast_{p}"] = _to_series(nowcast.timestamps, heights)
+        meta['nowcast_probability'] = nowcast.probability
+        meta['nowcast_method'] = nowcast.method
+    return publish(arrays, meta, cache_dir)
+
+
+def get_latest(cache_dir=CACHE_DIR):
+    """Return the current version of the cache, or None if nothing has been
+    published yet. Only maps the files again when the version has changed.
+    """
+    while True:
+        version = get_current_version(cache_dir)
+        if version is None:
+            return None
+        mapped = _mapped.get(cache_dir)
+        if mapped and mapped.version == version:
+            return mapped
+
+        version_dir = _get_version_dir(version, cache_dir)
+        try:
+            arrays = {f[:-4]: np.load(os.path.join(version_dir, f),
+                            mmap_mode='r')
+                        for f in os.listdir(version_dir) if f.endswith('.npy')}
+            with open(os.path.join(version_dir, META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            # Several versions were published since the pointer was read,
+            #   and this one was pruned. Read the pointer again.
+            continue
+
+        _mapped[cache_dir] = LatestSeries(version, arrays, meta,
+                os.path.join(version_dir, JSON_FILE))
+        return _mapped[cache_dir]
+
+
+def get_json_data(arrays, meta):
+    """Return the series in JSON_SERIES as local time strings and heights,
+    along with the version and metadata.
+    """
+    data = {'version': meta['version'], 'meta': meta}
+    for name in JSON_SERIES:
+        if name not in arrays:
+            continue
+        series = arrays[name]
+        data[name] = {
+            'x': time_utils.to_local_strings(series['ts'],
+                    with_offset=True).tolist(),
+            'y': series['height'].tolist(),
+        }
+    return data
+
+
+def get_current_version(cache_dir=CACHE_DIR):
+    """Return the current version number, or None."""
+    try:
+        with open(os.path.join(cache_dir, POINTER_FILE)) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def readings_to_series(readings):
+    """Return a list of IRReadings as a SERIES_DTYPE array."""
+    timestamps, heights = resample_utils.readings_to_arrays(readings)
+    return _to_series(timestamps, heights)
+
+
+def _to_series(timestamps, heights):
+    series = np.empty(len(timestamps), dtype=SERIES_DTYPE)
+    series['ts'] = timestamps
+    series['height'] = heights
+    return series
+
+
+def _get_version_dir(version, cache_dir):
+    return os.path.join(cache_dir, f"v{version:08d}")
+
+
+def _remove_old_versions(version, cache_dir):
+    for name in os.listdir(cache_dir):
+        if name.startswith('v') and int(name[1:]) <= version - KEEP_VERSIONS:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
@@ -0,0 +1,274 @@
+"""Single-flight runs, across processes.
+
+Only one refresh runs at a time, however it was started. The process
+running it holds a lease: a small json file naming the run, the process,
+and when the lease expires. A heartbeat thread extends the lease while the
+run goes on. A process that finds the lease held doesn't start a second
+fetch and render; it waits for the running one to finish, and takes its
+result.
+
+A lease is stale once it hasn't been extended in time, or its process has
+exited, and the next process to come along takes it over. A run that goes
+past MAX_RUN_MINUTES stops extending its lease, so a hung refresh can't
+block every later one. Such a run has lost its lease, like a run whose
+lease was taken over: the run is passed its Lease, and checks it before
+each write, so it stops rather than writing alongside the run that
+replaced it. Work that's expected to run long, like a backfill, holds an
+uncapped lease instead, which is extended for as long as its process
+lives.
+
+Leases are only read and written while holding a short flock on a guard
+file, so two processes can't both take over the same stale lease.
+"""
+
+import datetime, fcntl, json, os, socket, threading, time, uuid
+from contextlib import contextmanager
+
+import pytz
+
+
+LOCK_DIR = 'historical_data/locks'
+
+# A lease lasts this long unless it's extended.
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+MAX_RUN_MINUTES = 30
+
+# How often a waiting process checks on the lease.
+POLL_SECONDS = 0.5
+
+
+class LeaseLostError(RuntimeError):
+    """A run's lease was taken over, or the run went on too long."""
+
+
+class Lease:
+    """A lease on a named run, held by this process."""
+
+    def __init__(self, name, lock_dir=LOCK_DIR, capped=True):
+        self.name = name
+        self.lock_dir = lock_dir
+        # If capped, the lease is only extended for MAX_RUN_MINUTES.
+        self.capped = capped
+        self.run_id = uuid.uuid4().hex[:12]
+        # The lease that was in the way, after a failed acquire().
+        self.holder = None
+        # True once this process can't count on the lease any more: another
+        #   process took it over, or the run went past MAX_RUN_MINUTES.
+        self.lost = False
+        self._started = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        """Take the lease, if it's free or stale. Returns True if this
+        process now holds it.
+        """
+        with _guard(self.name, self.lock_dir):
+            lease = read_lease(self.name, self.lock_dir)
+            if lease and not is_stale(lease):
+                self.holder = lease
+                return False
+            if lease:
+                print(f"Taking over a stale {self.name} lease from"
+                        f" pid {lease['pid']} on {lease['host']}.")
+            self._started = time.time()
+            self._write()
+
+        self._heartbeat = threading.Thread(target=self._extend, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def release(self):
+        """Give up the lease, unless another process has taken it over."""
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        with _guard(self.name, self.lock_dir):
+            lease = read_lease(self.name, self.lock_dir)
+            if lease and lease['run_id'] == self.run_id:
+                os.remove(get_lease_file(self.name, self.lock_dir))
+
+    def check(self):
+        """Raise LeaseLostError if this process no longer holds the lease.
+        Call before each write that must not overlap another run.
+        """
+        if self.lost:
+            raise LeaseLostError(f"Lost the {self.name} lease; stopping"
+                    f" run {self.run_id}.")
+
+    def _extend(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            if (self.capped
+                    and time.time() - self._started > MAX_RUN_MINUTES * 60):
+                # The lease will expire, and another process can take it
+                #   over.
+                self.lost = True
+                return
+            with _guard(self.name, self.lock_dir):
+                lease = read_lease(self.name, self.lock_dir)
+                if not lease or lease['run_id'] != self.run_id:
+                    self.lost = True
+                    return
+                self._write()
+
+    def _write(self):
+        lease = {
+            'run_id': self.run_id,
+            'pid': os.getpid(),
+            'host': socket.gethostname(),
+            'started': self._started,
+            'expires': time.time() + LEASE_SECONDS,
+        }
+        _write_json(get_lease_file(self.name, self.lock_dir), lease)
+
+
+def run_single_flight(name, func, lock_dir=LOCK_DIR, timeout_minutes=None):
+    """Run func, unless another process is already running the same named
+    run; then wait for that run, and use its result.
+
+    func is called with the Lease, and should call its check() before each
+      write. func's result must be json serializable. If the run that was joined
+      failed, this raises RuntimeError.
+    Returns the result, and whether it came from another process's run.
+    """
+    timeout_minutes = timeout_minutes if timeout_minutes else MAX_RUN_MINUTES
+    deadline = time.time() + timeout_minutes * 60
+    while True:
+        lease = Lease(name, lock_dir)
+        if lease.acquire():
+            # Joiners look for the result once the lease is gone, so it's
+            #   saved first.
+            try:
+                result = func(lease)
+                _save_result(lease, {'ok': True, 'result': result})
+            # Record a sys.exit() or an interrupt too, or joiners would
+            #   find no result, and run again themselves.
+            except BaseException as e:
+                _save_result(lease, {'ok': False, 'error': repr(e)})
+                raise
+            finally:
+                lease.release()
+            return result, False
+
+        holder = lease.holder
+        print(f"A {name} run started by pid {holder['pid']} on"
+                f" {holder['host']} is in progress; waiting for it.")
+        _wait_for_run(name, holder['run_id'], lock_dir, deadline)
+
+        record = load_result(name, lock_dir)
+        if record and record['run_id'] == holder['run_id']:
+            if not record['ok']:
+                raise RuntimeError(f"The {name} run that was joined failed:"
+                        f" {record['error']}")
+            return record['result'], True
+        # The run ended without a result, so its lease went stale. Try to
+        #   run it here.
+
+
+@contextmanager
+def hold_lease(name, lock_dir=LOCK_DIR, timeout_minutes=None, capped=True):
+    """Wait for the lease on a named run, and hold it for the duration of
+    the block. For work that must not overlap a run, but can't use its
+    result. The block should call the lease's check() before each write.
+
+    With capped=False, the lease isn't given up after MAX_RUN_MINUTES, for
+      work that can take longer than a run, like a backfill.
+    """
+    timeout_minutes = timeout_minutes if timeout_minutes else MAX_RUN_MINUTES
+    deadline = time.time() + timeout_minutes * 60
+    lease = Lease(name, lock_dir, capped)
+    while not lease.acquire():
+        print(f"Waiting for the {name} run started by pid"
+                f" {lease.holder['pid']} on {lease.holder['host']}.")
+        _wait_for_run(name, lease.holder['run_id'], lock_dir, deadline)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+def read_lease(name, lock_dir=LOCK_DIR):
+    """Return the current lease on a named run, or None."""
+    try:
+        with open(get_lease_file(name, lock_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_stale(lease):
+    """A lease is stale once it's expired, or its process has exited."""
+    if lease['expires'] < time.time():
+        return True
+    if lease['host'] == socket.gethostname():
+        return not _pid_exists(lease['pid'])
+    return False
+
+
+def load_result(name, lock_dir=LOCK_DIR):
+    """Return the record of the last completed run, or None."""
+    try:
+        with open(get_result_file(name, lock_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def get_lease_file(name, lock_dir=LOCK_DIR):
+    return os.path.join(lock_dir, f"{name}.lease.json")
+
+
+def get_result_file(name, lock_dir=LOCK_DIR):
+    return os.path.join(lock_dir, f"{name}.result.json")
+
+
+def _wait_for_run(name, run_id, lock_dir, deadline):
+    """Wait until a run has released its lease, or the lease has gone
+    stale.
+    """
+    while True:
+        lease = read_lease(name, lock_dir)
+        if not lease or lease['run_id'] != run_id or is_stale(lease):
+            return
+        if time.time() > deadline:
+            raise TimeoutError(f"Gave up waiting for the {name} run"
+                    f" started by pid {lease['pid']}.")
+        time.sleep(POLL_SECONDS)
+
+
+def _save_result(lease, record):
+    # A run whose lease was taken over doesn't get to report for the run
+    #   that replaced it.
+    if lease.lost:
+        return
+    record = dict(record, run_id=lease.run_id,
+            dt_finished=datetime.datetime.now(pytz.utc).isoformat())
+    _write_json(get_result_file(lease.name, lease.lock_dir), record)
+
+
+@contextmanager
+def _guard(name, lock_dir):
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{name}.guard"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_json(filename, data):
+    with open(f"{filename}.tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(f"{filename}.tmp", filename)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
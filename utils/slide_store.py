@@ -0,0 +1,101 @@
+"""Model and store for known slide events.
+
+The time of a slide often isn't known exactly, so every slide covers an
+interval, which may be a single moment. The store keeps slides sorted by
+start time, so finding the slides that overlap any window is a binary
+search rather than a scan, whether it's one plot or thousands of
+animation frames.
+"""
+
+import csv, datetime, os
+
+import numpy as np
+import pytz
+
+
+SLIDES_FILE = 'historical_data/known_slides.csv'
+
+
+class SlideEvent:
+
+    def __init__(self, dt_start, dt_end=None, name=''):
+        """Every slide has a start and end time, which are the same if
+        the time is known exactly.
+        """
+        self.dt_start = dt_start
+        self.dt_end = dt_end if dt_end else dt_start
+        self.name = name
+
+    @property
+    def dt_slide(self):
+        """Best single time for the slide; the middle of its interval."""
+        return self.dt_start + (self.dt_end - self.dt_start) / 2
+
+    def get_formatted_slide(self):
+        """Print a neat string of the slide."""
+        dt = self.dt_slide.strftime('%m/%d/%Y %H:%M:%S')
+        return f"{dt} - {self.name}"
+
+
+class SlideStore:
+    """Known slides, indexed by time interval."""
+
+    def __init__(self, slides=None):
+        slides = sorted(slides if slides else [], key=lambda s: s.dt_start)
+        self.slides = slides
+        self._starts = np.array([s.dt_start.timestamp() for s in slides])
+        self._ends = np.array([s.dt_end.timestamp() for s in slides])
+        # No slide starts earlier than this before its end, which bounds
+        #   how far back a search has to go.
+        self._max_duration = (self._ends - self._starts).max() if slides else 0
+
+    def __len__(self):
+        return len(self.slides)
+
+    def get_slides(self, dt_start, dt_end):
+        """Return all slides that overlap the window from dt_start to
+        dt_end, inclusive.
+        """
+        ts_start, ts_end = dt_start.timestamp(), dt_end.timestamp()
+        first = np.searchsorted(self._starts, ts_start - self._max_duration)
+        last = np.searchsorted(self._starts, ts_end, side='right')
+        return [self.slides[i] for i in range(first, last)
+                    if self._ends[i] >= ts_start]
+
+    def get_slides_for_readings(self, readings, hours_after=0):
+        """Return the slides that overlap a set of readings, optionally
+        extending the window past the last reading.
+        """
+        dt_end = readings[-1].dt_reading + datetime.timedelta(hours=hours_after)
+        return self.get_slides(readings[0].dt_reading, dt_end)
+
+    def get_slide_timestamps(self):
+        """Return the epoch time of every slide, as an array."""
+        return np.array([s.dt_slide.timestamp() for s in self.slides])
+
+
+def load_slides(filename=SLIDES_FILE):
+    """Load known slides from a csv file, with a header row and columns for
+    name, start, and end. Times are iso format in utc; end can be blank.
+
+    Returns an empty store if there's no file.
+    """
+    if not os.path.exists(filename):
+        return SlideStore()
+
+    slides = []
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            dt_start = _parse_dt(row['start'])
+            dt_end = _parse_dt(row['end']) if row.get('end') else None
+            slides.append(SlideEvent(dt_start, dt_end, row['name']))
+
+    return SlideStore(slides)
+
+
+def _parse_dt(dt_str):
+    dt = datetime.datetime.fromisoformat(dt_str)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.utc)
+    return dt
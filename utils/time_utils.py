@@ -0,0 +1,133 @@
+"""Bulk conversion of epoch timestamps to Alaska local time.
+
+Converting one datetime at a time with astimezone() looks up the offset for
+every reading. Alaska's offset only changes at its DST transitions, so the
+transitions are read once from the pytz zone, and an array of timestamps
+is converted with a single searchsorted. pytz keeps the transitions in
+private attributes; a zone without them falls back to converting one
+timestamp at a time.
+
+LocalTimes holds a series' times in every form the plots use, each encoded
+once: utc datetime64 values for matplotlib, and local time strings for
+plotly. A slice of a LocalTimes shares the encoded values, so every frame
+of an animation is cut from one conversion of the whole series.
+"""
+
+import calendar, datetime
+
+import numpy as np
+import pytz
+
+from utils import resample_utils
+
+
+aktz = pytz.timezone('US/Alaska')
+
+# Sorted utc epoch seconds of aktz's transitions, and the offset in
+#   seconds from each one on.
+_transitions = None
+
+
+class LocalTimes:
+    """The times of a series, as utc values and as local time strings."""
+
+    def __init__(self, timestamps):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self._utc = None
+        self._strings = None
+
+    @classmethod
+    def from_readings(cls, readings):
+        timestamps, _ = resample_utils.readings_to_arrays(readings)
+        return cls(timestamps)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        """Slice, sharing anything already encoded."""
+        sliced = LocalTimes(self.timestamps[index])
+        if self._utc is not None:
+            sliced._utc = self._utc[index]
+        if self._strings is not None:
+            sliced._strings = self._strings[index]
+        return sliced
+
+    @property
+    def utc(self):
+        """datetime64 values, for matplotlib. Set the axis to aktz to label
+        them in local time.
+        """
+        if self._utc is None:
+            self._utc = self.timestamps.astype('datetime64[s]')
+        return self._utc
+
+    @property
+    def strings(self):
+        """Local time strings, for plotly. Plotly considers everything utc,
+        so it's sent local times without an offset, and plots the dates as
+        they read.
+        """
+        if self._strings is None:
+            self._strings = to_local_strings(self.timestamps)
+        return self._strings
+
+    def take(self, timestamps):
+        """Return the times in this series at the given timestamps, which
+        must all be in the series.
+        """
+        index = np.searchsorted(self.timestamps,
+                np.asarray(timestamps, dtype=np.int64))
+        return self[index]
+
+
+def get_utc_offsets(timestamps):
+    """Return aktz's utc offset in seconds at each epoch timestamp."""
+    if not _has_transitions():
+        return np.array([int(datetime.datetime.fromtimestamp(ts, pytz.utc)
+                    .astimezone(aktz).utcoffset().total_seconds())
+                for ts in np.asarray(timestamps).tolist()], dtype=np.int64)
+    transition_ts, offsets = _get_transitions()
+    index = np.searchsorted(transition_ts, timestamps, side='right') - 1
+    return offsets[np.maximum(index, 0)]
+
+
+def to_local_strings(timestamps, with_offset=False):
+    """Return an array of local time strings, ie '2019-09-21 14:15:00'.
+    With an offset, the strings match str() of an aware datetime, ie
+    '2019-09-21 14:15:00-08:00'.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if not len(timestamps):
+        return np.empty(0, dtype=str)
+    offsets = get_utc_offsets(timestamps)
+    local = (timestamps + offsets).astype('datetime64[s]')
+    strings = np.char.replace(np.datetime_as_string(local, unit='s'), 'T', ' ')
+    if not with_offset:
+        return strings
+
+    # Alaska's offsets are whole hours and minutes behind utc.
+    minutes = np.abs(offsets) // 60
+    offset_strings = np.char.add(
+            np.char.add(np.where(offsets < 0, '-', '+'),
+                np.char.zfill((minutes // 60).astype(str), 2)),
+            np.char.add(':', np.char.zfill((minutes % 60).astype(str), 2)))
+    return np.char.add(strings, offset_strings)
+
+
+def _has_transitions():
+    return (hasattr(aktz, '_utc_transition_times')
+            and hasattr(aktz, '_transition_info'))
+
+
+def _get_transitions():
+    global _transitions
+    if _transitions is None:
+        # DEV: pytz keeps the zone's transitions as naive utc datetimes,
+        #   and (utcoffset, dst, tzname) for each one.
+        transition_ts = np.array([calendar.timegm(dt.timetuple())
+                for dt in aktz._utc_transition_times], dtype=np.int64)
+        offsets = np.array([int(info[0].total_seconds())
+                for info in aktz._transition_info], dtype=np.int64)
+        _transitions = (transition_ts, offsets)
+    return _transitions